@@ -0,0 +1,139 @@
+"""Time of the batch user summaries (src.analytics) on a synthetic database.
+
+Seeds a temporary database with --users users and --rows records in total, with noise, gaps and a
+few outliers, recomputes the summary table and reports the throughput and the peak memory. A sample
+of the users is checked against a per-user reference: np.polyfit for the slopes and a plain loop for
+the smoothed weight.
+
+Usage (from the repository root):
+
+    python -m benchmarks.batch_analytics [--rows 1000000] [--users 5000] [--chunk-rows 50000]
+"""
+import argparse
+import asyncio
+import json
+import logging
+import math
+import multiprocessing
+import os
+import resource
+import sqlite3
+import sys
+import tempfile
+import time
+
+repository_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, repository_root)
+os.chdir(repository_root)
+
+import numpy as np
+from telebot import logger
+
+import src.analytics
+import src.batchstats
+import src.database
+from src.datautils import init_database
+from src.metrics import process_rss_bytes
+
+
+def seed_records(path: str, rows: int, users: int, seed: int = 1) -> None:
+    random = np.random.default_rng(seed)
+    lengths = random.multinomial(rows - users, np.ones(users) / users) + 1
+    user_id = np.repeat(np.arange(1, users + 1, dtype=np.int64) * 7919, lengths)
+    # Days with gaps of 1 to 4 days, starting from a random day of the last few years
+    gaps = random.integers(1, 5, size=rows)
+    starts = np.r_[0, np.cumsum(lengths)[:-1]]
+    gaps[starts] = random.integers(17000, 19500, size=users)
+    day = np.cumsum(gaps) - np.repeat(np.cumsum(gaps)[starts] - gaps[starts], lengths)
+    trend = np.repeat(random.normal(0, 0.02, size=users), lengths)
+    mass = np.repeat(random.uniform(55, 110, size=users), lengths) + trend * (day - np.repeat(day[starts], lengths))
+    mass += random.normal(0, 0.4, size=rows)
+    outliers = random.random(rows) < 0.001
+    mass[outliers] += random.choice([-8.0, 8.0], size=int(outliers.sum()))
+
+    connection = sqlite3.connect(path)
+    connection.executemany(f"INSERT INTO {src.analytics.sqlite_db_users_mass} (user_id, day, body_mass) "
+                           f"VALUES (?, ?, ?)", zip(user_id.tolist(), day.tolist(), np.round(mass, 1).tolist()))
+    connection.commit()
+    connection.close()
+
+
+def reference_summary(rows: list[tuple[int, float]]) -> dict:
+    day = np.array([row[0] for row in rows], dtype=np.float64)
+    mass = np.array([row[1] for row in rows])
+    tau = src.batchstats.ewma_half_life / math.log(2)
+    ewma = mass[0]
+    for i in range(1, len(rows)):
+        alpha = 1 - math.exp(-(day[i] - day[i - 1]) / tau)
+        ewma = (1 - alpha) * ewma + alpha * mass[i]
+    recent = day > day[-1] - src.batchstats.recent_days
+    return {'slope': np.polyfit(day, mass, 1)[0] if len(rows) > 1 else None,
+            'recent_slope': np.polyfit(day[recent], mass[recent], 1)[0] if recent.sum() > 1 else None,
+            'mean_mass': mass.mean(), 'ewma_mass': ewma}
+
+
+def close(value, expected) -> bool:
+    if value is None or expected is None:
+        return value is None and expected is None
+    return abs(value - expected) <= 1e-6 * max(1.0, abs(expected))
+
+
+async def run(arguments: argparse.Namespace) -> dict:
+    directory = tempfile.TemporaryDirectory()
+    src.database.sqlite_db_path = os.path.join(directory.name, 'bodymass.sqlite')
+    await init_database()
+    await src.database.close_connection()
+    seed_start = time.perf_counter()
+    # In a child process, so the seeding does not count towards this process' peak memory
+    seeding = multiprocessing.Process(target=seed_records,
+                                      args=(src.database.sqlite_db_path, arguments.rows, arguments.users))
+    seeding.start()
+    seeding.join()
+    seed_seconds = time.perf_counter() - seed_start
+
+    rss_before = process_rss_bytes()
+    start = time.perf_counter()
+    records, users = await src.analytics.update_summaries(arguments.chunk_rows)
+    duration = time.perf_counter() - start
+    peak_after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+    mismatches = []
+    for user_id, in await src.database.fetchall(f"SELECT user_id FROM {src.analytics.sqlite_db_users_mass_summary} "
+                                                f"ORDER BY random() LIMIT ?", (arguments.check_users,)):
+        summary = await src.analytics.fetch_user_summary(user_id)
+        expected = reference_summary(await src.database.fetchall(
+            f"SELECT day, body_mass FROM {src.analytics.sqlite_db_users_mass} WHERE user_id = ? ORDER BY day",
+            (user_id,)))
+        for name, value in expected.items():
+            if not close(getattr(summary, name), value):
+                mismatches.append(f"user {user_id} {name}: {getattr(summary, name)} != {value}")
+    outliers = (await src.database.fetchone(f"SELECT SUM(outliers) FROM {src.analytics.sqlite_db_users_mass_summary}"))[0]
+    await src.database.close_connection()
+    directory.cleanup()
+
+    return {'records': records,
+            'users': users,
+            'chunk_rows': arguments.chunk_rows,
+            'seed_seconds': seed_seconds,
+            'seconds': duration,
+            'records_per_s': records / duration,
+            'outliers': outliers,
+            'rss_before_bytes': rss_before,
+            'peak_rss_bytes': peak_after,
+            'peak_rss_increase_bytes': peak_after - rss_before,
+            'checked_users': arguments.check_users,
+            'mismatches': mismatches[:10]}
+
+
+def parse_arguments() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rows', type=int, default=1_000_000)
+    parser.add_argument('--users', type=int, default=5000)
+    parser.add_argument('--chunk-rows', type=int, default=src.analytics.analytics_chunk_rows)
+    parser.add_argument('--check-users', type=int, default=50, help='users checked against the reference')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    logger.setLevel(logging.WARNING)
+    json.dump(asyncio.run(run(parse_arguments())), sys.stdout, indent=2)
@@ -0,0 +1,335 @@
+"""Offline benchmarks of the message handling hot paths.
+
+Drives reply() from main.py with synthetic messages against a stub bot and a temporary
+SQLite database, then times the data and plotting helpers on users of different sizes.
+Startup time and resident memory of a fresh bot process are measured in a subprocess.
+Nothing is sent to Telegram.
+
+Usage (from the repository root):
+
+    python -m benchmarks.bench [--iterations N] [--sizes 10,1000,10000] [--output results.json]
+
+The results are printed as JSON, one entry per benchmark with throughput and latency percentiles.
+"""
+import argparse
+import asyncio
+import io
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from importlib import import_module
+from datetime import date, datetime, timedelta
+from typing import Awaitable, Callable
+
+repository_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+os.chdir(repository_root)
+sys.path.insert(0, repository_root)
+os.environ.setdefault('TELEGRAM_TOKEN', '0:benchmark')
+
+import src.database
+
+_temporary_directory = tempfile.TemporaryDirectory()
+src.database.sqlite_db_path = os.path.join(_temporary_directory.name, 'bodymass.sqlite')
+
+import logging
+from aiohttp import web
+from telebot import asyncio_helper, logger, types
+
+import main
+from benchmarks.latency import latency_summary
+import src.datautils as datautils
+import src.plotting
+from src.metrics import process_rss_bytes
+from src.plotcache import bump_data_version
+from src.userstats import day_number, update_user_stats
+
+benchmark_user_id = 1000
+
+
+class StubBot:
+    """Stands in for AsyncTeleBot. Records the calls and returns minimal messages."""
+
+    def __init__(self):
+        self.calls = 0
+        self.uploaded_bytes = 0
+        self._message_id = 0
+
+    def _sent_message(self, chat_id: int, photo: bool = False) -> types.Message:
+        self._message_id += 1
+        message_json = {'message_id': self._message_id, 'date': int(time.time()),
+                        'chat': {'id': chat_id, 'type': 'private'}}
+        if photo:
+            message_json['photo'] = [{'file_id': f'photo{self._message_id}',
+                                      'file_unique_id': f'photo{self._message_id}', 'width': 1, 'height': 1}]
+        return types.Message.de_json(message_json)
+
+    def _count(self, payload) -> None:
+        self.calls += 1
+        if isinstance(payload, bytes):
+            self.uploaded_bytes += len(payload)
+
+    async def send_message(self, chat_id, text, **kwargs):
+        self._count(None)
+        return self._sent_message(chat_id)
+
+    async def reply_to(self, message, text, **kwargs):
+        self._count(None)
+        return self._sent_message(message.chat.id)
+
+    async def send_photo(self, chat_id, photo, **kwargs):
+        self._count(photo)
+        return self._sent_message(chat_id, photo=True)
+
+    async def send_document(self, chat_id, document, **kwargs):
+        self._count(document)
+        return self._sent_message(chat_id)
+
+    async def get_file(self, file_id):
+        self._count(None)
+        return types.File.de_json({'file_id': file_id, 'file_unique_id': file_id, 'file_path': file_id})
+
+
+async def measure(name: str, iterations: int, operation: Callable[[], Awaitable],
+                  prepare: Callable[[], Awaitable] = None, **extra) -> dict:
+    latencies = []
+    for _ in range(iterations):
+        if prepare is not None:
+            await prepare()
+        start = time.perf_counter()
+        await operation()
+        latencies.append(time.perf_counter() - start)
+    result = latency_summary(name, latencies, **extra)
+    print(f"{name:<40} p50 {result['p50_ms']:9.2f} ms   p95 {result['p95_ms']:9.2f} ms   "
+          f"p99 {result['p99_ms']:9.2f} ms", file=sys.stderr)
+    return result
+
+
+def synthetic_records(rows: int) -> list[tuple[date, float]]:
+    first_day = date.today() - timedelta(days=rows - 1)
+    return [(first_day + timedelta(days=i), 80.0 - 0.01 * (i % 1000) + (i % 7) * 0.2) for i in range(rows)]
+
+
+def synthetic_csv(rows: int) -> bytes:
+    return ''.join(f"{day.strftime(datautils.date_format)},{mass:.1f}\r\n"
+                   for day, mass in synthetic_records(rows)).encode('utf-8')
+
+
+async def seed_user(user_id: int, rows: int) -> None:
+    await datautils.delete_user_data(user_id)
+    records = synthetic_records(rows)
+    async with src.database.transaction() as db:
+        await db.executemany(f"INSERT INTO {datautils.sqlite_db_users_mass} (user_id, day, body_mass) "
+                             f"VALUES (?, ?, ?)",
+                             [(user_id, day_number(day), mass) for day, mass in records])
+        await update_user_stats(db, user_id, {day_number(day): mass for day, mass in records}, {})
+    bump_data_version(user_id)
+
+
+def text_message(chat_id: int, text: str) -> types.Message:
+    return types.Message.de_json({'message_id': 1, 'date': int(time.time()), 'text': text,
+                                  'chat': {'id': chat_id, 'type': 'private'},
+                                  'from': {'id': chat_id, 'is_bot': False, 'first_name': 'Benchmark'}})
+
+
+def document_message(chat_id: int, file_id: str, file_size: int) -> types.Message:
+    return types.Message.de_json({'message_id': 1, 'date': int(time.time()),
+                                  'document': {'file_id': file_id, 'file_unique_id': file_id, 'file_size': file_size},
+                                  'chat': {'id': chat_id, 'type': 'private'},
+                                  'from': {'id': chat_id, 'is_bot': False, 'first_name': 'Benchmark'}})
+
+
+async def send(message: types.Message) -> None:
+    user_data = await main.get_conversation_data(message.chat.id)
+    await main.reply(message, user_data)
+
+
+async def benchmark_commands(iterations: int, rows: int, csv_files: dict[str, bytes]) -> list[dict]:
+    user_id = benchmark_user_id
+    results = []
+
+    async def reseed():
+        await seed_user(user_id, rows)
+
+    await reseed()
+
+    async def enter_weight():
+        await send(text_message(user_id, '/enter_weight'))
+        await send(text_message(user_id, '79.5'))
+
+    async def cold_plot_cache():
+        bump_data_version(user_id)
+
+    async def upload():
+        await send(text_message(user_id, '/upload'))
+        await send(document_message(user_id, 'upload.csv', len(csv_files['upload.csv'])))
+
+    async def erase():
+        await send(text_message(user_id, '/erase'))
+        await send(text_message(user_id, 'yes'))
+
+    results.append(await measure('/enter_weight + weight', iterations, enter_weight, rows=rows))
+    results.append(await measure('/plot', iterations, lambda: send(text_message(user_id, '/plot')), rows=rows))
+    results.append(await measure('/plot (cold cache)', iterations, lambda: send(text_message(user_id, '/plot')),
+                                 prepare=cold_plot_cache, rows=rows))
+    results.append(await measure('/plot_all', iterations, lambda: send(text_message(user_id, '/plot_all')),
+                                 rows=rows))
+    results.append(await measure('/plot_all (cold cache)', iterations,
+                                 lambda: send(text_message(user_id, '/plot_all')), prepare=cold_plot_cache, rows=rows))
+    results.append(await measure('/stats', iterations, lambda: send(text_message(user_id, '/stats')), rows=rows))
+    results.append(await measure('/download', iterations, lambda: send(text_message(user_id, '/download')), rows=rows))
+    results.append(await measure('/upload + document', iterations, upload, rows=rows))
+    results.append(await measure('/erase + yes', iterations, erase, prepare=reseed, rows=rows))
+    return results
+
+
+async def benchmark_data_paths(iterations: int, sizes: list[int], csv_base_url: str) -> list[dict]:
+    results = []
+    for rows in sizes:
+        user_id = benchmark_user_id + rows
+        await seed_user(user_id, rows)
+
+        async def cold_plot_cache():
+            bump_data_version(user_id)
+
+        for only_two_weeks in (True, False):
+            results.append(await measure(f'plot_user_data(two_weeks={only_two_weeks}) [{rows}]', iterations,
+                                         lambda: datautils.plot_user_data(user_id, only_two_weeks=only_two_weeks),
+                                         prepare=cold_plot_cache, rows=rows))
+
+        records = synthetic_records(rows)
+        days = [day_number(day) for day, _ in records]
+        masses = [mass for _, mass in records]
+
+        for renderer, module_name in src.plotting.plot_renderers.items():
+            renderer_module = import_module(module_name)
+            image = io.BytesIO()
+
+            async def draw():
+                image.seek(0)
+                image.truncate()
+                renderer_module.draw_plot_mass(days, masses, image)
+
+            result = await measure(f'draw_plot_mass({renderer}) [{rows}]', iterations, draw, rows=rows)
+            result['image_bytes'] = len(image.getvalue())
+            results.append(result)
+        results.append(await measure(f'user_data_to_csv [{rows}]', iterations,
+                                     lambda: datautils.user_data_to_csv(user_id), rows=rows))
+
+        async def clear_user():
+            await datautils.delete_user_data(user_id)
+
+        results.append(await measure(f'user_data_from_csv_url [{rows}]', iterations,
+                                     lambda: datautils.user_data_from_csv_url(user_id, f'{csv_base_url}/{rows}.csv',
+                                                                              1000),
+                                     prepare=clear_user, rows=rows))
+    return results
+
+
+startup_probe = """
+import json, sys, time
+start = time.perf_counter()
+import main
+import_seconds = time.perf_counter() - start
+from src.metrics import process_rss_bytes
+rss_after_import = process_rss_bytes()
+plotting_loaded_at_import = 'matplotlib' in sys.modules
+start = time.perf_counter()
+import src.plotting
+src.plotting.configure_plot_renderer(sys.argv[1])
+src.plotting.load_plot_renderer()
+print(json.dumps({'import_seconds': import_seconds,
+                  'rss_after_import_bytes': rss_after_import,
+                  'plotting_loaded_at_import': plotting_loaded_at_import,
+                  'plotting_import_seconds': time.perf_counter() - start,
+                  'rss_after_plotting_import_bytes': process_rss_bytes()}))
+"""
+
+
+def measure_startup(iterations: int, renderer: str) -> dict:
+    """Import the bot and then the plot renderer in fresh interpreters.
+
+    Reports the fastest imports and the memory of the last process.
+    """
+    environment = dict(os.environ, PYTHONPATH=repository_root)
+    runs = []
+    for _ in range(iterations):
+        output = subprocess.run([sys.executable, '-c', startup_probe, renderer], cwd=repository_root, env=environment,
+                                check=True, capture_output=True, text=True).stdout
+        runs.append(json.loads(output.splitlines()[-1]))
+    result = dict(runs[-1])
+    result['import_seconds'] = min(run['import_seconds'] for run in runs)
+    result['plotting_import_seconds'] = min(run['plotting_import_seconds'] for run in runs)
+    print(f"{'startup [' + renderer + ']':<40} import {result['import_seconds'] * 1000:9.2f} ms   "
+          f"rss {result['rss_after_import_bytes'] / 2 ** 20:7.1f} MB   "
+          f"+plotting {result['plotting_import_seconds'] * 1000:9.2f} ms "
+          f"{result['rss_after_plotting_import_bytes'] / 2 ** 20:7.1f} MB", file=sys.stderr)
+    return result
+
+
+async def start_file_server(csv_files: dict[str, bytes]) -> tuple[web.AppRunner, str]:
+    async def serve_file(request: web.Request) -> web.Response:
+        return web.Response(body=csv_files[request.match_info['name']])
+
+    app = web.Application()
+    app.router.add_get('/{name}', serve_file)
+    app.router.add_get('/file/bot{token}/{name}', serve_file)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, '127.0.0.1', 0)
+    await site.start()
+    port = runner.addresses[0][1]
+    return runner, f'http://127.0.0.1:{port}'
+
+
+async def run(iterations: int, sizes: list[int], command_rows: int) -> dict:
+    startup = {renderer: measure_startup(min(iterations, 5), renderer) for renderer in src.plotting.plot_renderers}
+    await datautils.init_database()
+    csv_files = {f'{rows}.csv': synthetic_csv(rows) for rows in sizes}
+    csv_files['upload.csv'] = synthetic_csv(command_rows)
+    runner, base_url = await start_file_server(csv_files)
+    asyncio_helper.FILE_URL = base_url + '/file/bot{0}/{1}'
+
+    stub_bot = StubBot()
+    main.bot = stub_bot
+    try:
+        results = await benchmark_commands(iterations, command_rows, csv_files)
+        results += await benchmark_data_paths(iterations, sizes, base_url)
+    finally:
+        await runner.cleanup()
+        main.shutdown_renderer()
+        await src.database.close_connection()
+
+    return {'timestamp': datetime.now().isoformat(timespec='seconds'),
+            'python': sys.version.split()[0],
+            'iterations': iterations,
+            'bot_calls': stub_bot.calls,
+            'uploaded_bytes': stub_bot.uploaded_bytes,
+            'startup': startup,
+            'rss_bytes': process_rss_bytes(),
+            'peak_rss_bytes': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+            'results': results}
+
+
+def parse_arguments() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--iterations', type=int, default=20)
+    parser.add_argument('--sizes', default='10,1000,10000', help='history sizes (rows) for the data path benchmarks')
+    parser.add_argument('--command-rows', type=int, default=365, help='history size of the user sending commands')
+    parser.add_argument('--output', help='write the JSON results to this file instead of stdout')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    arguments = parse_arguments()
+    logger.setLevel(logging.WARNING)
+    report = asyncio.run(run(arguments.iterations, [int(size) for size in arguments.sizes.split(',')],
+                             arguments.command_rows))
+    if arguments.output:
+        with open(arguments.output, 'w') as output:
+            json.dump(report, output, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
@@ -0,0 +1,179 @@
+"""A local stand-in for the Telegram Bot API.
+
+Answers the methods the bot uses: getMe, getUpdates (long polling of the updates queued with
+push_update()), the send methods, getFile and the download of the files added with add_file().
+Sends are held to Telegram-like rate limits: more than global_limit messages in a second, or more
+than chat_limit in a second in one chat, are rejected with 429 Too Many Requests and retry_after,
+like the real API does. Point the bot at it with TELEGRAM_API_URL=base_url, or in process with
+
+    asyncio_helper.API_URL = base_url + '/bot{0}/{1}'
+    asyncio_helper.FILE_URL = base_url + '/file/bot{0}/{1}'
+"""
+import asyncio
+import time
+from collections import defaultdict, deque
+from typing import Optional, Union
+from urllib.parse import parse_qsl
+
+from aiohttp import web
+
+upload_methods = ('sendPhoto', 'sendDocument')
+send_methods = ('sendMessage',) + upload_methods
+
+
+async def _read_form(request: web.Request) -> dict[str, Union[str, bytes]]:
+    """Parameters of a call. Telebot sends a form body, multipart with files, even with GET."""
+    form: dict[str, Union[str, bytes]] = dict(request.query)
+    if request.content_type == 'multipart/form-data':
+        reader = await request.multipart()
+        while (part := await reader.next()) is not None:
+            form[part.name] = bytes(await part.read()) if part.filename else await part.text()
+    elif request.can_read_body:
+        form.update(parse_qsl(await request.text()))
+    return form
+
+
+class FakeTelegramApi:
+    """Counts what the bot sends. stats has the accepted send calls by method, the 429 answers, the
+    getUpdates and getFile calls and the uploaded and downloaded bytes."""
+
+    def __init__(self, global_limit: int = 30, chat_limit: int = 1, retry_after: int = 1):
+        self.global_limit = global_limit
+        self.chat_limit = chat_limit
+        self.retry_after = retry_after
+        self.stats = {'calls': defaultdict(int), 'too_many_requests': 0, 'get_updates': 0, 'get_file': 0,
+                      'uploaded_bytes': 0, 'downloaded_bytes': 0}
+        self.sent_by_chat: dict[int, list[str]] = defaultdict(list)
+        self._sent: deque = deque()
+        self._sent_by_chat: dict[int, deque] = defaultdict(deque)
+        self._message_id = 0
+        self._update_id = 0
+        self._updates: deque = deque()
+        self._updates_added = asyncio.Event()
+        self._files: dict[str, bytes] = {}
+        self._reply_waiters: dict[int, asyncio.Event] = {}
+
+    def push_update(self, update: dict) -> int:
+        """Queue an update for getUpdates. Returns its update_id."""
+        self._update_id += 1
+        self._updates.append({'update_id': self._update_id, **update})
+        self._updates_added.set()
+        return self._update_id
+
+    def push_message(self, chat_id: int, text: Optional[str] = None, document: Optional[dict] = None) -> int:
+        """Queue a private message from the user chat_id. Returns its message_id."""
+        self._message_id += 1
+        message = {'message_id': self._message_id, 'date': int(time.time()),
+                   'chat': {'id': chat_id, 'type': 'private'},
+                   'from': {'id': chat_id, 'is_bot': False, 'first_name': f'user{chat_id}'}}
+        if text is not None:
+            message['text'] = text
+        if document is not None:
+            message['document'] = document
+        self.push_update({'message': message})
+        return self._message_id
+
+    def add_file(self, file_id: str, content: bytes) -> dict:
+        """Make content downloadable through getFile. Returns a document dict for push_message()."""
+        self._files[file_id] = content
+        return {'file_id': file_id, 'file_unique_id': file_id, 'file_name': f'{file_id}.csv',
+                'mime_type': 'text/csv', 'file_size': len(content)}
+
+    async def wait_for_replies(self, chat_id: int, count: int) -> None:
+        """Wait until the bot has sent count messages to the chat in total."""
+        while len(self.sent_by_chat[chat_id]) < count:
+            waiter = self._reply_waiters.setdefault(chat_id, asyncio.Event())
+            await waiter.wait()
+
+    async def _get_updates(self, form: dict) -> list[dict]:
+        self.stats['get_updates'] += 1
+        offset = int(form.get('offset') or 0)
+        while self._updates and self._updates[0]['update_id'] < offset:
+            self._updates.popleft()
+        if not self._updates:
+            self._updates_added.clear()
+            try:
+                await asyncio.wait_for(self._updates_added.wait(), float(form.get('timeout') or 0))
+            except asyncio.TimeoutError:
+                pass
+        limit = int(form.get('limit') or 100)
+        return [self._updates[i] for i in range(min(limit, len(self._updates)))]
+
+    def _rate_limited(self, chat_id: int, now: float) -> bool:
+        chat_sent = self._sent_by_chat[chat_id]
+        for sent in (self._sent, chat_sent):
+            while sent and sent[0] <= now - 1:
+                sent.popleft()
+        if len(self._sent) >= self.global_limit or len(chat_sent) >= self.chat_limit:
+            return True
+        self._sent.append(now)
+        chat_sent.append(now)
+        return False
+
+    def _message(self, chat_id: int, method: str) -> dict:
+        self._message_id += 1
+        message = {'message_id': self._message_id, 'date': int(time.time()),
+                   'chat': {'id': chat_id, 'type': 'private'}}
+        if method == 'sendPhoto':
+            message['photo'] = [{'file_id': f'photo{self._message_id}', 'file_unique_id': f'photo{self._message_id}',
+                                 'width': 2400, 'height': 1500}]
+        elif method == 'sendDocument':
+            message['document'] = {'file_id': f'document{self._message_id}',
+                                   'file_unique_id': f'document{self._message_id}'}
+        return message
+
+    async def handle(self, request: web.Request) -> web.Response:
+        method = request.match_info['method']
+        form = await _read_form(request)
+        if method == 'getMe':
+            return web.json_response({'ok': True, 'result': {'id': 1, 'is_bot': True, 'first_name': 'Body mass',
+                                                             'username': 'fake_bodymass_bot'}})
+        if method == 'getUpdates':
+            return web.json_response({'ok': True, 'result': await self._get_updates(form)})
+        if method == 'getFile':
+            self.stats['get_file'] += 1
+            file_id = form['file_id']
+            if file_id not in self._files:
+                return web.json_response({'ok': False, 'error_code': 400,
+                                          'description': 'Bad Request: invalid file_id'}, status=400)
+            return web.json_response({'ok': True, 'result': {'file_id': file_id, 'file_unique_id': file_id,
+                                                             'file_size': len(self._files[file_id]),
+                                                             'file_path': f'documents/{file_id}.csv'}})
+        if method not in send_methods:
+            return web.json_response({'ok': False, 'error_code': 404, 'description': 'Not Found'}, status=404)
+
+        chat_id = int(form['chat_id'])
+        if self._rate_limited(chat_id, time.monotonic()):
+            self.stats['too_many_requests'] += 1
+            return web.json_response({'ok': False, 'error_code': 429,
+                                      'description': f'Too Many Requests: retry after {self.retry_after}',
+                                      'parameters': {'retry_after': self.retry_after}}, status=429)
+
+        self.stats['calls'][method] += 1
+        for name in ('photo', 'document'):
+            if isinstance(form.get(name), bytes):
+                self.stats['uploaded_bytes'] += len(form[name])
+        self.sent_by_chat[chat_id].append(form.get('text') or form.get('caption') or method)
+        waiter = self._reply_waiters.pop(chat_id, None)
+        if waiter is not None:
+            waiter.set()
+        return web.json_response({'ok': True, 'result': self._message(chat_id, method)})
+
+    async def download(self, request: web.Request) -> web.Response:
+        file_id = request.match_info['path'].removeprefix('documents/').removesuffix('.csv')
+        if file_id not in self._files:
+            raise web.HTTPNotFound()
+        self.stats['downloaded_bytes'] += len(self._files[file_id])
+        return web.Response(body=self._files[file_id], content_type='text/csv')
+
+
+async def start_fake_telegram_api(api: FakeTelegramApi, host: str = '127.0.0.1',
+                                  port: int = 0) -> tuple[web.AppRunner, str]:
+    """Serve api on host:port (a free port by default). Returns the runner and the base url."""
+    app = web.Application(client_max_size=64 * 2 ** 20)
+    app.router.add_route('*', '/bot{token}/{method}', api.handle)
+    app.router.add_get('/file/bot{token}/{path:.+}', api.download)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner, f'http://{host}:{runner.addresses[0][1]}'
@@ -0,0 +1,114 @@
+"""Render and encode time and size of the plot images for every resolution and format.
+
+Draws plots of synthetic histories of --sizes records at every --dpi with the selected renderer and
+encodes each one in every format of src.plotting.plot_image_formats, reporting the median render
+time, encode time and size, and for 'auto' the format it picked under --budget bytes.
+
+Usage (from the repository root):
+
+    python -m benchmarks.image_profiles [--renderer pillow] [--dpi 300,160,100] [--sizes 14,365,3000]
+"""
+import argparse
+import importlib
+import io
+import json
+import os
+import statistics
+import sys
+import time
+from datetime import date, timedelta
+
+repository_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, repository_root)
+
+import src.plotting
+from src.userstats import day_number
+
+
+def synthetic_rows(rows: int) -> list[tuple[int, float]]:
+    first_day = day_number(date.today() - timedelta(days=rows - 1))
+    return [(first_day + i, 80.0 - 0.01 * (i % 1000) + (i % 7) * 0.2) for i in range(rows)]
+
+
+def load_renderer(name: str, dpi: int):
+    """Load the renderer at dpi, reloading it if it was loaded at another resolution."""
+    renderer = src.plotting._renderer
+    src.plotting._renderer = None
+    src.plotting.configure_plot_renderer(name)
+    src.plotting.configure_plot_image(dpi)
+    module = importlib.import_module(src.plotting.plot_renderers[name])
+    if renderer is not None:
+        module = importlib.reload(module)
+    src.plotting._renderer = module
+    return module
+
+
+def measure(rows: list[tuple[int, float]], image_format: str, budget: int, repeat: int) -> dict:
+    from src.imageencoding import encode_image, encode_auto
+
+    # Capture the drawn image once, then time the encodings on their own
+    captured = {}
+    encoding = sys.modules[src.plotting._renderer.__name__]
+    original = encoding.encode_plot_image
+
+    def capture(image, file_object):
+        captured['image'] = image.convert('RGB') if image.mode != 'RGB' else image
+        return original(image, file_object)
+
+    encoding.encode_plot_image = capture
+    render_seconds = []
+    try:
+        for _ in range(repeat):
+            start = time.perf_counter()
+            src.plotting.draw_user_plot(rows, io.BytesIO())
+            render_seconds.append(time.perf_counter() - start)
+    finally:
+        encoding.encode_plot_image = original
+
+    image = captured['image']
+    encode_seconds = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        if image_format == 'auto':
+            chosen, encoded = encode_auto(image, src.plotting.plot_auto_formats, src.plotting.plot_image_quality,
+                                          budget)
+        else:
+            chosen, encoded = image_format, encode_image(image, image_format, src.plotting.plot_image_quality)
+        encode_seconds.append(time.perf_counter() - start)
+    return {'width': image.width, 'height': image.height,
+            'draw_and_encode_ms': statistics.median(render_seconds) * 1000,
+            'encode_ms': statistics.median(encode_seconds) * 1000,
+            'bytes': len(encoded), 'format': chosen}
+
+
+def run(arguments: argparse.Namespace) -> list[dict]:
+    results = []
+    for dpi in (int(value) for value in arguments.dpi.split(',')):
+        load_renderer(arguments.renderer, dpi)
+        for size in (int(value) for value in arguments.sizes.split(',')):
+            rows = synthetic_rows(size)
+            for image_format in src.plotting.plot_image_formats:
+                src.plotting.configure_plot_image(dpi, image_format, arguments.quality, arguments.budget)
+                result = {'renderer': arguments.renderer, 'dpi': dpi, 'records': size, 'profile': image_format,
+                          **measure(rows, image_format, arguments.budget, arguments.repeat)}
+                print(f"{dpi:>4} dpi {size:>6} records {image_format:<8} -> {result['format']:<8}"
+                      f"{result['width']:>5}x{result['height']:<5} encode {result['encode_ms']:7.1f} ms "
+                      f"draw+encode {result['draw_and_encode_ms']:7.1f} ms {result['bytes'] / 1024:8.1f} KB",
+                      file=sys.stderr)
+                results.append(result)
+    return results
+
+
+def parse_arguments() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--renderer', default='pillow', choices=list(src.plotting.plot_renderers))
+    parser.add_argument('--dpi', default='300,160,100')
+    parser.add_argument('--sizes', default='14,365,3000', help='history sizes (records)')
+    parser.add_argument('--quality', type=int, default=src.plotting.plot_image_quality)
+    parser.add_argument('--budget', type=int, default=src.plotting.plot_image_budget, help="bytes, for 'auto'")
+    parser.add_argument('--repeat', type=int, default=5)
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    json.dump(run(parse_arguments()), sys.stdout, indent=2)
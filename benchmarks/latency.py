@@ -0,0 +1,17 @@
+"""Latency percentiles for the benchmark reports. Imports nothing from the bot, so any script can use it."""
+
+
+def latency_summary(name: str, latencies: list[float], **extra) -> dict:
+    latencies = sorted(latencies)
+
+    def percentile(fraction: float) -> float:
+        return latencies[min(len(latencies) - 1, int(round(fraction * (len(latencies) - 1))))]
+
+    total = sum(latencies)
+    return {'name': name, 'iterations': len(latencies),
+            'throughput_per_s': len(latencies) / total if total > 0 else None,
+            'mean_ms': total / len(latencies) * 1000,
+            'p50_ms': percentile(0.50) * 1000,
+            'p95_ms': percentile(0.95) * 1000,
+            'p99_ms': percentile(0.99) * 1000,
+            **extra}
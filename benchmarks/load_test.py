@@ -0,0 +1,276 @@
+"""End-to-end load test of a bot process against the fake Bot API.
+
+Starts benchmarks/fake_telegram_api.py and a real bot (python main.py in a scratch directory, long
+polling the fake through TELEGRAM_API_URL), then simulates --users users arriving over --ramp-up
+seconds. Every user opens the menu and runs --sessions sessions picked at random, with think time
+in between:
+
+    weigh-in  /enter_weight, then the weight; answered with the two-week plot
+    plot      /plot or /plot_all; answered with a plot
+    upload    /upload, then a csv document; the bot calls getFile, downloads it and sends a plot
+    download  /download; answered with the csv document
+
+Reports the end-to-end throughput, the latency of every step (from the update being queued to the
+bot's last reply), the API calls, the bytes uploaded and downloaded and the peak resident memory
+of the bot's processes, compared with the 200 MB limit of docker-compose.yml.
+
+Usage (from the repository root):
+
+    python -m benchmarks.load_test [--users 1000] [--sessions 2] [--workers 0]
+                                   [--send-rate 30] [--global-limit 30]
+
+Telegram allows about 30 messages a second, which caps the throughput; --send-rate 1000
+--global-limit 1000 lifts the limit on both sides to find the bot's own ceiling. The bot reads
+the rest of its settings (PLOT_RENDERER, ...) from the environment as usual.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import date, timedelta
+from typing import Optional
+
+repository_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, repository_root)
+os.environ.setdefault('TELEGRAM_TOKEN', '0:benchmark')
+
+from telebot import logger
+
+from benchmarks.latency import latency_summary
+from benchmarks.fake_telegram_api import FakeTelegramApi, start_fake_telegram_api
+
+memory_limit_bytes = 200 * 2 ** 20  # docker-compose.yml
+session_weights = {'weigh_in': 0.6, 'plot': 0.2, 'upload': 0.1, 'download': 0.1}
+upload_rows = (30, 365)
+csv_date_format = '%Y/%m/%d'
+
+
+def process_tree(pid: int) -> list[int]:
+    """pid and all its descendants."""
+    pids = [pid]
+    for parent in pids:
+        try:
+            with open(f'/proc/{parent}/task/{parent}/children') as children:
+                pids.extend(int(child) for child in children.read().split())
+        except OSError:
+            pass
+    return pids
+
+
+def memory_status(pid: int) -> dict[str, int]:
+    """VmRSS and VmHWM (peak) of a process, bytes."""
+    status = {}
+    try:
+        with open(f'/proc/{pid}/status') as file:
+            for line in file:
+                name, _, value = line.partition(':')
+                if name in ('VmRSS', 'VmHWM'):
+                    status[name] = int(value.split()[0]) * 1024
+    except OSError:
+        pass
+    return status
+
+
+class MemorySampler:
+    """Samples the total resident memory of a process tree, which is what a container limit applies to."""
+
+    def __init__(self, pid: int, interval: float = 0.2):
+        self.pid = pid
+        self.interval = interval
+        self.peak_total_rss = 0
+        self.peak_by_process: dict[int, int] = {}
+
+    def sample(self) -> None:
+        total = 0
+        for pid in process_tree(self.pid):
+            status = memory_status(pid)
+            total += status.get('VmRSS', 0)
+            if 'VmHWM' in status:
+                self.peak_by_process[pid] = max(self.peak_by_process.get(pid, 0), status['VmHWM'])
+        self.peak_total_rss = max(self.peak_total_rss, total)
+
+    async def run(self) -> None:
+        while True:
+            self.sample()
+            await asyncio.sleep(self.interval)
+
+
+def upload_csv(rows: int) -> bytes:
+    first_day = date.today() - timedelta(days=rows)
+    start_mass = random.uniform(60, 100)
+    trend = random.gauss(0, 0.03)
+    return ''.join(f"{(first_day + timedelta(days=i)).strftime(csv_date_format)},"
+                   f"{start_mass + trend * i + random.gauss(0, 0.4):.1f}\r\n" for i in range(rows)).encode('utf-8')
+
+
+class SimulatedUsers:
+    def __init__(self, api: FakeTelegramApi, step_timeout: float, think_time: float):
+        self.api = api
+        self.step_timeout = step_timeout
+        self.think_time = think_time
+        self.latencies: dict[str, list[float]] = {}
+        self.timeouts: dict[str, int] = {}
+        self.sessions: dict[str, int] = {}
+
+    async def step(self, name: str, chat_id: int, text: Optional[str] = None,
+                   document: Optional[dict] = None) -> None:
+        """Send a message and wait for one reply."""
+        expected = len(self.api.sent_by_chat[chat_id]) + 1
+        start = time.perf_counter()
+        self.api.push_message(chat_id, text, document)
+        try:
+            await asyncio.wait_for(self.api.wait_for_replies(chat_id, expected), self.step_timeout)
+        except asyncio.TimeoutError:
+            self.timeouts[name] = self.timeouts.get(name, 0) + 1
+        else:
+            self.latencies.setdefault(name, []).append(time.perf_counter() - start)
+
+    async def think(self) -> None:
+        await asyncio.sleep(random.expovariate(1 / self.think_time) if self.think_time > 0 else 0)
+
+    async def session(self, kind: str, chat_id: int, number: int) -> None:
+        self.sessions[kind] = self.sessions.get(kind, 0) + 1
+        if kind == 'weigh_in':
+            await self.step('enter_weight', chat_id, '/enter_weight')
+            await self.think()
+            await self.step('weight', chat_id, f'{random.uniform(55, 110):.1f}')
+        elif kind == 'plot':
+            command = random.choice(['/plot', '/plot_all'])
+            await self.step(command.lstrip('/'), chat_id, command)
+        elif kind == 'upload':
+            await self.step('upload', chat_id, '/upload')
+            await self.think()
+            document = self.api.add_file(f'csv{chat_id}n{number}', upload_csv(random.randint(*upload_rows)))
+            await self.step('csv_document', chat_id, document=document)
+        else:
+            await self.step('download', chat_id, '/download')
+
+    async def user(self, chat_id: int, sessions: int, delay: float) -> None:
+        await asyncio.sleep(delay)
+        await self.step('start', chat_id, '/start')
+        kinds = random.choices(list(session_weights), weights=list(session_weights.values()), k=sessions)
+        for number, kind in enumerate(kinds):
+            await self.think()
+            await self.session(kind, chat_id, number)
+
+
+async def wait_until_ready(api: FakeTelegramApi, bot: subprocess.Popen, scratch: str, workers: int,
+                           timeout: float = 60) -> None:
+    """Wait for the bot to poll and, in multi-process mode, for every worker to start."""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if bot.poll() is not None:
+            raise RuntimeError(f"The bot exited with code {bot.returncode}, see {scratch}/logs")
+        ready_workers = 0
+        for index in range(workers):
+            try:
+                with open(os.path.join(scratch, 'logs', f'log.worker{index}')) as log:
+                    ready_workers += 'is ready' in log.read()
+            except OSError:
+                pass
+        if api.stats['get_updates'] > 0 and ready_workers == workers:
+            return
+        await asyncio.sleep(0.1)
+    raise RuntimeError(f"The bot did not start in {timeout:.0f} s")
+
+
+async def stop_bot(bot: subprocess.Popen, timeout: float = 30) -> int:
+    bot.send_signal(signal.SIGINT)
+    deadline = time.monotonic() + timeout
+    while bot.poll() is None and time.monotonic() < deadline:
+        await asyncio.sleep(0.1)
+    if bot.poll() is None:
+        bot.kill()
+    return bot.wait()
+
+
+async def run(arguments: argparse.Namespace) -> dict:
+    random.seed(arguments.seed)
+    api = FakeTelegramApi(arguments.global_limit, arguments.chat_limit)
+    runner, base_url = await start_fake_telegram_api(api)
+
+    scratch = tempfile.mkdtemp(prefix='bodymass-load-')
+    os.makedirs(os.path.join(scratch, 'data'))
+    os.makedirs(os.path.join(scratch, 'logs'))
+    shutil.copy(os.path.join(repository_root, 'data', 'bodymass.sql'), os.path.join(scratch, 'data'))
+    environment = dict(os.environ, TELEGRAM_API_URL=base_url, BOT_MODE='polling', WORKERS=str(arguments.workers),
+                       SEND_RATE=str(arguments.send_rate), METRICS_PORT='0', BACKUP_INTERVAL='0',
+                       ANALYTICS_INTERVAL='0')
+    bot = subprocess.Popen([sys.executable, os.path.join(repository_root, 'main.py')], cwd=scratch, env=environment,
+                           stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    sampler = MemorySampler(bot.pid)
+    sampling = asyncio.create_task(sampler.run())
+    users = SimulatedUsers(api, arguments.step_timeout, arguments.think_time)
+    try:
+        start = time.perf_counter()
+        await wait_until_ready(api, bot, scratch, arguments.workers)
+        startup_seconds = time.perf_counter() - start
+        idle_rss = sum(memory_status(pid).get('VmRSS', 0) for pid in process_tree(bot.pid))
+
+        start = time.perf_counter()
+        await asyncio.gather(*[users.user(chat_id, arguments.sessions, random.uniform(0, arguments.ramp_up))
+                               for chat_id in range(1, arguments.users + 1)])
+        duration = time.perf_counter() - start
+        sampler.sample()
+    finally:
+        exit_code = await stop_bot(bot)
+        sampling.cancel()
+        await runner.cleanup()
+        if not arguments.keep_scratch:
+            shutil.rmtree(scratch, ignore_errors=True)
+
+    steps = sum(len(latencies) for latencies in users.latencies.values())
+    all_latencies = [latency for latencies in users.latencies.values() for latency in latencies]
+    return {'users': arguments.users,
+            'workers': arguments.workers,
+            'send_rate': arguments.send_rate,
+            'sessions': users.sessions,
+            'startup_seconds': startup_seconds,
+            'duration_seconds': duration,
+            'steps': steps,
+            'steps_per_s': steps / duration,
+            'timeouts': users.timeouts,
+            'latency': latency_summary('all', all_latencies) if all_latencies else None,
+            'latency_by_step': {name: latency_summary(name, latencies)
+                                for name, latencies in sorted(users.latencies.items())},
+            'api_calls': dict(api.stats['calls'], getUpdates=api.stats['get_updates'],
+                              getFile=api.stats['get_file']),
+            'too_many_requests': api.stats['too_many_requests'],
+            'uploaded_bytes': api.stats['uploaded_bytes'],
+            'downloaded_bytes': api.stats['downloaded_bytes'],
+            'idle_rss_bytes': idle_rss,
+            'peak_rss_bytes': sampler.peak_total_rss,
+            'peak_rss_by_process_bytes': sorted(sampler.peak_by_process.values(), reverse=True),
+            'memory_limit_bytes': memory_limit_bytes,
+            'within_memory_limit': sampler.peak_total_rss <= memory_limit_bytes,
+            'bot_exit_code': exit_code,
+            'scratch_directory': scratch if arguments.keep_scratch else None}
+
+
+def parse_arguments() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--sessions', type=int, default=2, help='sessions per user after opening the menu')
+    parser.add_argument('--ramp-up', type=float, default=30, help='seconds over which the users arrive')
+    parser.add_argument('--think-time', type=float, default=2, help='mean seconds between the steps of a user')
+    parser.add_argument('--step-timeout', type=float, default=120, help='seconds to wait for a reply')
+    parser.add_argument('--workers', type=int, default=0, help='WORKERS of the bot')
+    parser.add_argument('--send-rate', type=float, default=30, help='SEND_RATE of the bot')
+    parser.add_argument('--global-limit', type=int, default=30, help='messages a second the fake API accepts')
+    parser.add_argument('--chat-limit', type=int, default=1, help='messages a second in a chat the fake API accepts')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--keep-scratch', action='store_true', help="keep the bot's database and logs")
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    logger.setLevel(logging.ERROR)
+    json.dump(asyncio.run(run(parse_arguments())), sys.stdout, indent=2)
@@ -0,0 +1,107 @@
+"""Burst of outgoing messages against the fake Bot API.
+
+Every chat sends a few text replies and a photo at once, through the outbound queue of main.py
+or, with --no-queue, straight through AsyncTeleBot. The fake API answers 429 Too Many Requests
+above its rate limits. Reports how many messages were delivered, the 429 answers and retries,
+the latency of text and photo sends and whether every chat got its messages in order.
+
+Usage (from the repository root):
+
+    python -m benchmarks.send_burst [--chats 100] [--texts 3] [--photos 1] [--no-queue]
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import sys
+import time
+
+repository_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, repository_root)
+os.environ.setdefault('TELEGRAM_TOKEN', '0:benchmark')
+
+from telebot import asyncio_helper, logger
+from telebot.async_telebot import AsyncTeleBot
+
+import main
+import src.config
+from benchmarks.latency import latency_summary
+from benchmarks.fake_telegram_api import FakeTelegramApi, start_fake_telegram_api
+from src.outbound import OutboundQueue, telegram_retries_total
+
+photo = b'\x89PNG\r\n\x1a\n' + bytes(64 * 1024)
+
+
+async def send_chat_burst(bot: AsyncTeleBot, chat_id: int, texts: int, photos: int,
+                          latencies: dict[str, list[float]], failures: list[str]) -> None:
+    async def send(kind: str, index: int) -> None:
+        start = time.perf_counter()
+        try:
+            if kind == 'text':
+                await bot.send_message(chat_id, f'text {index}')
+            else:
+                await bot.send_photo(chat_id, photo, caption=f'photo {index}')
+        except Exception as exception:
+            failures.append(f'{type(exception).__name__}: {exception}')
+        else:
+            latencies[kind].append(time.perf_counter() - start)
+
+    await asyncio.gather(*[send('text', i) for i in range(texts)], *[send('photo', i) for i in range(photos)])
+
+
+async def run(arguments: argparse.Namespace) -> dict:
+    api = FakeTelegramApi(arguments.global_limit, arguments.chat_limit)
+    runner, base_url = await start_fake_telegram_api(api)
+    asyncio_helper.API_URL = base_url + '/bot{0}/{1}'
+
+    if arguments.no_queue:
+        bot = AsyncTeleBot(src.config.TELEGRAM_TOKEN)
+        outbound_queue = None
+    else:
+        outbound_queue = OutboundQueue(src.config.SEND_RATE, src.config.SEND_CHAT_RATE, src.config.SEND_CHAT_BURST,
+                                       src.config.SEND_QUEUE_SIZE, src.config.SEND_MAX_RETRIES)
+        bot = main.QueuedTeleBot(src.config.TELEGRAM_TOKEN, outbound_queue)
+
+    latencies = {'text': [], 'photo': []}
+    failures = []
+    start = time.perf_counter()
+    try:
+        await asyncio.gather(*[send_chat_burst(bot, chat_id, arguments.texts, arguments.photos, latencies, failures)
+                               for chat_id in range(1, arguments.chats + 1)])
+        duration = time.perf_counter() - start
+    finally:
+        if outbound_queue is not None:
+            await outbound_queue.close(0)
+        await bot.close_session()
+        await runner.cleanup()
+
+    expected_order = [f'text {i}' for i in range(arguments.texts)] + [f'photo {i}' for i in range(arguments.photos)]
+    return {'queue': not arguments.no_queue,
+            'chats': arguments.chats,
+            'messages': arguments.chats * (arguments.texts + arguments.photos),
+            'delivered': sum(api.stats['calls'].values()),
+            'failed': len(failures),
+            'too_many_requests': api.stats['too_many_requests'],
+            'retries': telegram_retries_total.value(),
+            'in_order_chats': sum(sent == expected_order for sent in api.sent_by_chat.values()),
+            'duration_seconds': duration,
+            'uploaded_bytes': api.stats['uploaded_bytes'],
+            'latency': {kind: latency_summary(kind, values) for kind, values in latencies.items() if values},
+            'errors': sorted(set(failures))[:5]}
+
+
+def parse_arguments() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--chats', type=int, default=100)
+    parser.add_argument('--texts', type=int, default=3, help='text messages per chat')
+    parser.add_argument('--photos', type=int, default=1, help='photos per chat')
+    parser.add_argument('--global-limit', type=int, default=30, help='messages a second the fake API accepts')
+    parser.add_argument('--chat-limit', type=int, default=1, help='messages a second in a chat the fake API accepts')
+    parser.add_argument('--no-queue', action='store_true', help='send straight through AsyncTeleBot')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    logger.setLevel(logging.ERROR)
+    json.dump(asyncio.run(run(parse_arguments())), sys.stdout, indent=2)
@@ -14,26 +14,66 @@ CREATE TABLE IF NOT EXISTS users_conversation (
 
 
 -- Table: users_mass
+-- day is the number of days since 1970-01-01
 CREATE TABLE IF NOT EXISTS users_mass (
-    record_id INTEGER,
-    user_id   TEXT (32),
-    date      DATE      NOT NULL,
-    body_mass REAL,
+    user_id   INTEGER NOT NULL,
+    day       INTEGER NOT NULL,
+    body_mass REAL    NOT NULL,
     PRIMARY KEY (
-        record_id AUTOINCREMENT
-    ),
-    CONSTRAINT user_date_constraint UNIQUE (
         user_id,
-        date
+        day
     )
-    ON CONFLICT REPLACE
+)
+WITHOUT ROWID;
+
+
+-- Table: users_mass_stats
+CREATE TABLE IF NOT EXISTS users_mass_stats (
+    user_id   INTEGER   PRIMARY KEY,
+    n         INTEGER   NOT NULL,
+    sum_x     INTEGER   NOT NULL,
+    sum_y     REAL      NOT NULL,
+    sum_xy    REAL      NOT NULL,
+    sum_xx    INTEGER   NOT NULL,
+    first_day INTEGER   NOT NULL,
+    last_day  INTEGER   NOT NULL
+);
+
+
+-- Table: users_mass_summary
+-- Recomputed for all the users by src/analytics.py. Slopes are kg/day, NULL when they cannot be fitted;
+-- updated is the unix time of the update
+CREATE TABLE IF NOT EXISTS users_mass_summary (
+    user_id      INTEGER PRIMARY KEY,
+    n            INTEGER NOT NULL,
+    first_day    INTEGER NOT NULL,
+    last_day     INTEGER NOT NULL,
+    mean_mass    REAL    NOT NULL,
+    slope        REAL,
+    recent_slope REAL,
+    ewma_mass    REAL    NOT NULL,
+    last_mass    REAL    NOT NULL,
+    outliers     INTEGER NOT NULL,
+    last_outlier INTEGER NOT NULL,
+    updated      INTEGER NOT NULL
+);
+
+
+-- Table: users_reminder
+-- minute is the minute of the day of the daily reminder, next_fire its next unix time
+CREATE TABLE IF NOT EXISTS users_reminder (
+    user_id   INTEGER PRIMARY KEY,
+    minute    INTEGER NOT NULL,
+    next_fire INTEGER NOT NULL
 );
 
 
--- Index: user_id_idx
-CREATE INDEX IF NOT EXISTS user_id_idx ON users_mass (
-    user_id
+-- Table: schema_version
+CREATE TABLE IF NOT EXISTS schema_version (
+    version INTEGER NOT NULL
 );
+-- The version of the tables above (src/migration.py current_schema_version), committed with them
+INSERT INTO schema_version (version) SELECT 2 WHERE NOT EXISTS (SELECT 1 FROM schema_version);
 
 
 COMMIT TRANSACTION;
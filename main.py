@@ -1,38 +1,113 @@
 import asyncio
 import logging.handlers
+import multiprocessing
 import os
+import queue
+import signal
 import sys
-from datetime import datetime
-from typing import Optional
+import time
+from contextlib import asynccontextmanager
+from datetime import date, datetime, timedelta
+from typing import AsyncIterator, Awaitable, Callable, Optional, Union
 
 from telebot.async_telebot import AsyncTeleBot
 from telebot import types
 from telebot import logger
+from telebot import asyncio_helper
 
 from src.glossary import *
 from src.conversationdata import get_conversation_data, write_conversation_data, ConversationState
+from src.conversationdata import start_conversation_flusher, stop_conversation_flusher
 from src.datautils import plot_user_data, add_record_now, date_format, user_data_to_csv, user_data_from_csv_url, delete_user_data
-from src.datautils import CSVParsingError
+from src.datautils import csv_filename_template, remember_plot_file_id, init_database, preload_renderer
+from src.datautils import CSVParsingError, user_window_stats
+from src.database import close_connection
+from src.rendering import configure_renderer, shutdown_renderer
+from src.plotting import configure_plot_renderer, configure_plot_image
+from src.plotcache import configure_plot_cache
+from src.webhook import run_webhook
+from src.workers import WorkerPool
+from src.dispatcher import ChatDispatcher
+from src.outbound import OutboundQueue, background_priority, text_priority, upload_priority
+from src.reminders import start_reminders, stop_reminders, set_reminder, cancel_reminder, get_reminder
+from src.reminders import parse_reminder_time, format_reminder_time
+from src.backup import run_backups_periodically
+from src.analytics import run_analytics_periodically
+from src.metrics import Gauge, command_seconds, csv_parsing_errors_total, errors_total, timed
+from src.metrics import start_metrics_server, log_metrics_periodically
 import src.config
 
 
-bot = AsyncTeleBot(src.config.TELEGRAM_TOKEN)
+class QueuedTeleBot(AsyncTeleBot):
+    """Sends every outgoing message through the outbound queue. reply_to() goes through send_message()."""
 
-logger.setLevel(logging.DEBUG)
+    def __init__(self, token: str, outbound_queue: OutboundQueue):
+        super().__init__(token)
+        self.outbound_queue = outbound_queue
+
+    async def send_message(self, chat_id, *args, priority: int = text_priority, **kwargs):
+        return await self.outbound_queue.send(chat_id, lambda: super(QueuedTeleBot, self).send_message(
+            chat_id, *args, **kwargs), priority)
+
+    async def send_photo(self, chat_id, *args, **kwargs):
+        return await self.outbound_queue.send(chat_id, lambda: super(QueuedTeleBot, self).send_photo(
+            chat_id, *args, **kwargs), upload_priority)
+
+    async def send_document(self, chat_id, *args, **kwargs):
+        return await self.outbound_queue.send(chat_id, lambda: super(QueuedTeleBot, self).send_document(
+            chat_id, *args, **kwargs), upload_priority)
+
+
+outbound_queue = OutboundQueue(rate=src.config.SEND_RATE,
+                               chat_rate=src.config.SEND_CHAT_RATE,
+                               chat_burst=src.config.SEND_CHAT_BURST,
+                               max_pending=src.config.SEND_QUEUE_SIZE,
+                               max_retries=src.config.SEND_MAX_RETRIES)
+bot = QueuedTeleBot(src.config.TELEGRAM_TOKEN, outbound_queue)
+
+fh: Optional[logging.Handler] = None
+
+
+def log_to_file(path: str) -> None:
+    """Log to the given file instead of the current one. Worker processes log to files of their own,
+    which rotate independently."""
+    global fh
+    if fh is not None:
+        logger.removeHandler(fh)
+        fh.close()
+    fh = logging.handlers.TimedRotatingFileHandler(path, when='midnight', delay=True)
+    fh.setFormatter(logging.Formatter('%(asctime)s %(levelname)-8s [%(filename)s:%(lineno)d] %(message)s'))
+    logger.addHandler(fh)
+
+
+logger.setLevel(src.config.LOG_LEVEL)
 os.makedirs('logs', exist_ok=True)
-fh = logging.handlers.TimedRotatingFileHandler('logs/log', when='midnight')
-fh.setFormatter(logging.Formatter('%(asctime)s %(levelname)-8s [%(filename)s:%(lineno)d] %(message)s'))
-logger.addHandler(fh)
+log_to_file('logs/log')
+
+dispatcher = ChatDispatcher(max_handlers=src.config.MAX_CONCURRENT_HANDLERS,
+                            max_heavy_handlers=src.config.MAX_CONCURRENT_HEAVY_HANDLERS,
+                            max_light_handlers=src.config.MAX_CONCURRENT_LIGHT_HANDLERS)
+handlers_in_flight = Gauge('bodymass_handlers_in_flight', 'Handlers holding a slot right now.',
+                           lambda: dispatcher.in_flight)
+outbound_queued = Gauge('bodymass_outbound_queued', 'Outgoing messages waiting for the rate limits.',
+                        lambda: outbound_queue.queued)
 
 
 @bot.message_handler(content_types=['document'])
 @bot.message_handler(func=lambda _: True)
 async def handler(message):
     logger.info("Message from %s: %s", message.chat.id, message.text)
+    command = 'unknown'
     try:
-        user_data = await get_conversation_data(message.chat.id)
-        await reply(message, user_data)
+        async with dispatcher.chat(message.chat.id):
+            user_data = await get_conversation_data(message.chat.id)
+            conversation_state = user_data['conversation_state']
+            command = command_label(message, conversation_state)
+            async with dispatcher.slot(heavy=is_heavy_request(message, conversation_state)):
+                with timed(command_seconds, command=command):
+                    await reply(message, user_data)
     except Exception as exception:
+        errors_total.inc(command=command)
         exc_type, exc_obj, exc_tb = sys.exc_info()
         fname = os.path.split(exc_tb.tb_frame.f_code.co_filename)[1]
         logger.critical("Unexpected error [%s:%d]: %s: %s" % (fname, exc_tb.tb_lineno, type(exception).__name__,
@@ -48,9 +123,43 @@ def reply_markup(buttons):
 
 DEFAULT_MARKUP = reply_markup([ENTER_WEIGHT_BUTTON, SHOW_MENU_BUTTON])
 
+HEAVY_COMMANDS = ['/plot', '/plot_all', '/download']
+LIGHT_COMMANDS = ['/info', '/stats', '/upload', '/erase', '/remind'] + ENTER_WEIGHT_COMMANDS + SHOW_MENU_COMMANDS
+HEAVY_CONVERSATION_STATES = [ConversationState.awaiting_body_weight,
+                             ConversationState.awaiting_erase_confirmation,
+                             ConversationState.awaiting_csv_table]
+
+
+def is_heavy_request(message: types.Message, conversation_state: str) -> bool:
+    """Whether the reply will render a plot or process a file. Mirrors the dispatch in reply()."""
+    message_text = message.text.strip() if message.text is not None else ''
+    if message_text in HEAVY_COMMANDS:
+        return True
+    if message_text in LIGHT_COMMANDS:
+        return False
+    return conversation_state in HEAVY_CONVERSATION_STATES or message.document is not None
+
+
+CONVERSATION_STATE_LABELS = {ConversationState.awaiting_body_weight: 'body_weight',
+                             ConversationState.awaiting_erase_confirmation: 'erase_confirmation',
+                             ConversationState.awaiting_csv_table: 'csv_table',
+                             ConversationState.awaiting_reminder_time: 'reminder_time'}
+
+
+def command_label(message: types.Message, conversation_state: str) -> str:
+    """Metrics label of the request. Free text is never used as a label, so the set of labels stays small."""
+    message_text = message.text.strip() if message.text is not None else ''
+    if message_text in HEAVY_COMMANDS or message_text in LIGHT_COMMANDS:
+        return message_text
+    if conversation_state in CONVERSATION_STATE_LABELS:
+        return CONVERSATION_STATE_LABELS[conversation_state]
+    if message.document is not None:
+        return 'document'
+    return 'other'
+
 
 async def reply(message: types.Message, user_data: dict):
-    logger.debug("User data:"+str(user_data))
+    logger.debug("User data: %s", user_data)
 
     conversation_state = user_data['conversation_state']
 
@@ -67,18 +176,24 @@ async def reply(message: types.Message, user_data: dict):
             await reply_plot(message, user_data)
         elif message_text == '/plot_all':
             await reply_plot_all(message, user_data)
+        elif message_text == '/stats':
+            await reply_stats(message, user_data)
         elif message_text == '/download':
             await reply_download(message, user_data)
         elif message_text == '/upload':
             await reply_upload(message, user_data)
         elif message_text == '/erase':
             await reply_erase(message, user_data)
+        elif message_text == '/remind':
+            await reply_remind(message, user_data)
         elif conversation_state == ConversationState.awaiting_body_weight:
             await reply_body_weight(message, user_data)
         elif conversation_state == ConversationState.awaiting_erase_confirmation:
             await reply_erase_confirmation(message, user_data)
         elif conversation_state == ConversationState.awaiting_csv_table:
             await reply_csv_table(message, user_data)
+        elif conversation_state == ConversationState.awaiting_reminder_time:
+            await reply_reminder_time(message, user_data)
         elif message.document is not None:
             await reply_unexpected_document(message, user_data)
         elif conversation_state == ConversationState.init:
@@ -165,6 +280,16 @@ def text_deficit_maintenance_surplus(speed_week_kg: Optional[float], mean_mass:
     return text
 
 
+async def send_plot(message: types.Message, caption: str, photo: Union[bytes, str], only_two_weeks: bool):
+    sent_message = await bot.send_photo(message.chat.id, caption=caption,
+                                        photo=photo,
+                                        reply_markup=DEFAULT_MARKUP,
+                                        reply_to_message_id=message.id,
+                                        parse_mode='HTML')
+    if sent_message.photo:
+        remember_plot_file_id(message.chat.id, only_two_weeks, photo, sent_message.photo[-1].file_id)
+
+
 async def reply_body_weight(message: types.Message, user_data):
     try:
         body_weight = float(message.text.strip())
@@ -175,65 +300,63 @@ async def reply_body_weight(message: types.Message, user_data):
         return
 
     await add_record_now(message.chat.id, body_weight)
-    img_path, speed_week_kg, mean_mass = await plot_user_data(message.chat.id, only_two_weeks=True)
-    with open(img_path, 'rb') as img_file_object:
-        text = f"Successfully added a new entry:\n<b>{datetime.now().strftime(date_format)} - {body_weight} kg</b>\n"
-        text += text_deficit_maintenance_surplus(speed_week_kg, mean_mass)
+    image, speed_week_kg, mean_mass = await plot_user_data(message.chat.id, only_two_weeks=True)
+    text = f"Successfully added a new entry:\n<b>{datetime.now().strftime(date_format)} - {body_weight} kg</b>\n"
+    text += text_deficit_maintenance_surplus(speed_week_kg, mean_mass)
 
-        await bot.send_photo(message.chat.id, caption=text,
-                             photo=img_file_object,
-                             reply_markup=DEFAULT_MARKUP,
-                             reply_to_message_id=message.id,
-                             parse_mode='HTML')
+    await send_plot(message, text, image, only_two_weeks=True)
 
-    try:
-        os.remove(img_path)
-    except OSError:
-        pass
     user_data['conversation_state'] = ConversationState.init
 
 
 async def reply_plot(message: types.Message, user_data: dict):
-    img_path, speed_week_kg, mean_mass = await plot_user_data(message.chat.id, only_two_weeks=True)
-    with open(img_path, 'rb') as img_file_object:
-        text = "Here's a plot of your progress over the last two weeks.\n"
-        text += text_deficit_maintenance_surplus(speed_week_kg, mean_mass)
-
-        await bot.send_photo(message.chat.id, caption=text,
-                             photo=img_file_object,
-                             reply_markup=DEFAULT_MARKUP,
-                             reply_to_message_id=message.id,
-                             parse_mode='HTML')
-    try:
-        os.remove(img_path)
-    except OSError:
-        pass
+    image, speed_week_kg, mean_mass = await plot_user_data(message.chat.id, only_two_weeks=True)
+    text = "Here's a plot of your progress over the last two weeks.\n"
+    text += text_deficit_maintenance_surplus(speed_week_kg, mean_mass)
+
+    await send_plot(message, text, image, only_two_weeks=True)
     user_data['conversation_state'] = ConversationState.init
 
 
 async def reply_plot_all(message: types.Message, user_data: dict):
-    img_path, speed_week_kg, mean_mass = await plot_user_data(message.chat.id, only_two_weeks=False)
-    with open(img_path, 'rb') as img_file_object:
-        text = "Here's a plot of your overall progress.\n"
-        text += text_deficit_maintenance_surplus(speed_week_kg, mean_mass)
-
-        await bot.send_photo(message.chat.id, caption=text,
-                             photo=img_file_object,
-                             reply_markup=DEFAULT_MARKUP,
-                             reply_to_message_id=message.id,
-                             parse_mode='HTML')
-    try:
-        os.remove(img_path)
-    except OSError:
-        pass
+    image, speed_week_kg, mean_mass = await plot_user_data(message.chat.id, only_two_weeks=False)
+    text = "Here's a plot of your overall progress.\n"
+    text += text_deficit_maintenance_surplus(speed_week_kg, mean_mass)
 
+    await send_plot(message, text, image, only_two_weeks=False)
+    user_data['conversation_state'] = ConversationState.init
+
+
+async def reply_stats(message: types.Message, user_data: dict):
+    text = ""
+    shown_n = None
+    for stats in await user_window_stats(message.chat.id):
+        # A longer window with no older records would repeat the previous one
+        if stats is None or stats.n == shown_n:
+            continue
+        shown_n = stats.n
+        if stats.days is not None:
+            title = f"Last {stats.days} days"
+        else:
+            title = f"All time (since {(date(1970, 1, 1) + timedelta(days=stats.first_day)).strftime(date_format)})"
+        speed_week_kg = round(stats.regression_coef[0] * 7, 2) if stats.regression_coef and stats.n >= 4 else None
+        text += f"\n<b>{title}</b>, {stats.n} {'entry' if stats.n == 1 else 'entries'}:\n"
+        text += f"mean <i>{stats.mean_mass:.1f} kg</i>, min <i>{stats.min_mass:.1f} kg</i>, " \
+                f"max <i>{stats.max_mass:.1f} kg</i>\n"
+        text += text_deficit_maintenance_surplus(speed_week_kg, stats.mean_mass).lstrip("\n")
+
+    if not text:
+        text = "You don't have any data yet.\n\nUse /enter_weight daily. \n" \
+               "Alternatively, use /upload to upload your existing data."
+    else:
+        text = "Here are your stats." + text
+    await bot.reply_to(message, text, reply_markup=DEFAULT_MARKUP, parse_mode='HTML')
     user_data['conversation_state'] = ConversationState.init
 
 
 async def reply_download(message: types.Message, user_data: dict):
-    csv_file_path = await user_data_to_csv(message.chat.id)
-    file_size = os.path.getsize(csv_file_path)
-    if file_size == 0:
+    csv_table = await user_data_to_csv(message.chat.id)
+    if len(csv_table) == 0:
         text = "You don't have any data to download yet.\n\n" \
                "Use /enter_weight daily. \n" \
                "Alternatively, use /upload to upload your existing data."
@@ -242,17 +365,13 @@ async def reply_download(message: types.Message, user_data: dict):
         text = "<b>Here is all of your data.</b>"
         text += "You can either analyze it by yourself, or use it as a backup to " \
                 "/upload it in case of the data loss."
-        with open(csv_file_path, 'rb') as csv_file_object:
-            await bot.send_document(chat_id=message.chat.id,
-                                    reply_to_message_id=message.id,
-                                    reply_markup=DEFAULT_MARKUP,
-                                    document=csv_file_object,
-                                    parse_mode='HTML',
-                                    caption=text)
-    try:
-        os.remove(csv_file_path)
-    except OSError:
-        pass
+        await bot.send_document(chat_id=message.chat.id,
+                                reply_to_message_id=message.id,
+                                reply_markup=DEFAULT_MARKUP,
+                                document=csv_table,
+                                visible_file_name=csv_filename_template.format(user_id=message.chat.id),
+                                parse_mode='HTML',
+                                caption=text)
 
     user_data['conversation_state'] = ConversationState.init
 
@@ -285,11 +404,15 @@ async def reply_csv_table(message: types.Message, user_data: dict):
         return
 
     file_info = await bot.get_file(file_id)
-    file_url = 'https://api.telegram.org/file/bot{0}/{1}'.format(src.config.TELEGRAM_TOKEN, file_info.file_path)
+    file_url = (asyncio_helper.FILE_URL or 'https://api.telegram.org/file/bot{0}/{1}').format(src.config.TELEGRAM_TOKEN,
+                                                                                            file_info.file_path)
 
+    import_start = time.perf_counter()
     try:
-        await user_data_from_csv_url(message.chat.id, file_url, src.config.MAX_BODY_WEIGHT)
+        imported, replaced = await user_data_from_csv_url(message.chat.id, file_url, src.config.MAX_BODY_WEIGHT,
+                                                          proxy=asyncio_helper.proxy)
     except CSVParsingError:
+        csv_parsing_errors_total.inc()
         await bot.reply_to(message, "The file is invalid. Please use /download to get an example of a valid file."
                                     "\n/start")
         return
@@ -302,21 +425,16 @@ async def reply_csv_table(message: types.Message, user_data: dict):
                                                               exception))
 
         return
+    logger.info("Imported %d rows (%d replaced) for %s in %.3f s",
+                imported, replaced, message.chat.id, time.perf_counter() - import_start)
 
-    img_path, speed_week_kg, mean_mass = await plot_user_data(message.chat.id, only_two_weeks=False)
-    with open(img_path, 'rb') as img_file_object:
-        text = "<b>Data has been uploaded successfully.</b>\nTake a look at the plot."
-        await bot.send_photo(message.chat.id, caption=text,
-                             photo=img_file_object,
-                             reply_markup=DEFAULT_MARKUP,
-                             reply_to_message_id=message.id,
-                             parse_mode='HTML')
+    image, speed_week_kg, mean_mass = await plot_user_data(message.chat.id, only_two_weeks=False)
+    text = "<b>Data has been uploaded successfully.</b>\n"
+    text += f"Entries imported: {imported} (replaced existing: {replaced}).\n"
+    text += "Take a look at the plot."
+    await send_plot(message, text, image, only_two_weeks=False)
 
     user_data['conversation_state'] = ConversationState.init
-    try:
-        os.remove(img_path)
-    except OSError:
-        pass
 
 
 async def reply_erase(message: types.Message, user_data: dict):
@@ -335,11 +453,10 @@ async def reply_erase_confirmation(message, user_data: dict):
         user_data['conversation_state'] = ConversationState.init
         return
 
-    csv_file_path = await user_data_to_csv(message.chat.id)
+    csv_table = await user_data_to_csv(message.chat.id)
     await delete_user_data(message.chat.id)
 
-    file_size = os.path.getsize(csv_file_path)
-    if file_size == 0:
+    if len(csv_table) == 0:
         text = "You don't have any data yet."
         await bot.reply_to(message, text, reply_markup=DEFAULT_MARKUP)
         user_data['conversation_state'] = ConversationState.init
@@ -348,16 +465,12 @@ async def reply_erase_confirmation(message, user_data: dict):
     text = 'Ok, I have forgotten everything about your progress.\n'\
            'But grab the file with your erased data, just in case.'
 
-    with open(csv_file_path, 'rb') as csv_file_object:
-        await bot.send_document(chat_id=message.chat.id,
-                                reply_to_message_id=message.id,
-                                reply_markup=DEFAULT_MARKUP,
-                                document=csv_file_object,
-                                caption=text)
-    try:
-        os.remove(csv_file_path)
-    except OSError:
-        pass
+    await bot.send_document(chat_id=message.chat.id,
+                            reply_to_message_id=message.id,
+                            reply_markup=DEFAULT_MARKUP,
+                            document=csv_table,
+                            visible_file_name=csv_filename_template.format(user_id=message.chat.id),
+                            caption=text)
     user_data['conversation_state'] = ConversationState.init
 
 
@@ -366,4 +479,251 @@ async def reply_unexpected_document(message: types.Message, user_data: dict):
     await bot.reply_to(message, text, reply_markup=DEFAULT_MARKUP)
     user_data['conversation_state'] = ConversationState.init
 
-asyncio.run(bot.polling(non_stop=True))
+
+async def reply_remind(message: types.Message, user_data: dict):
+    minute = get_reminder(message.chat.id)
+    if minute is None:
+        text = "I can remind you to weigh in every day. "
+    else:
+        text = f"I remind you to weigh in every day at <b>{format_reminder_time(minute)}</b>. "
+    text += "On days when you have already entered your weight, I stay silent.\n\n"
+    text += f"Send me the time for the reminder as HH:MM (my time now is {datetime.now().strftime('%H:%M')})"
+    text += ", or <i>off</i> to stop the reminders." if minute is not None else "."
+    text += "\n\n/start - return to menu"
+    await bot.reply_to(message, text, parse_mode='HTML')
+    user_data['conversation_state'] = ConversationState.awaiting_reminder_time
+
+
+async def reply_reminder_time(message: types.Message, user_data: dict):
+    message_text = message.text.strip()
+    if message_text.lower() == 'off':
+        await cancel_reminder(message.chat.id)
+        await bot.reply_to(message, "Ok, no more reminders.", reply_markup=DEFAULT_MARKUP)
+        user_data['conversation_state'] = ConversationState.init
+        return
+
+    minute = parse_reminder_time(message_text)
+    if minute is None:
+        await bot.reply_to(message, "Please send the time as HH:MM, for example 08:30.\n/start")
+        return
+
+    await set_reminder(message.chat.id, minute)
+    text = f"Done, I will remind you to weigh in every day at <b>{format_reminder_time(minute)}</b>.\n"
+    text += "Use /remind to change the time or turn the reminders off."
+    await bot.reply_to(message, text, reply_markup=DEFAULT_MARKUP, parse_mode='HTML')
+    user_data['conversation_state'] = ConversationState.init
+
+
+async def send_reminder(user_id: int):
+    await bot.send_message(user_id, "Time to weigh in! Send /enter_weight when you are on the scales.",
+                           reply_markup=DEFAULT_MARKUP, priority=background_priority)
+
+
+@asynccontextmanager
+async def running_services(shard: int = 0, shards: int = 1,
+                           metrics_port: int = src.config.METRICS_PORT) -> AsyncIterator[None]:
+    """Start everything the handlers need and stop it on exit.
+
+    A worker process handles one of the shards of the chats and gets an equal share of the send rates.
+    """
+    configure_renderer(src.config.PLOT_RENDER_WORKERS, src.config.PLOT_RENDER_QUEUE_SIZE)
+    configure_plot_renderer(src.config.PLOT_RENDERER, src.config.PLOT_MAX_POINTS)
+    configure_plot_image(src.config.PLOT_DPI, src.config.PLOT_IMAGE_FORMAT, src.config.PLOT_IMAGE_QUALITY,
+                         src.config.PLOT_IMAGE_BUDGET)
+    configure_plot_cache(src.config.PLOT_CACHE_MAX_ENTRIES, src.config.PLOT_CACHE_MAX_IMAGE_BYTES)
+    await init_database()
+    outbound_queue.set_rate(src.config.SEND_RATE / shards)
+    start_conversation_flusher(src.config.CONVERSATION_CACHE_SIZE, src.config.CONVERSATION_FLUSH_INTERVAL)
+    await start_reminders(send_reminder, src.config.REMINDER_SEND_RATE / shards, shard, shards)
+    renderer_preload = asyncio.create_task(preload_renderer()) if src.config.PLOT_RENDERER_PRELOAD else None
+
+    metrics_runner = None
+    if metrics_port:
+        metrics_runner = await start_metrics_server(src.config.METRICS_HOST, metrics_port)
+    metrics_logging = None
+    if src.config.METRICS_LOG_INTERVAL > 0:
+        metrics_logging = asyncio.create_task(log_metrics_periodically(src.config.METRICS_LOG_INTERVAL))
+
+    try:
+        yield
+    finally:
+        if renderer_preload is not None and not renderer_preload.done():
+            await asyncio.gather(renderer_preload, return_exceptions=True)
+        if metrics_logging is not None:
+            metrics_logging.cancel()
+        if metrics_runner is not None:
+            await metrics_runner.cleanup()
+        await stop_reminders()
+        await outbound_queue.close(src.config.SHUTDOWN_TIMEOUT)
+        if asyncio_helper.session_manager.session is not None:
+            await bot.close_session()
+        await stop_conversation_flusher()
+        shutdown_renderer()
+        await close_connection()
+
+
+@asynccontextmanager
+async def handling_updates(max_in_flight: int) -> AsyncIterator[Callable[[dict], Awaitable]]:
+    """Yield a dispatch() that passes the update dicts to the bot's handlers, max_in_flight at once.
+
+    On exit waits up to SHUTDOWN_TIMEOUT for the updates in flight, so they finish before the
+    services they use are stopped.
+    """
+    in_flight = asyncio.Semaphore(max_in_flight)
+    update_tasks: set[asyncio.Task] = set()
+
+    def on_update_done(task: asyncio.Task) -> None:
+        update_tasks.discard(task)
+        in_flight.release()
+
+    async def dispatch(update: dict) -> None:
+        await in_flight.acquire()
+        task = asyncio.create_task(bot.process_new_updates([types.Update.de_json(update)]))
+        update_tasks.add(task)
+        task.add_done_callback(on_update_done)
+
+    try:
+        yield dispatch
+    finally:
+        if update_tasks:
+            _, pending = await asyncio.wait(update_tasks, timeout=src.config.SHUTDOWN_TIMEOUT)
+            if pending:
+                logger.warning("%d updates were still in flight after %.0f s", len(pending),
+                               src.config.SHUTDOWN_TIMEOUT)
+
+
+async def poll_updates(dispatch: Callable[[dict], Awaitable]) -> None:
+    """Long polling that passes the update dicts to dispatch()."""
+    offset = None
+    while True:
+        try:
+            updates = await asyncio_helper.get_updates(src.config.TELEGRAM_TOKEN, offset, limit=100, timeout=20,
+                                                       request_timeout=30)
+        except Exception as exception:
+            logger.error("Failed to get updates: %s: %s", type(exception).__name__, exception)
+            await asyncio.sleep(1)
+            continue
+        for update in updates:
+            offset = update['update_id'] + 1
+            try:
+                await dispatch(update)
+            except Exception as exception:
+                logger.error("Failed to dispatch update %s: %s: %s", update.get('update_id'),
+                             type(exception).__name__, exception)
+
+
+async def receive_updates(stop_event: asyncio.Event, dispatch: Optional[Callable[[dict], Awaitable]] = None):
+    """Receive updates until stop_event is set. They go to the bot's handlers, or to dispatch() as dicts."""
+    if src.config.BOT_MODE == 'webhook':
+        await run_webhook(bot, stop_event,
+                          host=src.config.WEBHOOK_HOST,
+                          port=src.config.WEBHOOK_PORT,
+                          path=src.config.WEBHOOK_PATH,
+                          url=src.config.WEBHOOK_URL,
+                          secret_token=src.config.WEBHOOK_SECRET_TOKEN,
+                          max_in_flight=src.config.WEBHOOK_MAX_IN_FLIGHT,
+                          drain_timeout=src.config.SHUTDOWN_TIMEOUT,
+                          dispatch=dispatch)
+    elif dispatch is None:
+        async with handling_updates(src.config.POLLING_MAX_IN_FLIGHT) as dispatch:
+            await poll_until(stop_event, dispatch)
+    else:
+        await poll_until(stop_event, dispatch)
+
+
+async def poll_until(stop_event: asyncio.Event, dispatch: Callable[[dict], Awaitable]) -> None:
+    polling = asyncio.create_task(poll_updates(dispatch))
+    stop_requested = asyncio.create_task(stop_event.wait())
+    await asyncio.wait([polling, stop_requested], return_when=asyncio.FIRST_COMPLETED)
+    stop_requested.cancel()
+    polling.cancel()
+    await asyncio.gather(polling, return_exceptions=True)
+
+
+def start_periodic_jobs() -> list[asyncio.Task]:
+    """Start the database backups and the summary updates, in one process only."""
+    jobs = []
+    if src.config.BACKUP_INTERVAL > 0:
+        jobs.append(asyncio.create_task(run_backups_periodically(
+            src.config.BACKUP_INTERVAL, src.config.BACKUP_DIRECTORY, src.config.BACKUP_KEEP)))
+    if src.config.ANALYTICS_INTERVAL > 0:
+        jobs.append(asyncio.create_task(run_analytics_periodically(src.config.ANALYTICS_INTERVAL)))
+    return jobs
+
+
+async def stop_periodic_jobs(jobs: list[asyncio.Task]) -> None:
+    for job in jobs:
+        job.cancel()
+    await asyncio.gather(*jobs, return_exceptions=True)
+
+
+def stop_on_signals(*signal_numbers: int) -> asyncio.Event:
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for signal_number in signal_numbers:
+        loop.add_signal_handler(signal_number, stop_event.set)
+    return stop_event
+
+
+def run_worker(index: int, workers: int, updates: multiprocessing.Queue) -> None:
+    """Entry point of a worker process in multi-process mode."""
+    # Ctrl+C reaches the whole process group; the front process coordinates the shutdown
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    log_to_file(f'logs/log.worker{index}')
+    asyncio.run(serve_worker(index, workers, updates))
+
+
+async def serve_worker(index: int, workers: int, updates: multiprocessing.Queue) -> None:
+    stop_event = stop_on_signals(signal.SIGTERM)
+    metrics_port = src.config.METRICS_PORT + 1 + index if src.config.METRICS_PORT else 0
+    async with running_services(index, workers, metrics_port):
+        logger.info("Worker %d of %d is ready", index, workers)
+        loop = asyncio.get_running_loop()
+        async with handling_updates(src.config.WORKER_MAX_IN_FLIGHT) as dispatch:
+            while not stop_event.is_set():
+                try:
+                    update = await loop.run_in_executor(None, updates.get, True, 0.5)
+                except queue.Empty:
+                    continue
+                if update is None:
+                    break
+                await dispatch(update)
+
+
+async def run_front(stop_event: asyncio.Event) -> None:
+    """Receive the updates and route them to the worker processes by chat id."""
+    # Migrate the database once, before the workers open it
+    await init_database()
+    await close_connection()
+
+    pool = WorkerPool(run_worker, src.config.WORKERS, src.config.WORKER_QUEUE_SIZE)
+    pool.start()
+    supervision = asyncio.create_task(pool.supervise())
+    forwarding = asyncio.create_task(pool.forward())
+    jobs = start_periodic_jobs()
+    try:
+        await receive_updates(stop_event, pool.dispatch)
+    finally:
+        supervision.cancel()
+        forwarding.cancel()
+        await stop_periodic_jobs(jobs)
+        if asyncio_helper.session_manager.session is not None:
+            await bot.close_session()
+        await pool.stop(src.config.SHUTDOWN_TIMEOUT)
+
+
+async def main():
+    stop_event = stop_on_signals(signal.SIGTERM, signal.SIGINT)
+    if src.config.WORKERS > 0:
+        await run_front(stop_event)
+    else:
+        async with running_services():
+            jobs = start_periodic_jobs()
+            try:
+                await receive_updates(stop_event)
+            finally:
+                await stop_periodic_jobs(jobs)
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
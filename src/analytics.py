@@ -0,0 +1,159 @@
+"""Per-user summaries of the whole user base, computed in one pass.
+
+update_summaries() streams users_mass in chunks of analytics_chunk_rows records, whole users at a
+time, computes every user's mean, trend slopes, smoothed weight and outliers with grouped NumPy
+math (src.batchstats) and writes them to the users_mass_summary table, which the bot reads with
+fetch_user_summary(). The records are read on a connection of their own in a worker thread, from
+one consistent snapshot; each chunk's summaries are written in a short transaction of their own,
+so memory stays bounded and the bot's writers are not held up.
+
+Run as ``python -m src.analytics [--top N]``, or every ANALYTICS_INTERVAL seconds by the bot.
+"""
+import argparse
+import asyncio
+import sqlite3
+import sys
+import time
+from datetime import date
+from typing import NamedTuple, Optional
+
+from telebot import logger
+
+import src.database
+from src.database import close_connection, fetchall, fetchone
+from src.datautils import init_database
+from src.metrics import Counter, Histogram
+from src.userstats import day_number
+
+sqlite_db_users_mass = 'users_mass'
+sqlite_db_users_mass_summary = 'users_mass_summary'
+
+analytics_chunk_rows = 50_000  # about 25 MB of peak memory
+
+_summary_columns = ('user_id', 'n', 'first_day', 'last_day', 'mean_mass', 'slope', 'recent_slope', 'ewma_mass',
+                    'last_mass', 'outliers', 'last_outlier', 'updated')
+
+analytics_seconds = Histogram('bodymass_analytics_seconds', 'Time to recompute the user summaries.',
+                              buckets=(0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0))
+analytics_failures_total = Counter('bodymass_analytics_failures_total', 'Summary updates that failed.')
+
+
+class UserSummary(NamedTuple):
+    """Slopes are kg/day, None with too few records to fit them."""
+    n: int
+    first_day: int
+    last_day: int
+    mean_mass: float
+    slope: Optional[float]
+    recent_slope: Optional[float]
+    ewma_mass: float
+    last_mass: float
+    outliers: int
+    last_outlier: bool
+    updated: int  # unix time of the update
+
+
+def _update_summaries(database_path: str, chunk_rows: int) -> tuple[int, int]:
+    """Recompute the summary table. Returns the numbers of records and users."""
+    from src.batchstats import read_record_chunks, summarize, summary_rows
+
+    reader = sqlite3.connect(f'file:{database_path}?mode=ro', uri=True)
+    # Autocommit, so every chunk is written in a BEGIN IMMEDIATE transaction of its own
+    writer = sqlite3.connect(database_path, isolation_level=None)
+    insert_query = f"INSERT OR REPLACE INTO {sqlite_db_users_mass_summary} ({', '.join(_summary_columns)}) " \
+                   f"VALUES ({', '.join('?' * len(_summary_columns))})"
+    updated = int(time.time())
+    records = users = 0
+    try:
+        for connection in (reader, writer):
+            connection.execute(f'PRAGMA busy_timeout = {src.database.sqlite_busy_timeout_ms}')
+        # The whole pass reads from one snapshot
+        reader.execute('BEGIN')
+        for chunk in read_record_chunks(reader, sqlite_db_users_mass, chunk_rows):
+            rows = summary_rows(summarize(chunk), updated)
+            writer.execute('BEGIN IMMEDIATE')
+            writer.executemany(insert_query, rows)
+            writer.execute('COMMIT')
+            records += len(chunk.user_id)
+            users += len(rows)
+        # Users who deleted their records
+        writer.execute('BEGIN IMMEDIATE')
+        writer.execute(f"DELETE FROM {sqlite_db_users_mass_summary} WHERE updated != ?", (updated,))
+        writer.execute('COMMIT')
+    finally:
+        if writer.in_transaction:
+            writer.execute('ROLLBACK')
+        writer.close()
+        reader.close()
+    return records, users
+
+
+async def update_summaries(chunk_rows: int = analytics_chunk_rows) -> tuple[int, int]:
+    """Recompute the summaries of all the users. Returns the numbers of records and users."""
+    loop = asyncio.get_running_loop()
+    start = time.perf_counter()
+    try:
+        records, users = await loop.run_in_executor(None, _update_summaries, src.database.sqlite_db_path, chunk_rows)
+    except Exception:
+        analytics_failures_total.inc()
+        raise
+    duration = time.perf_counter() - start
+    analytics_seconds.observe(duration)
+    logger.info("Summarized %d records of %d users in %.1f s", records, users, duration)
+    return records, users
+
+
+async def run_analytics_periodically(interval: float) -> None:
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await update_summaries()
+        except Exception as exception:
+            logger.error("Summary update failed: %s: %s", type(exception).__name__, exception)
+
+
+async def fetch_user_summary(user_id: int) -> Optional[UserSummary]:
+    row = await fetchone(f"SELECT {', '.join(_summary_columns[1:])} FROM {sqlite_db_users_mass_summary} "
+                         f"WHERE user_id = ?", (user_id,))
+    return UserSummary(*row[:9], bool(row[9]), row[10]) if row is not None else None
+
+
+async def fetch_trending_users(limit: int, since_day: int, up: bool = True) -> list[tuple[int, float]]:
+    """(user_id, recent slope kg/day) of the users gaining (with up) or losing weight the fastest
+    lately, among those with records since since_day."""
+    return await fetchall(f"SELECT user_id, recent_slope FROM {sqlite_db_users_mass_summary} "
+                          f"WHERE last_day >= ? AND recent_slope {'>' if up else '<'} 0 "
+                          f"ORDER BY recent_slope {'DESC' if up else 'ASC'} LIMIT ?", (since_day, limit))
+
+
+async def _main(arguments: argparse.Namespace) -> int:
+    src.database.sqlite_db_path = arguments.database
+    try:
+        await init_database()
+        start = time.perf_counter()
+        records, users = await update_summaries(arguments.chunk_rows)
+        print(f"Summarized {records} records of {users} users in {time.perf_counter() - start:.1f} s")
+        if arguments.top:
+            since_day = day_number(date.today()) - arguments.active_days
+            for title, up in (("Gaining", True), ("Losing", False)):
+                print(f"{title} fastest, kg/week:")
+                for user_id, recent_slope in await fetch_trending_users(arguments.top, since_day, up):
+                    print(f"{user_id:>16} {recent_slope * 7:+.2f}")
+    finally:
+        await close_connection()
+    return 0
+
+
+def parse_arguments(arguments: Optional[list[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Recompute the per-user summaries of the body mass records.")
+    parser.add_argument('--database', default=src.database.sqlite_db_path)
+    parser.add_argument('--chunk-rows', type=int, default=analytics_chunk_rows,
+                        help='records read and summarized at a time')
+    parser.add_argument('--top', type=int, default=0, help='then list the users with the steepest recent trends')
+    parser.add_argument('--active-days', type=int, default=14,
+                        help='only list the users with records in this many days')
+    return parser.parse_args(arguments)
+
+
+if __name__ == '__main__':
+    sys.exit(asyncio.run(_main(parse_arguments())))
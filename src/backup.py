@@ -0,0 +1,311 @@
+"""Online backups of the database and snapshots of the body mass records.
+
+A backup is a copy of the database file made with SQLite's online backup API, in steps of
+backup_step_pages pages on a connection of its own in a worker thread, so neither the event loop
+nor the writers wait for it. Writes made during the backup restart it; after backup_max_restarts
+restarts the rest is copied in one step, which in WAL mode still does not block the writers.
+The copy is written under a temporary name, checked with PRAGMA integrity_check and renamed.
+
+A snapshot is a gzipped csv of all the users_mass rows (user_id,date,body_mass) ending with a
+'# <rows> rows' line, streamed in both directions, so memory use does not grow with the database.
+restore_snapshot() refuses truncated or corrupted snapshots.
+
+Run as ``python -m src.backup backup|export|restore|check`` (see --help). Restoring rewrites the
+records and the stats table, so the bot must be stopped.
+"""
+import argparse
+import asyncio
+import contextlib
+import csv
+import gzip
+import os
+import sqlite3
+import sys
+import time
+from datetime import date, datetime
+from typing import Iterator, Optional
+
+from telebot import logger
+
+import src.database
+from src.analytics import sqlite_db_users_mass_summary
+from src.database import close_connection, transaction
+from src.datautils import init_database
+from src.metrics import Counter, Histogram
+from src.userstats import day_number, sqlite_db_users_mass_stats, unix_epoch_ordinal, users_mass_stats_source_query
+
+sqlite_db_users_mass = 'users_mass'
+
+backup_directory = 'data/backups'
+backup_step_pages = 256
+backup_step_pause = 0.01  # seconds between steps
+backup_max_restarts = 3
+backup_keep = 7
+backup_name_template = 'bodymass-{timestamp}.sqlite'
+snapshot_batch_size = 5000
+
+backup_seconds = Histogram('bodymass_backup_seconds', 'Time to write and check a backup or a snapshot.', ('kind',),
+                           buckets=(0.1, 0.5, 1.0, 5.0, 15.0, 60.0, 300.0, 900.0))
+backup_failures_total = Counter('bodymass_backup_failures_total', 'Backups and snapshots that failed.', ('kind',))
+
+
+class BackupError(Exception):
+    pass
+
+
+class _TooManyRestarts(Exception):
+    pass
+
+
+def _connect(path: str, read_only: bool = False) -> sqlite3.Connection:
+    if read_only:
+        connection = sqlite3.connect(f'file:{path}?mode=ro', uri=True)
+    else:
+        connection = sqlite3.connect(path)
+    connection.execute(f'PRAGMA busy_timeout = {src.database.sqlite_busy_timeout_ms}')
+    return connection
+
+
+def check_database(path: str) -> None:
+    """Raise BackupError unless PRAGMA integrity_check passes on the database file."""
+    connection = _connect(path, read_only=True)
+    try:
+        problems = [row[0] for row in connection.execute('PRAGMA integrity_check')]
+    finally:
+        connection.close()
+    if problems != ['ok']:
+        raise BackupError(f"Integrity check of {path} failed: {'; '.join(problems[:5])}")
+
+
+def _backup_database(source_path: str, destination: str) -> int:
+    """Copy the database, check the copy and move it to destination.
+
+    :return: size of the copy, bytes
+    """
+    temporary = destination + '.part'
+    source = _connect(source_path, read_only=True)
+    target = sqlite3.connect(temporary)
+    restarts = 0
+    remaining_before = None
+
+    def progress(status: int, remaining: int, total: int) -> None:
+        nonlocal restarts, remaining_before
+        if remaining_before is not None and remaining > remaining_before:
+            restarts += 1
+            if restarts >= backup_max_restarts:
+                raise _TooManyRestarts
+        remaining_before = remaining
+        time.sleep(backup_step_pause)
+
+    try:
+        try:
+            source.backup(target, pages=backup_step_pages, progress=progress)
+        except _TooManyRestarts:
+            logger.info("Backup restarted %d times by concurrent writes, copying the rest in one step", restarts)
+            source.backup(target)
+        # The copy inherits WAL mode; a backup is a single self-contained file
+        target.execute('PRAGMA journal_mode = DELETE')
+    finally:
+        target.close()
+        source.close()
+
+    try:
+        check_database(temporary)
+        os.replace(temporary, destination)
+    except BaseException:
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(temporary)
+        raise
+    return os.path.getsize(destination)
+
+
+async def backup_database(destination: str) -> int:
+    """Write an online backup of the database to destination. Returns its size in bytes."""
+    loop = asyncio.get_running_loop()
+    start = time.perf_counter()
+    try:
+        size = await loop.run_in_executor(None, _backup_database, src.database.sqlite_db_path, destination)
+    except Exception:
+        backup_failures_total.inc(kind='database')
+        raise
+    duration = time.perf_counter() - start
+    backup_seconds.observe(duration, kind='database')
+    logger.info("Backed up the database to %s (%.1f MB) in %.1f s", destination, size / 2 ** 20, duration)
+    return size
+
+
+def _export_snapshot(source_path: str, destination: str) -> int:
+    temporary = destination + '.part'
+    source = _connect(source_path, read_only=True)
+    rows = 0
+    try:
+        with gzip.open(temporary, 'wt', encoding='utf-8', newline='') as snapshot:
+            writer = csv.writer(snapshot, lineterminator='\n')
+            writer.writerow(('user_id', 'date', 'body_mass'))
+            # The table is clustered on (user_id, day), so the rows come in this order without sorting
+            cursor = source.execute(f"SELECT user_id, day, body_mass FROM {sqlite_db_users_mass} ORDER BY user_id, day")
+            while batch := cursor.fetchmany(snapshot_batch_size):
+                writer.writerows((user_id, date.fromordinal(day + unix_epoch_ordinal).isoformat(), repr(body_mass))
+                                 for user_id, day, body_mass in batch)
+                rows += len(batch)
+            snapshot.write(f'# {rows} rows\n')
+    except BaseException:
+        # The temporary file may not have been created, keep the original error
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(temporary)
+        raise
+    finally:
+        source.close()
+
+    try:
+        checked_rows = sum(1 for _ in _read_snapshot(temporary))
+        if checked_rows != rows:
+            raise BackupError(f"Snapshot {temporary} has {checked_rows} rows instead of {rows}")
+        os.replace(temporary, destination)
+    except BaseException:
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(temporary)
+        raise
+    return rows
+
+
+async def export_snapshot(destination: str) -> int:
+    """Write a snapshot of all the records to destination. Returns the number of records."""
+    loop = asyncio.get_running_loop()
+    start = time.perf_counter()
+    try:
+        rows = await loop.run_in_executor(None, _export_snapshot, src.database.sqlite_db_path, destination)
+    except Exception:
+        backup_failures_total.inc(kind='snapshot')
+        raise
+    duration = time.perf_counter() - start
+    backup_seconds.observe(duration, kind='snapshot')
+    logger.info("Exported %d records to %s (%.1f MB) in %.1f s", rows, destination,
+                os.path.getsize(destination) / 2 ** 20, duration)
+    return rows
+
+
+def _read_snapshot(path: str) -> Iterator[tuple[int, int, float]]:
+    """(user_id, day number, body mass) rows of a snapshot.
+
+    Raises BackupError, after the last row, if the snapshot is truncated or its row count is wrong.
+    """
+    rows = 0
+    try:
+        with gzip.open(path, 'rt', encoding='utf-8', newline='') as snapshot:
+            header = next(snapshot, '')
+            if header.strip() != 'user_id,date,body_mass':
+                raise BackupError(f"{path} is not a snapshot")
+            for line in snapshot:
+                if line.startswith('#'):
+                    if line.strip() != f'# {rows} rows':
+                        raise BackupError(f"Snapshot {path} has {rows} rows, its footer says {line.strip()!r}")
+                    return
+                user_id, day, body_mass = line.rstrip('\r\n').split(',')
+                rows += 1
+                yield int(user_id), day_number(date.fromisoformat(day)), float(body_mass)
+    except (OSError, EOFError, ValueError) as exception:
+        raise BackupError(f"Snapshot {path} is damaged: {exception}") from exception
+    raise BackupError(f"Snapshot {path} is truncated after {rows} rows")
+
+
+async def restore_snapshot(path: str, replace: bool = False) -> int:
+    """Insert the snapshot's records, replacing the records of the same days.
+
+    With replace, all the other records are deleted. The stats table is rebuilt and the summary
+    table emptied until the next update of the summaries. Nothing is changed unless the whole
+    snapshot is valid. Returns the number of records read.
+    """
+    rows = 0
+
+    def counted() -> Iterator[tuple[int, int, float]]:
+        nonlocal rows
+        for row in _read_snapshot(path):
+            rows += 1
+            yield row
+
+    async with transaction() as db:
+        if replace:
+            await db.execute(f"DELETE FROM {sqlite_db_users_mass}")
+        await db.executemany(f"INSERT OR REPLACE INTO {sqlite_db_users_mass} (user_id, day, body_mass) "
+                             f"VALUES (?, ?, ?)", counted())
+        await db.execute(f"DELETE FROM {sqlite_db_users_mass_stats}")
+        await db.execute(f"INSERT INTO {sqlite_db_users_mass_stats} {users_mass_stats_source_query}")
+        await db.execute(f"DELETE FROM {sqlite_db_users_mass_summary}")
+    return rows
+
+
+def _remove_old_backups(directory: str, keep: int) -> None:
+    prefix, suffix = backup_name_template.split('{timestamp}')
+    backups = sorted(name for name in os.listdir(directory) if name.startswith(prefix) and name.endswith(suffix))
+    for name in backups[:max(0, len(backups) - keep)]:
+        os.remove(os.path.join(directory, name))
+
+
+async def backup_now(directory: str = backup_directory, keep: int = backup_keep) -> str:
+    """Back up the database into directory and keep only the newest keep backups there."""
+    os.makedirs(directory, exist_ok=True)
+    destination = os.path.join(directory, backup_name_template.format(
+        timestamp=datetime.now().strftime('%Y%m%d-%H%M%S')))
+    await backup_database(destination)
+    _remove_old_backups(directory, keep)
+    return destination
+
+
+async def run_backups_periodically(interval: float, directory: str = backup_directory,
+                                   keep: int = backup_keep) -> None:
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await backup_now(directory, keep)
+        except Exception as exception:
+            logger.error("Backup failed: %s: %s", type(exception).__name__, exception)
+
+
+async def _main(arguments: argparse.Namespace) -> int:
+    src.database.sqlite_db_path = arguments.database
+    try:
+        if arguments.command == 'backup':
+            print(await backup_now(arguments.directory, arguments.keep))
+        elif arguments.command == 'export':
+            rows = await export_snapshot(arguments.path)
+            print(f"Exported {rows} records to {arguments.path}")
+        elif arguments.command == 'restore':
+            # The database file may be new, after a loss
+            await init_database()
+            rows = await restore_snapshot(arguments.path, arguments.replace)
+            print(f"Restored {rows} records from {arguments.path}")
+        else:
+            if arguments.path.endswith('.gz'):
+                rows = sum(1 for _ in _read_snapshot(arguments.path))
+                print(f"{arguments.path}: snapshot of {rows} records, ok")
+            else:
+                check_database(arguments.path)
+                print(f"{arguments.path}: ok")
+    except (BackupError, sqlite3.Error) as exception:
+        print(exception, file=sys.stderr)
+        return 1
+    finally:
+        await close_connection()
+    return 0
+
+
+def parse_arguments(arguments: Optional[list[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Back up the database, export or restore snapshots of the records.")
+    parser.add_argument('--database', default=src.database.sqlite_db_path)
+    commands = parser.add_subparsers(dest='command', required=True)
+    backup = commands.add_parser('backup', help='online backup of the database file')
+    backup.add_argument('--directory', default=backup_directory)
+    backup.add_argument('--keep', type=int, default=backup_keep, help='number of backups to keep')
+    export = commands.add_parser('export', help='gzipped csv snapshot of all the records')
+    export.add_argument('path')
+    restore = commands.add_parser('restore', help='restore the records from a snapshot, the bot must be stopped')
+    restore.add_argument('path')
+    restore.add_argument('--replace', action='store_true', help='delete the records missing from the snapshot')
+    check = commands.add_parser('check', help='check a backup (.sqlite) or a snapshot (.gz)')
+    check.add_argument('path')
+    return parser.parse_args(arguments)
+
+
+if __name__ == '__main__':
+    sys.exit(asyncio.run(_main(parse_arguments())))
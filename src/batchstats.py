@@ -0,0 +1,138 @@
+"""Grouped NumPy statistics of the body mass records of many users at once.
+
+The records come as three arrays (user_id, day, body_mass) sorted by user and day, so the records
+of each user are contiguous and every per-user sum is one np.add.reduceat over the group starts.
+No Python code runs per record.
+
+Imports numpy, so it is loaded lazily, in the thread that computes the summaries.
+"""
+import sqlite3
+from typing import Iterator, NamedTuple
+
+import numpy as np
+
+ewma_half_life = 7.0  # days
+outlier_sigmas = 3.0
+outlier_min_deviation = 2.0  # kg
+outlier_min_records = 5
+recent_days = 28
+
+_record_dtype = np.dtype([('user_id', np.int64), ('day', np.int64), ('mass', np.float64)])
+
+
+class Records(NamedTuple):
+    user_id: np.ndarray  # int64
+    day: np.ndarray  # int64
+    mass: np.ndarray  # float64
+
+
+class Summaries(NamedTuple):
+    """One entry per user. Slopes are kg/day, nan where they cannot be fitted."""
+    user_id: np.ndarray
+    n: np.ndarray
+    first_day: np.ndarray
+    last_day: np.ndarray
+    mean_mass: np.ndarray
+    slope: np.ndarray
+    recent_slope: np.ndarray
+    ewma_mass: np.ndarray
+    last_mass: np.ndarray
+    outliers: np.ndarray
+    last_outlier: np.ndarray  # bool
+
+
+def read_record_chunks(connection: sqlite3.Connection, table: str, chunk_rows: int) -> Iterator[Records]:
+    """Records of the table in chunks of about chunk_rows, never splitting a user between chunks.
+
+    The records of the last user of a fetched chunk are carried over to the next one, so a chunk is
+    longer than chunk_rows only when a single user has more records.
+    """
+    cursor = connection.execute(f"SELECT user_id, day, body_mass FROM {table} ORDER BY user_id, day")
+    carried = None
+    while True:
+        rows = cursor.fetchmany(chunk_rows)
+        if rows:
+            table_chunk = np.fromiter(rows, dtype=_record_dtype, count=len(rows))
+            records = Records(table_chunk['user_id'], table_chunk['day'], table_chunk['mass'])
+            if carried is not None:
+                records = Records(*(np.concatenate(pair) for pair in zip(carried, records)))
+        elif carried is not None:
+            yield carried
+            return
+        else:
+            return
+
+        # The last user may continue in the next fetch
+        last_user_start = int(np.searchsorted(records.user_id, records.user_id[-1]))
+        if last_user_start > 0:
+            yield Records(*(column[:last_user_start] for column in records))
+        carried = Records(*(column[last_user_start:] for column in records))
+
+
+def _grouped_slope(n: np.ndarray, sum_x: np.ndarray, sum_y: np.ndarray, sum_xy: np.ndarray,
+                   sum_xx: np.ndarray) -> np.ndarray:
+    denominator = (n * sum_xx - sum_x * sum_x).astype(np.float64)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        slope = (n * sum_xy - sum_x * sum_y) / denominator
+    slope[(n < 2) | (denominator == 0)] = np.nan
+    return slope
+
+
+def summarize(records: Records) -> Summaries:
+    """Per-user statistics of records sorted by user and day.
+
+    mean_mass and slope are over all the records, the same as the stats table and the plot trend line;
+    recent_slope over the recent_days up to the user's last record. ewma_mass is the exponentially
+    weighted mean at the last record with a half-life of ewma_half_life days, weighting each record by
+    the time to the next one, so gaps in the records are handled. A record is an outlier when it is
+    further from the trend line than outlier_sigmas times the residual standard deviation and
+    outlier_min_deviation kg.
+    """
+    user_id, day, mass = records
+    starts = np.flatnonzero(np.r_[True, user_id[1:] != user_id[:-1]])
+    ends = np.r_[starts[1:], len(user_id)]
+    n = ends - starts
+    group = np.repeat(np.arange(len(starts)), n)
+
+    # Days from the user's first record keep the sums small and exact
+    first_day = day[starts]
+    last_day = day[ends - 1]
+    x = day - first_day[group]
+    sum_x = np.add.reduceat(x, starts)
+    sum_xx = np.add.reduceat(x * x, starts)
+    sum_y = np.add.reduceat(mass, starts)
+    sum_xy = np.add.reduceat(x * mass, starts)
+    mean_mass = sum_y / n
+    slope = _grouped_slope(n, sum_x, sum_y, sum_xy, sum_xx)
+
+    recent = (day > last_day[group] - recent_days).astype(np.int64)
+    recent_slope = _grouped_slope(np.add.reduceat(recent, starts), np.add.reduceat(recent * x, starts),
+                                  np.add.reduceat(recent * mass, starts), np.add.reduceat(recent * x * mass, starts),
+                                  np.add.reduceat(recent * x * x, starts))
+
+    # s_i = (1 - a_i) s_(i-1) + a_i y_i with a_i = 1 - exp(-(t_i - t_(i-1)) / tau) unrolls to
+    # sum(w_i y_i) with w_i = e_i - e_(i-1), e_i = exp(-(t_last - t_i) / tau), and e_(-1) = 0
+    decay = np.exp(-(last_day[group] - day) * (np.log(2) / ewma_half_life))
+    previous_decay = np.r_[0.0, decay[:-1]]
+    previous_decay[starts] = 0.0
+    ewma_mass = np.add.reduceat((decay - previous_decay) * mass, starts)
+
+    intercept = (sum_y - np.nan_to_num(slope) * sum_x) / n
+    residual = mass - (intercept[group] + np.nan_to_num(slope)[group] * x)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        residual_sd = np.sqrt(np.add.reduceat(residual * residual, starts) / np.maximum(n - 2, 1))
+    threshold = np.maximum(outlier_sigmas * residual_sd, outlier_min_deviation)
+    outlier = (np.abs(residual) > threshold[group]) & (n[group] >= outlier_min_records)
+
+    return Summaries(user_id[starts], n, first_day, last_day, mean_mass, slope, recent_slope, ewma_mass,
+                     mass[ends - 1], np.add.reduceat(outlier.astype(np.int64), starts), outlier[ends - 1])
+
+
+def summary_rows(summaries: Summaries, updated: int) -> list[tuple]:
+    """Rows for the summary table, with NULL for the slopes that cannot be fitted."""
+    columns = [column.tolist() for column in summaries]
+    for slopes in (columns[5], columns[6]):
+        for index, slope in enumerate(slopes):
+            if slope != slope:
+                slopes[index] = None
+    return [(*row, updated) for row in zip(*columns)]
@@ -2,10 +2,93 @@ import os
 from telebot import asyncio_helper
 
 SQLITE_PATH = 'data/bodymass.db'
+
+BOT_MODE = os.environ.get('BOT_MODE', 'polling')  # 'polling' or 'webhook'
+# Long polling hands up to POLLING_MAX_IN_FLIGHT updates to the handlers at once
+POLLING_MAX_IN_FLIGHT = int(os.environ.get('POLLING_MAX_IN_FLIGHT', 40))
+
+# Webhook mode. Without WEBHOOK_URL the webhook is not registered with Telegram,
+# which is useful for feeding recorded updates to a local instance.
+WEBHOOK_URL = os.environ.get('WEBHOOK_URL')
+WEBHOOK_HOST = os.environ.get('WEBHOOK_HOST', '0.0.0.0')
+WEBHOOK_PORT = int(os.environ.get('WEBHOOK_PORT', 8443))
+WEBHOOK_PATH = os.environ.get('WEBHOOK_PATH', '/webhook')
+WEBHOOK_SECRET_TOKEN = os.environ.get('WEBHOOK_SECRET_TOKEN')
+WEBHOOK_MAX_IN_FLIGHT = int(os.environ.get('WEBHOOK_MAX_IN_FLIGHT', 40))
+SHUTDOWN_TIMEOUT = float(os.environ.get('SHUTDOWN_TIMEOUT', 20))
+
+# With WORKERS > 0 the process only receives the updates and routes them by chat id to WORKERS
+# worker processes, which handle them and share the database. WORKER_QUEUE_SIZE updates can wait
+# for each worker, which handles up to WORKER_MAX_IN_FLIGHT of them at once.
+WORKERS = int(os.environ.get('WORKERS', 0))
+WORKER_QUEUE_SIZE = int(os.environ.get('WORKER_QUEUE_SIZE', 1000))
+WORKER_MAX_IN_FLIGHT = int(os.environ.get('WORKER_MAX_IN_FLIGHT', 40))
+
+MAX_CONCURRENT_HANDLERS = int(os.environ.get('MAX_CONCURRENT_HANDLERS', 32))
+MAX_CONCURRENT_HEAVY_HANDLERS = int(os.environ.get('MAX_CONCURRENT_HEAVY_HANDLERS', 4))
+MAX_CONCURRENT_LIGHT_HANDLERS = int(os.environ.get('MAX_CONCURRENT_LIGHT_HANDLERS', 32))
+
 MAX_FILE_SIZE = 100*1024
 MAX_BODY_WEIGHT = 1000
 MAINTENANCE_THRESHOLD = 0.001
 
+# Outgoing messages are kept under Telegram's limits: SEND_RATE messages a second overall and
+# SEND_CHAT_RATE a second in a chat, after a burst of SEND_CHAT_BURST. Handlers wait when
+# SEND_QUEUE_SIZE messages are pending. A message rejected with 429 Too Many Requests is retried
+# after the delay Telegram asks for, at most SEND_MAX_RETRIES times.
+SEND_RATE = float(os.environ.get('SEND_RATE', 30))
+SEND_CHAT_RATE = float(os.environ.get('SEND_CHAT_RATE', 1))
+SEND_CHAT_BURST = float(os.environ.get('SEND_CHAT_BURST', 1))
+SEND_QUEUE_SIZE = int(os.environ.get('SEND_QUEUE_SIZE', 256))
+SEND_MAX_RETRIES = int(os.environ.get('SEND_MAX_RETRIES', 5))
+
+# Daily reminders are sent at most REMINDER_SEND_RATE a second, after the replies to users.
+REMINDER_SEND_RATE = float(os.environ.get('REMINDER_SEND_RATE', 10))
+
+# An online backup of the database is written to BACKUP_DIRECTORY every BACKUP_INTERVAL seconds,
+# keeping the newest BACKUP_KEEP. BACKUP_INTERVAL=0 disables the backups.
+BACKUP_DIRECTORY = os.environ.get('BACKUP_DIRECTORY', 'data/backups')
+BACKUP_INTERVAL = float(os.environ.get('BACKUP_INTERVAL', 24 * 60 * 60))
+BACKUP_KEEP = int(os.environ.get('BACKUP_KEEP', 7))
+
+# The per-user summary table (trends, smoothed weight, outliers) is recomputed for all the users
+# every ANALYTICS_INTERVAL seconds, 0 disables it; python -m src.analytics recomputes it by hand.
+ANALYTICS_INTERVAL = float(os.environ.get('ANALYTICS_INTERVAL', 24 * 60 * 60))
+
+PLOT_RENDER_WORKERS = int(os.environ.get('PLOT_RENDER_WORKERS', 1))
+PLOT_RENDER_QUEUE_SIZE = int(os.environ.get('PLOT_RENDER_QUEUE_SIZE', 8))
+# 'pillow' draws the plots directly with Pillow, 'matplotlib' with matplotlib. The matplotlib renderer
+# is used if the selected one cannot be loaded.
+PLOT_RENDERER = os.environ.get('PLOT_RENDERER', 'pillow')
+# Longer histories are plotted as weekly (or longer) means with min/max bands. The trend line
+# is always fitted on all the records.
+PLOT_MAX_POINTS = int(os.environ.get('PLOT_MAX_POINTS', 400))
+# Plots are drawn at PLOT_DPI (8x5 inches, 160 dpi is 1280x800) and encoded as PLOT_IMAGE_FORMAT:
+# 'png', 'palette' (PNG with up to 256 colours), 'jpeg', 'webp' (at PLOT_IMAGE_QUALITY) or 'auto',
+# which takes the first of palette PNG, JPEG and WebP that fits in PLOT_IMAGE_BUDGET bytes.
+PLOT_DPI = int(os.environ.get('PLOT_DPI', 160))
+PLOT_IMAGE_FORMAT = os.environ.get('PLOT_IMAGE_FORMAT', 'auto')
+PLOT_IMAGE_QUALITY = int(os.environ.get('PLOT_IMAGE_QUALITY', 85))
+PLOT_IMAGE_BUDGET = int(os.environ.get('PLOT_IMAGE_BUDGET', 64 * 1024))
+# The plot renderer (and matplotlib and numpy with it) is loaded on the first plot. With
+# PLOT_RENDERER_PRELOAD=1 it is loaded in the background right after startup instead,
+# trading idle memory for a faster first plot.
+PLOT_RENDERER_PRELOAD = os.environ.get('PLOT_RENDERER_PRELOAD', '0') == '1'
+
+PLOT_CACHE_MAX_ENTRIES = int(os.environ.get('PLOT_CACHE_MAX_ENTRIES', 4096))
+PLOT_CACHE_MAX_IMAGE_BYTES = int(os.environ.get('PLOT_CACHE_MAX_IMAGE_BYTES', 16 * 1024 * 1024))
+
+CONVERSATION_CACHE_SIZE = int(os.environ.get('CONVERSATION_CACHE_SIZE', 10000))
+CONVERSATION_FLUSH_INTERVAL = float(os.environ.get('CONVERSATION_FLUSH_INTERVAL', 2.0))
+
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO')
+
+# Prometheus metrics are served on METRICS_HOST:METRICS_PORT/metrics, METRICS_PORT=0 disables the endpoint.
+# With METRICS_LOG_INTERVAL > 0 a summary line is also logged every METRICS_LOG_INTERVAL seconds.
+METRICS_HOST = os.environ.get('METRICS_HOST', '127.0.0.1')
+METRICS_PORT = int(os.environ.get('METRICS_PORT', 9464))
+METRICS_LOG_INTERVAL = float(os.environ.get('METRICS_LOG_INTERVAL', 0))
+
 TELEGRAM_TOKEN = os.environ.get('TELEGRAM_TOKEN')
 
 class TelegramTokenNotSpecified(Exception):
@@ -14,5 +97,11 @@ class TelegramTokenNotSpecified(Exception):
 if not TELEGRAM_TOKEN:
     raise TelegramTokenNotSpecified("Please specify TELEGRAM_TOKEN environmental variable or edit src/config.py")
 
+# A Bot API server other than api.telegram.org, e.g. a local one or benchmarks/fake_telegram_api.py
+TELEGRAM_API_URL = os.environ.get('TELEGRAM_API_URL')
+if TELEGRAM_API_URL:
+    asyncio_helper.API_URL = TELEGRAM_API_URL.rstrip('/') + '/bot{0}/{1}'
+    asyncio_helper.FILE_URL = TELEGRAM_API_URL.rstrip('/') + '/file/bot{0}/{1}'
+
 if os.environ.get('PYTHONANYWHERE'):
     asyncio_helper.proxy = "http://proxy.server:3128"
@@ -1,14 +1,29 @@
-import aiosqlite
+import asyncio
+from collections import OrderedDict
+from typing import Optional
+
+from telebot import logger
+
+from src.database import fetchone, transaction
 
-sqlite_db_path = 'data/bodymass.sqlite'
 sqlite_db_users_conversation = 'users_conversation'
 
+conversation_cache_size = 10000
+conversation_flush_interval = 2.0
+
+# Write-back cache in front of the users_conversation table, which stays the durable copy.
+# Entries are kept in least recently used order; changed states wait in _dirty until flushed.
+_states: 'OrderedDict[int, str]' = OrderedDict()
+_dirty: dict[int, str] = {}
+_flush_task: Optional[asyncio.Task] = None
+
 
 class ConversationState:
     init = 'init'
     awaiting_body_weight = 'awaiting_body_weight'
     awaiting_erase_confirmation = 'awaiting_erase_confirmation'
     awaiting_csv_table = 'awaiting_csv_table'
+    awaiting_reminder_time = 'awaiting_reminder_time'
 
 
 conversation_states = [k for k in vars(ConversationState).keys() if not k.startswith('_')]
@@ -19,23 +34,78 @@ for k, v in vars(ConversationState).items():
 
 
 async def get_conversation_data(user_id: int) -> dict:
-    async with aiosqlite.connect(sqlite_db_path) as db:
-        async with db.cursor() as cursor:
-            query = f"SELECT conversation_state FROM {sqlite_db_users_conversation} " \
-                                 f"WHERE user_id = '{user_id}';"
-            await cursor.execute(query)
-            conversation_state = await cursor.fetchone()
-            conversation_state = conversation_state[0] if conversation_state is not None else 'init'
-            assert conversation_state in conversation_states
-            return {'conversation_state': conversation_state}
+    conversation_state = _states.get(user_id)
+    if conversation_state is None:
+        conversation_state = await fetchone(f"SELECT conversation_state FROM {sqlite_db_users_conversation} "
+                                            f"WHERE user_id = ?;", (str(user_id),))
+        conversation_state = conversation_state[0] if conversation_state is not None else 'init'
+        assert conversation_state in conversation_states
+        _states.setdefault(user_id, conversation_state)
+        _evict()
+    else:
+        _states.move_to_end(user_id)
+    return {'conversation_state': conversation_state}
 
 
 async def write_conversation_data(user_id: int, conversation_data: dict) -> None:
-    async with aiosqlite.connect(sqlite_db_path) as db:
+    """Remember the conversation state. Only a changed state is written to the database, on the next flush."""
+    conversation_state = conversation_data['conversation_state']
+    if _states.get(user_id) == conversation_state:
+        return
+    _states[user_id] = conversation_state
+    _states.move_to_end(user_id)
+    _dirty[user_id] = conversation_state
+    _evict()
+
+
+def _evict() -> None:
+    # Idle chats go first; states that are not flushed yet are never dropped
+    while len(_states) > conversation_cache_size:
+        idle_user_id = next((user_id for user_id in _states if user_id not in _dirty), None)
+        if idle_user_id is None:
+            return
+        del _states[idle_user_id]
+
 
+async def flush_conversation_data() -> None:
+    """Write all changed states to the database in one transaction.
+
+    The states stay dirty, so they are not evicted, until the transaction commits; then only the
+    ones that did not change in the meantime are marked clean.
+    """
+    if not _dirty:
+        return
+    batch = list(_dirty.items())
+    async with transaction() as db:
         query = f"INSERT INTO {sqlite_db_users_conversation} (user_id, conversation_state) " \
-                f"VALUES ('{user_id}', '{conversation_data['conversation_state']}'); "
+                f"VALUES (?, ?);"
+
+        await db.executemany(query, [(str(user_id), conversation_state) for user_id, conversation_state in batch])
+    for user_id, conversation_state in batch:
+        if _dirty.get(user_id) == conversation_state:
+            del _dirty[user_id]
+
+
+async def _flush_periodically() -> None:
+    while True:
+        await asyncio.sleep(conversation_flush_interval)
+        try:
+            await flush_conversation_data()
+        except Exception as exception:
+            logger.error("Failed to flush conversation states: %s: %s", type(exception).__name__, exception)
+
+
+def start_conversation_flusher(cache_size: int, flush_interval: float) -> None:
+    global conversation_cache_size, conversation_flush_interval, _flush_task
+    conversation_cache_size = cache_size
+    conversation_flush_interval = flush_interval
+    _flush_task = asyncio.create_task(_flush_periodically())
 
-        await db.execute(query)
-        await db.commit()
 
+async def stop_conversation_flusher() -> None:
+    """Stop periodic flushing and write the remaining changes."""
+    global _flush_task
+    if _flush_task is not None:
+        _flush_task.cancel()
+        _flush_task = None
+    await flush_conversation_data()
@@ -0,0 +1,80 @@
+import asyncio
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Iterable, Optional
+
+import aiosqlite
+
+from src.metrics import stage_seconds, timed
+
+sqlite_db_path = 'data/bodymass.sqlite'
+
+sqlite_cached_statements = 128
+sqlite_busy_timeout_ms = 5000
+
+_connection: Optional[aiosqlite.Connection] = None
+_connection_lock = asyncio.Lock()
+_write_lock = asyncio.Lock()
+
+
+async def get_connection() -> aiosqlite.Connection:
+    """Return the shared database connection, opening it on first use.
+
+    The connection lives for the whole life of the process and runs in WAL mode,
+    so readers never wait for the writer. Statements are parameterized and kept in
+    the sqlite3 statement cache.
+    """
+    global _connection
+    if _connection is None:
+        async with _connection_lock:
+            if _connection is None:
+                connection = await aiosqlite.connect(sqlite_db_path, cached_statements=sqlite_cached_statements)
+                await connection.execute('PRAGMA journal_mode = WAL')
+                await connection.execute('PRAGMA synchronous = NORMAL')
+                await connection.execute(f'PRAGMA busy_timeout = {sqlite_busy_timeout_ms}')
+                _connection = connection
+    return _connection
+
+
+@asynccontextmanager
+async def transaction() -> AsyncIterator[aiosqlite.Connection]:
+    """Run a write transaction on the shared connection.
+
+    Writers are serialized, so statements of concurrent transactions never interleave.
+    The transaction takes the write lock when it begins (BEGIN IMMEDIATE), so writers of other
+    processes wait for each other within the busy timeout instead of failing on a stale snapshot.
+    It is committed on success and rolled back on any exception.
+    """
+    db = await get_connection()
+    async with _write_lock:
+        with timed(stage_seconds, stage='db_write'):
+            await db.execute('BEGIN IMMEDIATE')
+            try:
+                yield db
+            except BaseException:
+                await db.rollback()
+                raise
+            else:
+                await db.commit()
+
+
+async def fetchall(query: str, parameters: Iterable[Any] = ()) -> list[tuple]:
+    db = await get_connection()
+    with timed(stage_seconds, stage='db_fetch'):
+        async with db.execute(query, tuple(parameters)) as cursor:
+            return list(await cursor.fetchall())
+
+
+async def fetchone(query: str, parameters: Iterable[Any] = ()) -> Optional[tuple]:
+    db = await get_connection()
+    with timed(stage_seconds, stage='db_fetch'):
+        async with db.execute(query, tuple(parameters)) as cursor:
+            return await cursor.fetchone()
+
+
+async def close_connection() -> None:
+    """Close the shared connection. Must be called on shutdown."""
+    global _connection
+    if _connection is not None:
+        connection, _connection = _connection, None
+        async with _write_lock:
+            await connection.close()
@@ -1,36 +1,54 @@
-import os
+import io
 import csv
-import uuid
-from datetime import datetime, timedelta
-import aiosqlite
-import sqlite3
-from matplotlib.dates import date2num, DateFormatter
-from matplotlib import pyplot
-import numpy as np
-from typing import Optional
-import requests
-from codecs import iterdecode
-
-sqlite_db_path = 'data/bodymass.sqlite'
+from datetime import date as date_type, datetime, timedelta
+from typing import Optional, Union
+import aiohttp
+
+from src.database import fetchall, get_connection, transaction
+from src.rendering import run_render
+from src.plotting import draw_user_plot, load_plot_renderer
+from src.plotcache import bump_data_version, plot_cache_key, get_cached_plot, cache_plot, remember_file_id
+from src.userstats import sqlite_db_users_mass_stats, users_mass_stats_source_query
+from src.userstats import day_number, update_user_stats, delete_user_stats, fetch_user_stats
+from src.userstats import WindowStats, window_stats
+from src.metrics import stage_seconds, timed
+from src.migration import current_schema_version, fetch_schema_version, finish_migration, set_schema_version
+from telebot import logger
+
 sqlite_db_users_mass = 'users_mass'
 
 sql_header_path = 'data/bodymass.sql'
 
-csv_tmp_folder = 'data/tmp/'
-csv_tmp_filename_template = 'bodymass_{user_id}_{hash}.csv'
-csv_uploaded_tmp_filename_template = 'uploaded_{user_id}_{hash}.csv'
-
-plot_tmp_folder = 'data/tmp/'
-plot_tmp_filename_template = '{user_id}_{hash}.png'
+csv_filename_template = 'bodymass_{user_id}.csv'
 
 date_format = "%Y/%m/%d"
 
+stats_windows = (7, 30, 90, 365, None)  # days, None for all time
 
-if not os.path.exists(sqlite_db_path):
-    with sqlite3.connect(sqlite_db_path) as db:
-        with open(sql_header_path, 'r') as sql_header:
-            for command in sql_header.read().split(';'):
-                db.execute(command)
+
+async def init_database() -> None:
+    """Finish a pending migration to the current schema version and create missing tables.
+
+    The stats table is filled from the records while it is empty.
+    Must be awaited on startup, before the first query.
+    """
+    schema_version = await fetch_schema_version()
+    if schema_version is not None and schema_version < current_schema_version:
+        logger.info("Migrating the database from schema version %d to %d", schema_version, current_schema_version)
+        async with transaction() as db:
+            await finish_migration(db)
+
+    with open(sql_header_path, 'r') as sql_header:
+        schema = sql_header.read()
+    # The schema script has its own transaction and executescript() would commit an enclosing one,
+    # so the tables are created first and filled under a lock of their own
+    await (await get_connection()).executescript(schema)
+    async with transaction() as db:
+        await set_schema_version(db, current_schema_version)
+        async with db.execute(f"SELECT 1 FROM {sqlite_db_users_mass_stats} LIMIT 1") as cursor:
+            stats_table_empty = await cursor.fetchone() is None
+        if stats_table_empty:
+            await db.execute(f"INSERT INTO {sqlite_db_users_mass_stats} {users_mass_stats_source_query}")
 
 
 async def add_record_now(user_id: int, body_mass: float) -> None:
@@ -38,142 +56,207 @@ async def add_record_now(user_id: int, body_mass: float) -> None:
 
 
 async def add_record(user_id: int, date: datetime.date, body_mass: float) -> None:
-    async with aiosqlite.connect(sqlite_db_path) as db:
-        query = f"INSERT INTO {sqlite_db_users_mass} (user_id, date, body_mass) " \
-                f"VALUES ('{user_id}', '{date.strftime(date_format)}', {body_mass}); "
+    async with transaction() as db:
+        day = day_number(date)
+        async with db.execute(f"SELECT body_mass FROM {sqlite_db_users_mass} WHERE user_id = ? AND day = ?",
+                              (user_id, day)) as cursor:
+            replaced_row = await cursor.fetchone()
+
+        query = f"INSERT OR REPLACE INTO {sqlite_db_users_mass} (user_id, day, body_mass) " \
+                f"VALUES (?, ?, ?);"
+
+        await db.execute(query, (user_id, day, body_mass))
 
-        await db.execute(query)
-        await db.commit()
+        await update_user_stats(db, user_id, {day: body_mass}, {day: replaced_row[0]} if replaced_row else {})
+    bump_data_version(user_id)
 
 
 async def delete_user_data(user_id: int) -> None:
-    async with aiosqlite.connect(sqlite_db_path) as db:
-        await db.execute(f"DELETE FROM {sqlite_db_users_mass} WHERE user_id = '{user_id}'")
-        await db.commit()
+    async with transaction() as db:
+        await db.execute(f"DELETE FROM {sqlite_db_users_mass} WHERE user_id = ?", (user_id,))
+        await delete_user_stats(db, user_id)
+    bump_data_version(user_id)
 
 
-async def fetch_user_data(user_id: int):
-    async with aiosqlite.connect(sqlite_db_path) as db:
-        async with db.cursor() as cursor:
-            await cursor.execute(f"SELECT date, body_mass FROM {sqlite_db_users_mass} " 
-                                 f"WHERE user_id = '{user_id}' ORDER BY date ASC")
-            while row := await cursor.fetchone():
-                yield row
+async def fetch_user_data(user_id: int, date_from: Optional[date_type] = None, date_to: Optional[date_type] = None,
+                          limit: Optional[int] = None) -> list[tuple[str, float]]:
+    """Fetch user records ordered by date.
 
+    The date range is evaluated in SQL on the (user_id, day) primary key.
 
-def random_hash() -> str:
-    """Returns a random 8-piece hash"""
-    return uuid.uuid4().hex[:8]
+    Keyword arguments:
+    :param user_id: user id
+    :param date_from: first date to include
+    :param date_to: last date to include
+    :param limit: return only this many most recent records
 
+    :return: list of (date, body mass)
+    """
+    query = f"SELECT strftime('{date_format}', day * 86400, 'unixepoch'), body_mass " \
+            f"FROM {sqlite_db_users_mass} WHERE user_id = ?"
+    parameters = [user_id]
+    if date_from is not None:
+        query += " AND day >= ?"
+        parameters.append(day_number(date_from))
+    if date_to is not None:
+        query += " AND day <= ?"
+        parameters.append(day_number(date_to))
+
+    if limit is None:
+        return await fetchall(query + " ORDER BY day ASC", parameters)
+
+    parameters.append(limit)
+    rows = await fetchall(query + " ORDER BY day DESC LIMIT ?", parameters)
+    rows.reverse()
+    return rows
+
+
+async def fetch_user_series(user_id: int, date_from: Optional[date_type] = None) -> list[tuple[int, float]]:
+    """Fetch user records ordered by date as (day number, body mass), days counted from 1970-01-01."""
+    query = f"SELECT day, body_mass FROM {sqlite_db_users_mass} WHERE user_id = ?"
+    parameters = [user_id]
+    if date_from is not None:
+        query += " AND day >= ?"
+        parameters.append(day_number(date_from))
+    return await fetchall(query + " ORDER BY day ASC", parameters)
+
+
+async def user_window_stats(user_id: int) -> list[Optional[WindowStats]]:
+    """Stats of the user's records over each of stats_windows, from a single fetch and without plotting.
+
+    :return: WindowStats per window, None for windows without records
+    """
+    rows = await fetch_user_series(user_id)
+    return window_stats(rows, day_number(date_type.today()), stats_windows)
 
-async def plot_user_data(user_id: int, only_two_weeks: bool = False) -> tuple[str, Optional[np.array], float]:
+
+async def plot_user_data(user_id: int,
+                         only_two_weeks: bool = False) -> tuple[Union[bytes, str], Optional[float], float]:
     """Plot user data to an image.
 
+    Results are cached until the user's data changes. If the plot has already been sent,
+    its Telegram file_id is returned instead of the image.
+
     Keyword arguments:
     :param user_id: user id
     :param only_two_weeks: draw progress only for the past 2 weeks
 
-    :return: image temporary file path, speed kg/week, mean body mass
+    :return: plot image or Telegram file_id, speed kg/week, mean body mass
     """
-    os.makedirs(plot_tmp_folder, exist_ok=True)
-    plot_file_path = os.path.join(plot_tmp_folder,
-                                  plot_tmp_filename_template.format(user_id=user_id, hash=random_hash()))
-
-    date_list: list[datetime] = []
-    mass_list: list[float] = []
-    async for (date_str, body_mass) in fetch_user_data(user_id):
-        datetime_object = datetime.strptime(date_str, date_format)
-        if only_two_weeks:
-            if datetime.now() - datetime_object > timedelta(days=14):
-                continue
-
-        date_list.append(datetime_object)
-        mass_list.append(body_mass)
-
-    regression_coef = draw_plot_mass(date_list, mass_list, plot_file_path)
-    speed_kg_week = round(regression_coef[0] * 7, 2) if regression_coef is not None else None
-    if len(mass_list) < 4:
-        speed_kg_week = None
-
-    return plot_file_path, speed_kg_week, float(np.mean(mass_list))
-
-
-def draw_plot_mass(date: list[datetime], mass: list[float], file_path: str) -> Optional[np.array]:
-    x = list(map(date2num, date))
-    y = mass
+    cache_key = plot_cache_key(user_id, only_two_weeks)
+    cached_plot = get_cached_plot(cache_key)
+    if cached_plot is not None:
+        return cached_plot.photo, cached_plot.speed_kg_week, cached_plot.mean_mass
 
-    regression_coef = np.polyfit(x, y, 1) if len(x) > 1 else None
-    regression_func = np.poly1d(regression_coef) if len(x) > 1 else None
+    date_from = date_type.today() - timedelta(days=13) if only_two_weeks else None
+    rows = await fetch_user_series(user_id, date_from=date_from)
 
-    fig, ax = pyplot.subplots(figsize=[8, 5])
+    # The all-time trend is kept up to date in the stats table, no need to refit it
+    user_stats = await fetch_user_stats(user_id) if not only_two_weeks else None
 
-    pyplot.scatter(x, y)
+    image = io.BytesIO()
+    regression_coef = await run_render(draw_user_plot, rows, image,
+                                       user_stats.regression_coef if user_stats is not None else None)
+    speed_kg_week = round(regression_coef[0] * 7, 2) if regression_coef is not None else None
+    if len(rows) < 4:
+        speed_kg_week = None
 
-    if len(x) > 1:
-        limits = (min(mass) // 5 * 5 - 6, max(mass) // 5 * 5 + 6)
+    image = image.getvalue()
+    if user_stats is not None:
+        mean_mass = user_stats.mean_mass
     else:
-        limits = (64, 76)
-
-    pyplot.ylim(limits)
+        mean_mass = sum(body_mass for _, body_mass in rows) / len(rows) if rows else float('nan')
+    cache_plot(cache_key, image, speed_kg_week, mean_mass)
+    return image, speed_kg_week, mean_mass
 
-    if len(x) > 1:
-        pyplot.plot(x, regression_func(x))
 
-    pyplot.ylabel('Bodyweight, kg')
+def remember_plot_file_id(user_id: int, only_two_weeks: bool, photo: Union[bytes, str], file_id: str) -> None:
+    """Let the plot cache reuse the file_id of a plot returned by plot_user_data once it has been sent."""
+    if isinstance(photo, bytes):
+        remember_file_id(plot_cache_key(user_id, only_two_weeks), photo, file_id)
 
-    ax.xaxis.set_major_formatter(DateFormatter('%d %b'))
-    pyplot.xticks(rotation=45)
-    pyplot.grid()
-    pyplot.tight_layout()
-    pyplot.savefig(file_path, dpi=300)
-    pyplot.close('all')
 
-    return regression_coef
+async def preload_renderer() -> None:
+    """Import the plot renderer in the render thread ahead of the first plot."""
+    await run_render(load_plot_renderer)
 
 
-async def user_data_to_csv(user_id: int) -> str:
-    """Save user data from the database to a csv file.
+async def user_data_to_csv(user_id: int) -> bytes:
+    """Export user data from the database as a csv table.
 
     Keyword arguments:
     :param user_id: user id
 
-    :return csv temporary file path
+    :return csv file contents (empty if the user has no data)
     """
 
-    os.makedirs(csv_tmp_folder, exist_ok=True)
-    csv_file_path = os.path.join(csv_tmp_folder,
-                                 csv_tmp_filename_template.format(user_id=user_id, hash=random_hash()))
-    with open(csv_file_path, 'w', newline='', encoding='utf-8') as csv_file_object:
-        csv_writer = csv.writer(csv_file_object)
-        async for row in fetch_user_data(user_id):
-            csv_writer.writerow(row)
+    csv_file_object = io.StringIO(newline='')
+    csv_writer = csv.writer(csv_file_object)
+    csv_writer.writerows(await fetch_user_data(user_id))
 
-    return csv_file_path
+    return csv_file_object.getvalue().encode('utf-8')
 
 
 class CSVParsingError(Exception):
     pass
 
 
-async def user_data_from_csv_url(user_id: int, csv_url: str, max_body_weight: int) -> None:
-    with requests.get(csv_url) as request:
-        csv_reader = csv.reader(iterdecode(request.iter_lines(), 'utf-8'))
-        for row in csv_reader:
-            try:
-                date, body_weight = row
-                date = datetime.strptime(date, date_format)
-                body_weight = float(body_weight)
-                assert 0 < body_weight < max_body_weight
-            except Exception:
-                raise CSVParsingError()
-
-            await add_record(user_id, date, body_weight)
-
-
+def parse_csv_row(line: str, max_body_weight: int) -> tuple[date_type, float]:
+    """Validate a single line of an uploaded csv table.
 
+    :return: date, body weight
+    """
+    try:
+        date, body_weight = next(csv.reader([line]))
+        date = datetime.strptime(date, date_format)
+        body_weight = float(body_weight)
+        assert 0 < body_weight < max_body_weight
+    except Exception:
+        raise CSVParsingError()
 
+    return date.date(), body_weight
 
 
+async def user_data_from_csv_url(user_id: int, csv_url: str, max_body_weight: int,
+                                 proxy: Optional[str] = None) -> tuple[int, int]:
+    """Import a csv table into the user's data.
 
+    The file is downloaded and validated line by line. The rows are then written in a single
+    transaction, so nothing is imported if any row is invalid.
 
+    Keyword arguments:
+    :param user_id: user id
+    :param csv_url: csv file url
+    :param max_body_weight: upper limit of a valid body weight
+    :param proxy: http proxy for the download
 
+    :return: number of imported rows, number of rows that replaced existing entries
+    """
+    records: dict[date_type, float] = {}
+    with timed(stage_seconds, stage='csv_parse'):
+        async with aiohttp.ClientSession() as session:
+            async with session.get(csv_url, proxy=proxy) as response:
+                response.raise_for_status()
+                async for line in response.content:
+                    try:
+                        line = line.decode('utf-8')
+                    except UnicodeDecodeError:
+                        raise CSVParsingError()
+                    date, body_weight = parse_csv_row(line, max_body_weight)
+                    records[date] = body_weight
+
+    added = {day_number(date): body_weight for date, body_weight in records.items()}
+    async with transaction() as db:
+        async with db.execute(f"SELECT day, body_mass FROM {sqlite_db_users_mass} WHERE user_id = ?",
+                              (user_id,)) as cursor:
+            existing = dict(await cursor.fetchall())
+        replaced = {day: existing[day] for day in added if day in existing}
+
+        query = f"INSERT OR REPLACE INTO {sqlite_db_users_mass} (user_id, day, body_mass) " \
+                f"VALUES (?, ?, ?);"
+        await db.executemany(query, [(user_id, day, body_weight) for day, body_weight in added.items()])
+
+        await update_user_stats(db, user_id, added, replaced)
+    bump_data_version(user_id)
+
+    return len(records), len(replaced)
@@ -0,0 +1,47 @@
+import asyncio
+from contextlib import asynccontextmanager
+from typing import AsyncIterator
+
+
+class ChatDispatcher:
+    """Serializes handlers per chat and caps how many of them run at once.
+
+    Updates of the same chat are handled one at a time in arrival order. Heavy handlers
+    (plots, imports) and light ones (menus, text replies) have separate limits, and both
+    share a global limit.
+    """
+
+    def __init__(self, max_handlers: int, max_heavy_handlers: int, max_light_handlers: int):
+        self._chat_locks: dict[int, asyncio.Lock] = {}
+        self._chat_users: dict[int, int] = {}
+        self._handlers = asyncio.Semaphore(max_handlers)
+        self._heavy_handlers = asyncio.Semaphore(max_heavy_handlers)
+        self._light_handlers = asyncio.Semaphore(max_light_handlers)
+        self.in_flight = 0
+
+    @asynccontextmanager
+    async def chat(self, chat_id: int) -> AsyncIterator[None]:
+        """Hold the chat's lock. The lock is dropped as soon as no update of the chat is waiting for it."""
+        lock = self._chat_locks.get(chat_id)
+        if lock is None:
+            lock = self._chat_locks[chat_id] = asyncio.Lock()
+        self._chat_users[chat_id] = self._chat_users.get(chat_id, 0) + 1
+        try:
+            async with lock:
+                yield
+        finally:
+            self._chat_users[chat_id] -= 1
+            if self._chat_users[chat_id] == 0:
+                del self._chat_users[chat_id]
+                del self._chat_locks[chat_id]
+
+    @asynccontextmanager
+    async def slot(self, heavy: bool) -> AsyncIterator[None]:
+        """Wait for a free handler slot of the given class."""
+        async with self._heavy_handlers if heavy else self._light_handlers:
+            async with self._handlers:
+                self.in_flight += 1
+                try:
+                    yield
+                finally:
+                    self.in_flight -= 1
@@ -1,9 +1,11 @@
 COMMAND_LIST = "/enter_weight - enter current weight\n\n" \
                "/plot - show plot (2 weeks) \n" \
                "/plot_all - show plot (all time) \n" \
+               "/stats - progress over 7, 30, 90, 365 days and all time \n" \
                "/download - download data (*.csv) \n" \
                "/upload - upload data (*.csv)\n" \
-               "/erase - erase all data \n\n" \
+               "/erase - erase all data \n" \
+               "/remind - daily weigh-in reminder \n\n" \
                "/start - show menu \n\n" \
                "/info - info and advice on how to use this bot"
 
@@ -0,0 +1,70 @@
+"""Encoding of the plot images, in the format selected with configure_plot_image().
+
+The plots are flat colours with antialiased text, so a palette PNG is usually both the smallest
+and a lossless encoding; JPEG is the fastest and WebP the smallest for dense plots. Every encoding
+is timed and measured per format in bodymass_image_encode_seconds and bodymass_image_bytes.
+
+Imports Pillow, so it is loaded lazily, in the render thread.
+"""
+import io
+import time
+from typing import BinaryIO
+
+from PIL import Image
+
+import src.plotting
+from src.metrics import Histogram, stage_seconds, timed
+
+palette_colors = 256
+
+image_encode_seconds = Histogram('bodymass_image_encode_seconds', 'Time to encode a plot image.', ('format',),
+                                 buckets=(0.002, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5))
+image_bytes = Histogram('bodymass_image_bytes', 'Size of the encoded plot images.', ('format',),
+                        buckets=(8192, 16384, 32768, 65536, 131072, 262144, 524288, 1048576))
+
+
+def encode_image(image: Image.Image, image_format: str, quality: int) -> bytes:
+    """image (RGB) in one of the formats of src.plotting.plot_image_formats except 'auto'."""
+    start = time.perf_counter()
+    output = io.BytesIO()
+    if image_format == 'png':
+        image.save(output, format='png')
+    elif image_format == 'palette':
+        image.quantize(palette_colors, method=Image.Quantize.FASTOCTREE).save(output, format='png')
+    elif image_format == 'jpeg':
+        image.save(output, format='jpeg', quality=quality)
+    elif image_format == 'webp':
+        image.save(output, format='webp', quality=quality)
+    else:
+        raise ValueError(f"Unknown image format {image_format!r}")
+    encoded = output.getvalue()
+    image_encode_seconds.observe(time.perf_counter() - start, format=image_format)
+    image_bytes.observe(len(encoded), format=image_format)
+    return encoded
+
+
+def encode_auto(image: Image.Image, formats: tuple[str, ...], quality: int, budget: int) -> tuple[str, bytes]:
+    """The first of formats whose encoding fits in budget bytes, the smallest one if none does."""
+    smallest = None
+    for image_format in formats:
+        encoded = encode_image(image, image_format, quality)
+        if len(encoded) <= budget:
+            return image_format, encoded
+        if smallest is None or len(encoded) < len(smallest[1]):
+            smallest = image_format, encoded
+    return smallest
+
+
+def encode_plot_image(image: Image.Image, file_object: BinaryIO) -> str:
+    """Write the plot image in the configured format. Returns the format used."""
+    with timed(stage_seconds, stage='image_encode'):
+        if image.mode != 'RGB':
+            image = image.convert('RGB')
+        image_format = src.plotting.plot_image_format
+        if image_format == 'auto':
+            image_format, encoded = encode_auto(image, src.plotting.plot_auto_formats,
+                                                src.plotting.plot_image_quality, src.plotting.plot_image_budget)
+        else:
+            encoded = encode_image(image, image_format, src.plotting.plot_image_quality)
+        file_object.write(encoded)
+    return image_format
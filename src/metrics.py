@@ -0,0 +1,180 @@
+"""In-process metrics exposed in the Prometheus text format.
+
+Metrics are plain counters, gauges and histograms kept in memory. Recording a value costs a
+lock and a few additions, so instrumentation stays on in production.
+"""
+import asyncio
+import bisect
+import os
+import resource
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Iterator
+
+from aiohttp import web
+from telebot import logger
+
+default_buckets = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+_registry: list['_Metric'] = []
+
+
+class _Metric:
+    kind = ''
+
+    def __init__(self, name: str, documentation: str, labels: tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def _label_values(self, labels: dict) -> tuple:
+        return tuple(str(labels[label]) for label in self.labels)
+
+    def _format_labels(self, values: tuple, extra: str = '') -> str:
+        pairs = [f'{label}="{value}"' for label, value in zip(self.labels, values)]
+        if extra:
+            pairs.append(extra)
+        return '{' + ','.join(pairs) + '}' if pairs else ''
+
+    def samples(self) -> Iterator[str]:
+        raise NotImplementedError
+
+    def exposition(self) -> str:
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.kind}']
+        lines.extend(self.samples())
+        return '\n'.join(lines)
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def __init__(self, name: str, documentation: str, labels: tuple[str, ...] = ()):
+        super().__init__(name, documentation, labels)
+        self._values: dict[tuple, float] = {}
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = self._label_values(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels) -> float:
+        return self._values.get(self._label_values(labels), 0)
+
+    def samples(self) -> Iterator[str]:
+        if not self.labels and not self._values:
+            yield f'{self.name} 0'
+        for values, value in sorted(self._values.items()):
+            yield f'{self.name}{self._format_labels(values)} {value}'
+
+
+class Gauge(_Metric):
+    """A value read from a callback at collection time."""
+    kind = 'gauge'
+
+    def __init__(self, name: str, documentation: str, callback: Callable[[], float]):
+        super().__init__(name, documentation)
+        self.callback = callback
+
+    def samples(self) -> Iterator[str]:
+        yield f'{self.name} {self.callback()}'
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labels: tuple[str, ...] = (),
+                 buckets: tuple[float, ...] = default_buckets):
+        super().__init__(name, documentation, labels)
+        self.buckets = buckets
+        # label values -> [count per bucket (the last one is +Inf), sum]
+        self._values: dict[tuple, list] = {}
+
+    def observe(self, value: float, **labels) -> None:
+        key = self._label_values(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self._values.get(key)
+            if counts is None:
+                counts = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            counts[0][index] += 1
+            counts[1] += value
+
+    def summary(self) -> dict[tuple, tuple[int, float]]:
+        """Label values -> (count, sum)."""
+        with self._lock:
+            return {key: (sum(counts[0]), counts[1]) for key, counts in self._values.items()}
+
+    def samples(self) -> Iterator[str]:
+        with self._lock:
+            values = sorted((key, (list(counts[0]), counts[1])) for key, counts in self._values.items())
+        for key, (bucket_counts, total) in values:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float('inf'),), bucket_counts):
+                cumulative += bucket_count
+                le = 'le="{}"'.format('+Inf' if bound == float('inf') else repr(bound))
+                yield f'{self.name}_bucket{self._format_labels(key, le)} {cumulative}'
+            yield f'{self.name}_sum{self._format_labels(key)} {total}'
+            yield f'{self.name}_count{self._format_labels(key)} {cumulative}'
+
+
+@contextmanager
+def timed(histogram: Histogram, **labels) -> Iterator[None]:
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        histogram.observe(time.perf_counter() - start, **labels)
+
+
+def process_rss_bytes() -> int:
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        # Peak instead of current RSS where /proc is not available (kilobytes on Linux, bytes on macOS)
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+stage_seconds = Histogram('bodymass_stage_seconds', 'Time spent in a handling stage.', ('stage',))
+command_seconds = Histogram('bodymass_command_seconds', 'Time to handle a message, by command.', ('command',))
+errors_total = Counter('bodymass_errors_total', 'Unexpected errors while handling a message.', ('command',))
+csv_parsing_errors_total = Counter('bodymass_csv_parsing_errors_total', 'Uploaded csv tables that failed to parse.')
+process_rss = Gauge('bodymass_process_resident_memory_bytes', 'Resident memory of the bot process.',
+                    process_rss_bytes)
+
+
+def render_metrics() -> str:
+    return '\n'.join(metric.exposition() for metric in _registry) + '\n'
+
+
+async def start_metrics_server(host: str, port: int) -> web.AppRunner:
+    async def serve_metrics(request: web.Request) -> web.Response:
+        return web.Response(text=render_metrics(), content_type='text/plain', charset='utf-8',
+                            headers={'X-Content-Type-Options': 'nosniff'})
+
+    app = web.Application()
+    app.router.add_get('/metrics', serve_metrics)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    logger.info("Serving metrics on %s:%d/metrics", host, port)
+    return runner
+
+
+async def log_metrics_periodically(interval: float) -> None:
+    """Log a one-line summary of the handled commands every interval seconds."""
+    previous: dict[tuple, tuple[int, float]] = {}
+    while True:
+        await asyncio.sleep(interval)
+        current = command_seconds.summary()
+        parts = []
+        for key, (count, total) in sorted(current.items()):
+            previous_count, previous_total = previous.get(key, (0, 0.0))
+            if count > previous_count:
+                mean_ms = (total - previous_total) / (count - previous_count) * 1000
+                parts.append(f"{key[0]}={count - previous_count} ({mean_ms:.0f} ms)")
+        previous = current
+        logger.info("Metrics: %s; rss=%.1f MB", ', '.join(parts) or 'no messages', process_rss_bytes() / 2 ** 20)
@@ -0,0 +1,261 @@
+"""Online migration of the body mass records to the compact schema.
+
+Schema version 1 keeps users_mass in a rowid table with TEXT user ids, '%Y/%m/%d' date strings and
+two extra indexes. Version 2 keeps INTEGER chat ids and day numbers in a WITHOUT ROWID table
+clustered on (user_id, day) and records the version in the schema_version table.
+
+The migration takes two steps:
+
+1. ``python -m src.migration`` while the old bot keeps running. It creates the new table next to
+   the old one, with triggers that mirror every write into it. Then it copies the existing records
+   in small batches, each in its own short transaction, and reports the size of both tables and the
+   time of a per-user query on each. It can be interrupted and rerun.
+2. Start the new bot. On startup, finish_migration() copies whatever is left, replaces the old
+   table and rebuilds the stats table. Without step 1 the whole copy happens there.
+
+``python -m src.migration --finish`` does step 2 with the bot stopped and VACUUMs the file.
+"""
+import argparse
+import asyncio
+import os
+import sqlite3
+import sys
+import time
+from typing import Optional
+
+import aiosqlite
+
+import src.database
+from src.database import fetchall, fetchone, close_connection, get_connection, transaction
+
+current_schema_version = 2
+
+sqlite_db_users_mass = 'users_mass'
+sqlite_db_users_mass_stats = 'users_mass_stats'
+sqlite_db_schema_version = 'schema_version'
+sqlite_db_users_mass_v2 = 'users_mass_v2'
+sqlite_db_migration_progress = 'schema_migration'
+
+migration_batch_size = 5000
+migration_pause = 0.05  # seconds between batches, leaves the database to the bot
+
+_create_v2_table_query = f"""
+    CREATE TABLE IF NOT EXISTS {sqlite_db_users_mass_v2} (
+        user_id   INTEGER NOT NULL,
+        day       INTEGER NOT NULL,
+        body_mass REAL    NOT NULL,
+        PRIMARY KEY (user_id, day)
+    ) WITHOUT ROWID
+"""
+
+
+def _v1_day(row: str = '') -> str:
+    return f"CAST(julianday(replace({row}date, '/', '-')) - 2440587.5 AS INTEGER)"
+
+
+def _v1_to_v2(row: str = '') -> str:
+    """Select a version 1 row as a version 2 row. Rows with an invalid date or no body mass are skipped."""
+    return f"SELECT CAST({row}user_id AS INTEGER), {_v1_day(row)}, {row}body_mass " \
+           f"WHERE {_v1_day(row)} IS NOT NULL AND {row}body_mass IS NOT NULL"
+
+
+_mirror_insert = f"INSERT OR REPLACE INTO {sqlite_db_users_mass_v2} (user_id, day, body_mass) {_v1_to_v2('NEW.')};"
+_mirror_delete = f"DELETE FROM {sqlite_db_users_mass_v2} " \
+                 f"WHERE user_id = CAST(OLD.user_id AS INTEGER) AND day = {_v1_day('OLD.')};"
+
+_mirror_triggers = {
+    'users_mass_v2_insert': f"AFTER INSERT ON {sqlite_db_users_mass} BEGIN {_mirror_insert} END",
+    'users_mass_v2_update': f"AFTER UPDATE ON {sqlite_db_users_mass} BEGIN {_mirror_delete} {_mirror_insert} END",
+    'users_mass_v2_delete': f"AFTER DELETE ON {sqlite_db_users_mass} BEGIN {_mirror_delete} END",
+}
+
+
+async def _table_exists(name: str) -> bool:
+    return await fetchone("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (name,)) is not None
+
+
+async def _table_columns(name: str) -> set[str]:
+    return {row[1] for row in await fetchall(f"PRAGMA table_info({name})")}
+
+
+async def fetch_schema_version() -> Optional[int]:
+    """Schema version of the database, None for an empty database.
+
+    Without a version row the version is told from the records table: version 1 has record_id and
+    date columns.
+    """
+    if await _table_exists(sqlite_db_schema_version):
+        row = await fetchone(f"SELECT MAX(version) FROM {sqlite_db_schema_version}")
+        if row is not None and row[0] is not None:
+            return row[0]
+    columns = await _table_columns(sqlite_db_users_mass)
+    if not columns:
+        return None
+    return 1 if {'record_id', 'date'} & columns else current_schema_version
+
+
+async def set_schema_version(db: aiosqlite.Connection, version: int) -> None:
+    await db.execute(f"DELETE FROM {sqlite_db_schema_version}")
+    await db.execute(f"INSERT INTO {sqlite_db_schema_version} (version) VALUES (?)", (version,))
+
+
+async def _create_v2_table(db: aiosqlite.Connection) -> None:
+    await db.execute(_create_v2_table_query)
+    await db.execute(f"CREATE TABLE IF NOT EXISTS {sqlite_db_migration_progress} (copied_record_id INTEGER NOT NULL)")
+    async with db.execute(f"SELECT 1 FROM {sqlite_db_migration_progress}") as cursor:
+        if await cursor.fetchone() is None:
+            await db.execute(f"INSERT INTO {sqlite_db_migration_progress} (copied_record_id) VALUES (0)")
+
+
+async def start_migration() -> None:
+    """Create the version 2 table and the triggers that keep it in sync with the version 1 table."""
+    async with transaction() as db:
+        await _create_v2_table(db)
+        for name, definition in _mirror_triggers.items():
+            await db.execute(f"CREATE TRIGGER IF NOT EXISTS {name} {definition}")
+
+
+async def _copy_records(db: aiosqlite.Connection, batch_size: Optional[int]) -> int:
+    """Copy the next batch of version 1 records, all of them if batch_size is None.
+
+    Records are copied in record_id order. Newer records have higher ids, and the triggers mirror
+    every change to the records already copied, so the copy never misses a write.
+
+    :return: number of version 1 records read
+    """
+    async with db.execute(f"SELECT copied_record_id FROM {sqlite_db_migration_progress}") as cursor:
+        copied_record_id = (await cursor.fetchone())[0]
+    async with db.execute(f"SELECT COUNT(*), MAX(record_id) FROM (SELECT record_id FROM {sqlite_db_users_mass} "
+                          f"WHERE record_id > ? ORDER BY record_id LIMIT ?)",
+                          (copied_record_id, -1 if batch_size is None else batch_size)) as cursor:
+        count, last_record_id = await cursor.fetchone()
+    if count == 0:
+        return 0
+
+    await db.execute(f"INSERT OR IGNORE INTO {sqlite_db_users_mass_v2} (user_id, day, body_mass) "
+                     f"SELECT CAST(user_id AS INTEGER), {_v1_day()}, body_mass FROM {sqlite_db_users_mass} "
+                     f"WHERE record_id > ? AND record_id <= ? AND {_v1_day()} IS NOT NULL "
+                     f"AND body_mass IS NOT NULL", (copied_record_id, last_record_id))
+    await db.execute(f"UPDATE {sqlite_db_migration_progress} SET copied_record_id = ?", (last_record_id,))
+    return count
+
+
+async def copy_records(batch_size: int = migration_batch_size, pause: float = migration_pause) -> int:
+    """Copy all version 1 records in batches, one transaction per batch.
+
+    :return: number of version 1 records read
+    """
+    total = 0
+    while True:
+        async with transaction() as db:
+            copied = await _copy_records(db, batch_size)
+        if copied == 0:
+            return total
+        total += copied
+        print(f"Copied {total} records", file=sys.stderr)
+        await asyncio.sleep(pause)
+
+
+async def finish_migration(db: aiosqlite.Connection) -> None:
+    """Copy the remaining records, replace the version 1 table and record the new version.
+
+    The old bot must not be running. The stats table is dropped, to be rebuilt with integer user ids.
+    """
+    await _create_v2_table(db)
+    await _copy_records(db, None)
+
+    for name in _mirror_triggers:
+        await db.execute(f"DROP TRIGGER IF EXISTS {name}")
+    await db.execute(f"DROP TABLE {sqlite_db_users_mass}")
+    await db.execute(f"ALTER TABLE {sqlite_db_users_mass_v2} RENAME TO {sqlite_db_users_mass}")
+    await db.execute(f"DROP TABLE {sqlite_db_migration_progress}")
+    await db.execute(f"DROP TABLE IF EXISTS {sqlite_db_users_mass_stats}")
+    await db.execute(f"CREATE TABLE IF NOT EXISTS {sqlite_db_schema_version} (version INTEGER NOT NULL)")
+    await set_schema_version(db, current_schema_version)
+
+
+async def _table_sizes() -> Optional[dict[str, int]]:
+    """Bytes used by each table together with its indexes, None if SQLite is built without dbstat."""
+    try:
+        rows = await fetchall("SELECT tbl_name, SUM(pgsize) FROM dbstat JOIN sqlite_master USING (name) "
+                              "GROUP BY tbl_name")
+    except sqlite3.OperationalError:
+        return None
+    return dict(rows)
+
+
+async def _time_user_queries(query: str, user_ids: list, repeat: int = 3) -> float:
+    """Best mean time of query over user_ids, seconds."""
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for user_id in user_ids:
+            await fetchall(query, (user_id,))
+        best = min(best, (time.perf_counter() - start) / max(1, len(user_ids)))
+    return best
+
+
+async def report_migration() -> None:
+    sizes = await _table_sizes()
+    if sizes is not None:
+        old_size, new_size = sizes.get(sqlite_db_users_mass, 0), sizes.get(sqlite_db_users_mass_v2, 0)
+        print(f"users_mass: {old_size / 2 ** 20:.2f} MB, compact table: {new_size / 2 ** 20:.2f} MB"
+              + (f" ({new_size / old_size:.0%})" if old_size else ""))
+
+    old_count = (await fetchone(f"SELECT COUNT(*) FROM {sqlite_db_users_mass}"))[0]
+    new_count = (await fetchone(f"SELECT COUNT(*) FROM {sqlite_db_users_mass_v2}"))[0]
+    print(f"Records: {old_count}, copied: {new_count}"
+          + (f" ({old_count - new_count} invalid records skipped)" if new_count < old_count else ""))
+
+    user_ids = [row[0] for row in await fetchall(f"SELECT user_id FROM {sqlite_db_users_mass_v2} "
+                                                 f"GROUP BY user_id ORDER BY random() LIMIT 100")]
+    if user_ids:
+        old_time = await _time_user_queries(f"SELECT date, body_mass FROM {sqlite_db_users_mass} "
+                                            f"WHERE user_id = ? ORDER BY date", [str(i) for i in user_ids])
+        new_time = await _time_user_queries(f"SELECT day, body_mass FROM {sqlite_db_users_mass_v2} "
+                                            f"WHERE user_id = ? ORDER BY day", user_ids)
+        print(f"History of a user: {old_time * 1000:.3f} ms, compact table: {new_time * 1000:.3f} ms "
+              f"({len(user_ids)} users)")
+
+
+async def _main(arguments: argparse.Namespace) -> int:
+    src.database.sqlite_db_path = arguments.database
+    try:
+        version = await fetch_schema_version()
+        if version != 1:
+            print(f"Nothing to migrate, schema version {version}")
+            return 0
+
+        if arguments.finish:
+            from src.datautils import init_database
+            size_before = os.path.getsize(arguments.database)
+            await init_database()
+            db = await get_connection()
+            await db.execute('VACUUM')
+            # In WAL mode the vacuumed database is in the write-ahead log until a checkpoint
+            await db.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+            print(f"Migrated to schema version {current_schema_version}, file size "
+                  f"{size_before / 2 ** 20:.2f} MB -> {os.path.getsize(arguments.database) / 2 ** 20:.2f} MB")
+            return 0
+
+        await start_migration()
+        copied = await copy_records(arguments.batch_size, arguments.pause)
+        print(f"Copied {copied} records. Start the new version of the bot to finish the migration.")
+        await report_migration()
+        return 0
+    finally:
+        await close_connection()
+
+
+def parse_arguments() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Migrate the records to the compact schema.")
+    parser.add_argument('--database', default=src.database.sqlite_db_path)
+    parser.add_argument('--batch-size', type=int, default=migration_batch_size)
+    parser.add_argument('--pause', type=float, default=migration_pause, help='seconds between batches')
+    parser.add_argument('--finish', action='store_true',
+                        help='replace the old table and VACUUM, the bot must be stopped')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    sys.exit(asyncio.run(_main(parse_arguments())))
@@ -0,0 +1,64 @@
+"""matplotlib plot renderer.
+
+Only the object-oriented matplotlib API with the Agg canvas is used: no pyplot, no GUI backend.
+"""
+import os
+import time
+from typing import BinaryIO, Optional, Sequence
+
+os.environ.setdefault('MPLBACKEND', 'Agg')
+
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.dates import DateFormatter
+from matplotlib.figure import Figure
+import numpy as np
+from PIL import Image
+
+import src.plotting
+from src.imageencoding import encode_plot_image
+from src.metrics import stage_seconds
+
+
+def draw_plot_mass(day: Sequence[float], mass: Sequence[float], file_object: BinaryIO,
+                   regression_coef: Optional[Sequence[float]] = None,
+                   band: Optional[tuple[Sequence[float], Sequence[float]]] = None) -> Optional[Sequence[float]]:
+    render_start = time.perf_counter()
+    # Day numbers are matplotlib date numbers with the default 1970-01-01 epoch
+    x = np.asarray(day, dtype=np.float64)
+    y = np.asarray(mass, dtype=np.float64)
+
+    if regression_coef is None:
+        regression_coef = np.polyfit(x, y, 1) if len(x) > 1 else None
+    regression_func = np.poly1d(regression_coef) if len(x) > 1 else None
+
+    fig = Figure(figsize=[8, 5], dpi=src.plotting.plot_dpi)
+    canvas = FigureCanvasAgg(fig)
+    ax = fig.subplots()
+
+    if band is not None:
+        ax.fill_between(x, band[0], band[1], color='C0', alpha=0.3, linewidth=0)
+    ax.scatter(x, y)
+
+    if len(x) > 1:
+        lowest, highest = (np.min(band[0]), np.max(band[1])) if band is not None else (np.min(y), np.max(y))
+        limits = (lowest // 5 * 5 - 6, highest // 5 * 5 + 6)
+    else:
+        limits = (64, 76)
+
+    ax.set_ylim(limits)
+
+    if len(x) > 1:
+        ax.plot(x, regression_func(x))
+
+    ax.set_ylabel('Bodyweight, kg')
+
+    ax.xaxis.set_major_formatter(DateFormatter('%d %b'))
+    ax.tick_params(axis='x', labelrotation=45)
+    ax.grid()
+    fig.tight_layout()
+    canvas.draw()
+    stage_seconds.observe(time.perf_counter() - render_start, stage='plot_render')
+
+    encode_plot_image(Image.frombuffer('RGBA', canvas.get_width_height(), canvas.buffer_rgba()), file_object)
+
+    return regression_coef
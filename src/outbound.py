@@ -0,0 +1,264 @@
+"""Outbound queue for the messages the bot sends.
+
+Telegram accepts about 30 messages a second from a bot and about one a second in a chat, and
+answers faster senders with 429 Too Many Requests and the number of seconds to wait. Every send
+goes through an OutboundQueue, which keeps under these limits with token buckets, retries the
+rejected calls after the delay Telegram asks for and sends text ahead of photo and document uploads.
+"""
+import asyncio
+import bisect
+import itertools
+from typing import Any, Awaitable, Callable, Optional
+
+from telebot import logger
+from telebot.asyncio_helper import ApiTelegramException
+
+from src.metrics import Counter, stage_seconds, timed
+
+text_priority = 0
+upload_priority = 1
+background_priority = 2  # messages nobody is waiting for, such as reminders
+
+# Buckets of idle chats are dropped once there are more of them than this
+max_idle_chat_buckets = 1024
+# A 429 is taken for the global limit when this many chats got one within retry_after, or when the
+# chat's previous send was longer ago than this many of its send intervals
+global_limit_chats = 3
+global_limit_chat_intervals = 2
+
+telegram_retries_total = Counter('bodymass_telegram_retries_total',
+                                 'Telegram API calls retried after a 429 Too Many Requests response.')
+
+
+class TokenBucket:
+    """rate tokens a second, at most burst of them stored."""
+
+    def __init__(self, rate: float, burst: float, now: float):
+        self.rate = rate
+        self.burst = max(1.0, burst)
+        self.tokens = self.burst
+        self.updated = now
+        self.blocked_until = 0.0
+        self.last_taken: Optional[float] = None
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, now: float) -> float:
+        """Seconds until a token can be taken, 0 if it can be taken now."""
+        self._refill(now)
+        return max(0.0, self.blocked_until - now, (1 - self.tokens) / self.rate)
+
+    def take(self, now: float) -> None:
+        self._refill(now)
+        self.tokens -= 1
+        self.last_taken = now
+
+    def block(self, until: float) -> None:
+        """Give out no tokens until the given time."""
+        self.blocked_until = max(self.blocked_until, until)
+        self.tokens = min(self.tokens, 0.0)
+
+    def idle(self, now: float) -> bool:
+        self._refill(now)
+        return self.tokens >= self.burst and self.blocked_until <= now
+
+
+class _Call:
+    __slots__ = ('priority', 'sequence', 'chat_id', 'call', 'future', 'queued_at', 'retries',
+                 'chat_send_gap')
+
+    def __init__(self, priority: int, sequence: int, chat_id: int, call: Callable[[], Awaitable],
+                 future: asyncio.Future, queued_at: float):
+        self.priority = priority
+        self.sequence = sequence
+        self.chat_id = chat_id
+        self.call = call
+        self.future = future
+        self.queued_at = queued_at
+        self.retries = 0
+        self.chat_send_gap: Optional[float] = None  # seconds since the chat's previous call went out
+
+    def __lt__(self, other: '_Call') -> bool:
+        return (self.priority, self.sequence) < (other.priority, other.sequence)
+
+
+def _retry_after(exception: ApiTelegramException) -> float:
+    parameters = exception.result_json.get('parameters') if isinstance(exception.result_json, dict) else None
+    return float((parameters or {}).get('retry_after', 1))
+
+
+class OutboundQueue:
+    """Sends API calls in priority order within the global and per-chat rate limits.
+
+    Calls of the same chat go out one at a time in the order they were queued. Across chats the
+    call with the lowest priority number goes first, then the oldest one. A call rejected with
+    429 Too Many Requests holds its chat for retry_after seconds and is retried up to max_retries
+    times. Telegram does not say which limit a 429 is for; it is taken for the global limit, and
+    every chat is held, when global_limit_chats chats got one within retry_after or when the chat
+    had sent nothing for global_limit_chat_intervals of its send intervals. Other errors are raised
+    to the caller. When max_pending calls are queued or in flight,
+    send() waits for one of them to complete, which slows the handlers down instead of dropping replies.
+    """
+
+    def __init__(self, rate: float, chat_rate: float, chat_burst: float, max_pending: int, max_retries: int):
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_retries = max_retries
+        # No burst overall: rate messages in any second, evenly spaced
+        self._bucket = TokenBucket(rate, 1, 0.0)
+        self._chat_buckets: dict[int, TokenBucket] = {}
+        self._rejected_chats: dict[int, float] = {}  # chat_id -> time of its last 429
+        self._slots = asyncio.Semaphore(max_pending)
+        self._queued: list[_Call] = []  # sorted by priority, then sequence
+        self._sending: set[int] = set()  # chats with a call in flight
+        self._sequence = itertools.count()
+        self._wakeup = asyncio.Event()
+        self._scheduler: Optional[asyncio.Task] = None
+        self._send_tasks: set[asyncio.Task] = set()
+
+    def set_rate(self, rate: float) -> None:
+        """Change the global rate, e.g. to a worker process's share of the bot's limit."""
+        self._bucket.rate = rate
+
+    @property
+    def queued(self) -> int:
+        return len(self._queued)
+
+    async def send(self, chat_id: int, call: Callable[[], Awaitable], priority: int = text_priority) -> Any:
+        """Queue call() and return its result once it has been sent."""
+        async with self._slots:
+            loop = asyncio.get_running_loop()
+            if self._scheduler is None:
+                self._scheduler = asyncio.create_task(self._schedule())
+            queued_call = _Call(priority, next(self._sequence), chat_id, call, loop.create_future(), loop.time())
+            bisect.insort(self._queued, queued_call)
+            self._wakeup.set()
+            try:
+                return await queued_call.future
+            except asyncio.CancelledError:
+                if queued_call in self._queued:
+                    self._queued.remove(queued_call)
+                raise
+
+    async def _schedule(self) -> None:
+        while True:
+            self._wakeup.clear()
+            delay = self._start_ready_calls()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
+
+    def _chat_bucket(self, chat_id: int, now: float) -> TokenBucket:
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            bucket = self._chat_buckets[chat_id] = TokenBucket(self.chat_rate, self.chat_burst, now)
+        return bucket
+
+    def _start_ready_calls(self) -> Optional[float]:
+        """Start every call the limits allow now.
+
+        :return: seconds until the next queued call may be allowed, None if no call can go before
+            a call in flight completes
+        """
+        now = asyncio.get_running_loop().time()
+        if len(self._chat_buckets) > max_idle_chat_buckets:
+            self._chat_buckets = {chat_id: bucket for chat_id, bucket in self._chat_buckets.items()
+                                  if chat_id in self._sending or not bucket.idle(now)}
+
+        # Only the oldest call of a chat may go, so the chat sees its messages in order
+        oldest_calls: dict[int, int] = {}
+        for queued_call in self._queued:
+            if queued_call.chat_id not in self._sending:
+                oldest_calls[queued_call.chat_id] = min(oldest_calls.get(queued_call.chat_id, queued_call.sequence),
+                                                        queued_call.sequence)
+
+        delay = None
+        for queued_call in list(self._queued):
+            if oldest_calls.get(queued_call.chat_id) != queued_call.sequence:
+                continue
+            global_delay = self._bucket.delay(now)
+            if global_delay > 0:
+                return global_delay if delay is None else min(delay, global_delay)
+            chat_delay = self._chat_bucket(queued_call.chat_id, now).delay(now)
+            if chat_delay > 0:
+                delay = chat_delay if delay is None else min(delay, chat_delay)
+                continue
+
+            chat_bucket = self._chat_buckets[queued_call.chat_id]
+            if chat_bucket.last_taken is not None:
+                queued_call.chat_send_gap = now - chat_bucket.last_taken
+            self._bucket.take(now)
+            chat_bucket.take(now)
+            self._queued.remove(queued_call)
+            self._sending.add(queued_call.chat_id)
+            stage_seconds.observe(now - queued_call.queued_at, stage='outbound_queue')
+            task = asyncio.create_task(self._send(queued_call))
+            self._send_tasks.add(task)
+            task.add_done_callback(self._send_tasks.discard)
+        return delay
+
+    def _global_limit_hit(self, queued_call: _Call, now: float, retry_after: float) -> bool:
+        """Whether a 429 for the call looks like the global limit rather than its chat's."""
+        self._rejected_chats = {chat_id: rejected_at for chat_id, rejected_at in self._rejected_chats.items()
+                                if rejected_at > now - retry_after}
+        self._rejected_chats[queued_call.chat_id] = now
+        if len(self._rejected_chats) >= global_limit_chats:
+            return True
+        gap = queued_call.chat_send_gap
+        return gap is None or gap > global_limit_chat_intervals / self.chat_rate
+
+    async def _send(self, queued_call: _Call) -> None:
+        try:
+            with timed(stage_seconds, stage='telegram_send'):
+                result = await queued_call.call()
+        except ApiTelegramException as exception:
+            if exception.error_code == 429 and queued_call.retries < self.max_retries \
+                    and not queued_call.future.done():
+                retry_after = _retry_after(exception)
+                telegram_retries_total.inc()
+                now = asyncio.get_running_loop().time()
+                if self._global_limit_hit(queued_call, now, retry_after):
+                    logger.warning("Too many requests, holding every chat for %.0f s", retry_after)
+                    self._bucket.block(now + retry_after)
+                else:
+                    logger.warning("Too many requests to chat %s, retrying in %.0f s", queued_call.chat_id,
+                                   retry_after)
+                self._chat_bucket(queued_call.chat_id, now).block(now + retry_after)
+                queued_call.retries += 1
+                bisect.insort(self._queued, queued_call)
+            elif not queued_call.future.done():
+                queued_call.future.set_exception(exception)
+        except asyncio.CancelledError:
+            queued_call.future.cancel()
+            raise
+        except Exception as exception:
+            if not queued_call.future.done():
+                queued_call.future.set_exception(exception)
+        else:
+            if not queued_call.future.done():
+                queued_call.future.set_result(result)
+        finally:
+            self._sending.discard(queued_call.chat_id)
+            self._wakeup.set()
+
+    async def close(self, timeout: float) -> None:
+        """Send the queued calls within timeout seconds, then stop. Calls left over fail with CancelledError."""
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        while (self._queued or self._sending) and loop.time() < deadline:
+            await asyncio.sleep(0.05)
+        if self._queued or self._sending:
+            logger.warning("%d outgoing messages were not sent", len(self._queued) + len(self._sending))
+        for task in list(self._send_tasks):
+            task.cancel()
+        await asyncio.gather(*self._send_tasks, return_exceptions=True)
+        if self._scheduler is not None:
+            self._scheduler.cancel()
+            await asyncio.gather(self._scheduler, return_exceptions=True)
+            self._scheduler = None
+        for queued_call in self._queued:
+            queued_call.future.cancel()
+        self._queued.clear()
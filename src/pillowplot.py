@@ -0,0 +1,219 @@
+"""Pillow plot renderer.
+
+Draws the same chart as the matplotlib renderer (default matplotlib style, 8x5 inches at
+src.plotting.plot_dpi, tight layout) directly with Pillow, without loading matplotlib or numpy.
+Tick positions follow matplotlib's default locator, so the axes show the same ticks and labels.
+
+Needs the DejaVu Sans font: either installed system-wide or the copy bundled with matplotlib.
+Importing the module raises OSError if neither is found.
+"""
+import math
+import os
+import time
+from datetime import datetime, timedelta
+from importlib.util import find_spec
+from typing import BinaryIO, Optional, Sequence
+
+from PIL import Image, ImageDraw, ImageFont
+
+import src.plotting
+from src.imageencoding import encode_plot_image
+from src.metrics import stage_seconds
+
+figure_size = (8, 5)  # inches
+dpi = src.plotting.plot_dpi
+point = dpi / 72  # pixels
+
+font_size = 10 * point
+tick_length = 3.5 * point
+tick_width = 0.8 * point
+tick_pad = 3.5 * point
+label_pad = 4 * point
+spine_width = 0.8 * point
+grid_width = 0.8 * point
+line_width = 1.5 * point
+marker_diameter = (6 + 1.5) * point  # marker size plus its edge
+layout_pad = 1.08 * font_size
+axis_margin = 0.05
+max_bins = 9
+
+marker_color = '#1f77b4'
+line_color = '#1f77b4'
+band_color = '#bcd6e8'  # marker color at 30% opacity over white
+grid_color = '#b0b0b0'
+text_color = 'black'
+
+epoch = datetime(1970, 1, 1)
+
+
+def _load_font() -> ImageFont.FreeTypeFont:
+    try:
+        return ImageFont.truetype('DejaVuSans.ttf', round(font_size))
+    except OSError:
+        # matplotlib ships the font; find_spec locates the package without importing it
+        matplotlib_spec = find_spec('matplotlib')
+        if matplotlib_spec is None or not matplotlib_spec.submodule_search_locations:
+            raise
+        font_path = os.path.join(matplotlib_spec.submodule_search_locations[0], 'mpl-data', 'fonts', 'ttf',
+                                 'DejaVuSans.ttf')
+        return ImageFont.truetype(font_path, round(font_size))
+
+
+font = _load_font()
+
+
+def _text_mask(text: str, angle: float = 0) -> Image.Image:
+    """Antialiased text as an 'L' mask, rotated counterclockwise by angle degrees."""
+    ascent, descent = font.getmetrics()
+    left, _, right, _ = font.getbbox(text, anchor='ls')
+    mask = Image.new('L', (max(1, math.ceil(right - left)), ascent + descent))
+    ImageDraw.Draw(mask).text((-left, ascent), text, fill=255, font=font, anchor='ls')
+    if angle:
+        mask = mask.rotate(angle, resample=Image.Resampling.BICUBIC, expand=True)
+    return mask
+
+
+def _paste_text(image: Image.Image, mask: Image.Image, left: float, top: float) -> None:
+    left, top = round(left), round(top)
+    image.paste(text_color, (left, top, left + mask.width, top + mask.height), mask)
+
+
+def _ticks(vmin: float, vmax: float, bins: int) -> list[float]:
+    """Tick positions of matplotlib's default locator (MaxNLocator with steps 1, 2, 2.5, 5, 10)."""
+    raw_step = (vmax - vmin) / bins
+    scale = 10 ** math.floor(math.log10(raw_step))
+    steps = [step * scale for step in (0.5, 1, 2, 2.5, 5, 10, 20)]
+    tolerance = 1e-10 * scale
+    large_step = next(i for i, step in enumerate(steps) if step >= raw_step - tolerance)
+    ticks = []
+    for step in reversed(steps[:large_step + 1]):
+        best_vmin = (vmin // step) * step
+        low = math.floor((vmin - best_vmin) / step + 1e-10)
+        high = math.ceil((vmax - best_vmin) / step - 1e-10)
+        ticks = [best_vmin + i * step for i in range(low, high + 1)]
+        if sum(vmin - tolerance <= tick <= vmax + tolerance for tick in ticks) >= 2:
+            break
+    return [tick for tick in ticks if vmin - tolerance <= tick <= vmax + tolerance]
+
+
+def _format_ticks(ticks: list[float]) -> list[str]:
+    """Same number of decimals for every tick, as few as needed."""
+    decimals = next((d for d in range(7) if all(abs(round(tick, d) - tick) < 1e-9 for tick in ticks)), 6)
+    return [f'{tick:.{decimals}f}' for tick in ticks]
+
+
+def _x_limits(x: list[float]) -> tuple[float, float]:
+    if not x:
+        return 0.0, 1.0
+    vmin, vmax = min(x), max(x)
+    if vmin == vmax:
+        vmin, vmax = vmin - axis_margin * abs(vmin), vmax + axis_margin * abs(vmax)
+        if vmin == vmax:
+            vmin, vmax = -axis_margin, axis_margin
+    margin = (vmax - vmin) * axis_margin
+    return vmin - margin, vmax + margin
+
+
+def _fit_line(x: list[float], y: list[float]) -> tuple[float, float]:
+    n = len(x)
+    mean_x, mean_y = sum(x) / n, sum(y) / n
+    sxx = sum((xi - mean_x) ** 2 for xi in x)
+    sxy = sum((xi - mean_x) * (yi - mean_y) for xi, yi in zip(x, y))
+    slope = sxy / sxx if sxx else 0.0
+    return slope, mean_y - slope * mean_x
+
+
+def draw_plot_mass(day: Sequence[float], mass: Sequence[float], file_object: BinaryIO,
+                   regression_coef: Optional[Sequence[float]] = None,
+                   band: Optional[tuple[Sequence[float], Sequence[float]]] = None) -> Optional[Sequence[float]]:
+    render_start = time.perf_counter()
+    x = [float(value) for value in day]
+    y = [float(value) for value in mass]
+
+    if regression_coef is None and len(x) > 1:
+        regression_coef = _fit_line(x, y)
+
+    if band is not None:
+        band = [float(value) for value in band[0]], [float(value) for value in band[1]]
+    if len(x) > 1:
+        lowest, highest = (min(band[0]), max(band[1])) if band is not None else (min(y), max(y))
+        y_limits = (lowest // 5 * 5 - 6, highest // 5 * 5 + 6)
+    else:
+        y_limits = (64, 76)
+    x_limits = _x_limits(x)
+
+    width, height = figure_size[0] * dpi, figure_size[1] * dpi
+    text_height = sum(font.getmetrics())
+
+    # Tick space as in matplotlib: three font sizes per x tick, two per y tick
+    bins_x = max(1, min(max_bins, int(width * 0.775 / (font_size * 3))))
+    bins_y = max(1, min(max_bins, int(height * 0.77 / (font_size * 2))))
+    x_ticks = _ticks(*x_limits, bins_x)
+    y_ticks = _ticks(*y_limits, bins_y)
+    x_labels = [_text_mask((epoch + timedelta(days=tick)).strftime('%d %b'), 45) for tick in x_ticks]
+    y_labels = [_text_mask(label) for label in _format_ticks(y_ticks)]
+    y_label = _text_mask('Bodyweight, kg', 90)
+
+    # Tight layout: the axes take all the space left by the labels
+    y_labels_width = max((label.width for label in y_labels), default=0)
+    left = layout_pad + y_label.width + label_pad + y_labels_width + tick_pad + tick_length
+    bottom = height - layout_pad - max((label.height for label in x_labels), default=0) - tick_pad - tick_length
+    top = layout_pad + text_height / 2
+    right = width - layout_pad
+
+    def to_pixel_x(value: float) -> float:
+        return left + (value - x_limits[0]) / (x_limits[1] - x_limits[0]) * (right - left)
+
+    if x_labels:
+        # Rotated date labels may stick out past the axes ends
+        right -= max(0.0, to_pixel_x(x_ticks[-1]) + x_labels[-1].width / 2 - (width - layout_pad))
+        left += max(0.0, layout_pad - (to_pixel_x(x_ticks[0]) - x_labels[0].width / 2))
+
+    def to_pixel_y(value: float) -> float:
+        return bottom - (value - y_limits[0]) / (y_limits[1] - y_limits[0]) * (bottom - top)
+
+    image = Image.new('RGB', (width, height), 'white')
+
+    # Data and grid are drawn on a separate image of the axes size, which clips them to the axes
+    axes_left, axes_top = round(left), round(top)
+    axes = Image.new('RGB', (round(right) - axes_left, round(bottom) - axes_top), 'white')
+    axes_draw = ImageDraw.Draw(axes)
+    if band is not None:
+        axes_draw.polygon([(to_pixel_x(xi) - axes_left, to_pixel_y(yi) - axes_top)
+                           for xi, yi in zip(x + x[::-1], band[1] + band[0][::-1])], fill=band_color)
+    radius = marker_diameter / 2
+    for xi, yi in zip(x, y):
+        px, py = to_pixel_x(xi) - axes_left, to_pixel_y(yi) - axes_top
+        axes_draw.ellipse((px - radius, py - radius, px + radius, py + radius), fill=marker_color)
+    for tick in x_ticks:
+        px = to_pixel_x(tick) - axes_left
+        axes_draw.line(((px, 0), (px, axes.height)), fill=grid_color, width=round(grid_width))
+    for tick in y_ticks:
+        py = to_pixel_y(tick) - axes_top
+        axes_draw.line(((0, py), (axes.width, py)), fill=grid_color, width=round(grid_width))
+    if len(x) > 1:
+        slope, intercept = regression_coef[0], regression_coef[1]
+        axes_draw.line([(to_pixel_x(xi) - axes_left, to_pixel_y(slope * xi + intercept) - axes_top)
+                        for xi in (min(x), max(x))], fill=line_color, width=round(line_width))
+    image.paste(axes, (axes_left, axes_top))
+
+    draw = ImageDraw.Draw(image)
+    half_spine = spine_width / 2
+    draw.rectangle((left - half_spine, top - half_spine, right + half_spine, bottom + half_spine),
+                   outline=text_color, width=round(spine_width))
+
+    for tick, label in zip(x_ticks, x_labels):
+        px = to_pixel_x(tick)
+        draw.line(((px, bottom), (px, bottom + tick_length)), fill=text_color, width=round(tick_width))
+        _paste_text(image, label, px - label.width / 2, bottom + tick_length + tick_pad)
+    for tick, label in zip(y_ticks, y_labels):
+        py = to_pixel_y(tick)
+        draw.line(((left - tick_length, py), (left, py)), fill=text_color, width=round(tick_width))
+        _paste_text(image, label, left - tick_length - tick_pad - label.width, py - label.height / 2)
+    _paste_text(image, y_label, left - tick_length - tick_pad - y_labels_width - label_pad - y_label.width,
+                (top + bottom) / 2 - y_label.height / 2)
+    stage_seconds.observe(time.perf_counter() - render_start, stage='plot_render')
+
+    encode_plot_image(image, file_object)
+
+    return regression_coef
@@ -0,0 +1,88 @@
+from collections import OrderedDict
+from datetime import date
+from typing import Hashable, Optional, Union
+
+plot_cache_max_entries = 4096
+plot_cache_max_image_bytes = 16 * 1024 * 1024
+
+_data_versions: dict[int, int] = {}
+_entries: 'OrderedDict[Hashable, PlotCacheEntry]' = OrderedDict()
+_image_bytes = 0
+
+
+class PlotCacheEntry:
+    """A rendered plot with its statistics.
+
+    The image bytes are kept only until Telegram returns a file_id for them,
+    after that the plot is resent by file_id with no render and no upload.
+    """
+    __slots__ = ('image', 'file_id', 'speed_kg_week', 'mean_mass')
+
+    def __init__(self, image: bytes, speed_kg_week: Optional[float], mean_mass: float):
+        self.image: Optional[bytes] = image
+        self.file_id: Optional[str] = None
+        self.speed_kg_week = speed_kg_week
+        self.mean_mass = mean_mass
+
+    @property
+    def photo(self) -> Union[bytes, str]:
+        return self.file_id if self.file_id is not None else self.image
+
+
+def configure_plot_cache(max_entries: int, max_image_bytes: int) -> None:
+    global plot_cache_max_entries, plot_cache_max_image_bytes
+    plot_cache_max_entries = max_entries
+    plot_cache_max_image_bytes = max_image_bytes
+    _evict()
+
+
+def bump_data_version(user_id: int) -> None:
+    """Invalidate every cached plot of the user. Call after any change to the user's records."""
+    _data_versions[user_id] = _data_versions.get(user_id, 0) + 1
+
+
+def plot_cache_key(user_id: int, only_two_weeks: bool) -> tuple:
+    # The two-week window moves every day even if the data does not change
+    window = date.today().toordinal() if only_two_weeks else 'all'
+    return user_id, window, _data_versions.get(user_id, 0)
+
+
+def get_cached_plot(key: Hashable) -> Optional[PlotCacheEntry]:
+    entry = _entries.get(key)
+    if entry is not None:
+        _entries.move_to_end(key)
+    return entry
+
+
+def cache_plot(key: Hashable, image: bytes, speed_kg_week: Optional[float], mean_mass: float) -> None:
+    global _image_bytes
+    _remove(key)
+    _entries[key] = PlotCacheEntry(image, speed_kg_week, mean_mass)
+    _image_bytes += len(image)
+    _evict()
+
+
+def remember_file_id(key: Hashable, image: bytes, file_id: str) -> None:
+    """Store the Telegram file_id of a sent plot and drop its image bytes.
+
+    Nothing happens if the entry was evicted or replaced in the meantime.
+    """
+    global _image_bytes
+    entry = _entries.get(key)
+    if entry is None or entry.image is not image:
+        return
+    _image_bytes -= len(entry.image)
+    entry.image = None
+    entry.file_id = file_id
+
+
+def _remove(key: Hashable) -> None:
+    global _image_bytes
+    entry = _entries.pop(key, None)
+    if entry is not None and entry.image is not None:
+        _image_bytes -= len(entry.image)
+
+
+def _evict() -> None:
+    while _entries and (len(_entries) > plot_cache_max_entries or _image_bytes > plot_cache_max_image_bytes):
+        _remove(next(iter(_entries)))
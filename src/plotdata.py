@@ -0,0 +1,54 @@
+"""Preparation of the plotted series: NumPy arrays, trend line and downsampling.
+
+Imports numpy, so it is loaded lazily, in the render thread.
+"""
+from typing import NamedTuple, Optional
+
+import numpy as np
+
+from src.userstats import regression_coef as stats_regression_coef
+
+# Aggregated bins span whole weeks, so weekly patterns do not shift between bins
+bin_days_step = 7
+
+
+class PlotSeries(NamedTuple):
+    day: np.ndarray
+    mass: np.ndarray
+    band: Optional[tuple[np.ndarray, np.ndarray]]  # min and max of the aggregated records, None if not aggregated
+
+
+def series_from_rows(rows: list[tuple[int, float]]) -> tuple[np.ndarray, np.ndarray]:
+    """(day number, body mass) rows to a day array (int64) and a body mass array (float64)."""
+    if not rows:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float64)
+    table = np.array(rows, dtype=np.float64)
+    return table[:, 0].astype(np.int64), table[:, 1]
+
+
+def regression_coef(day: np.ndarray, mass: np.ndarray) -> Optional[tuple[float, float]]:
+    """Least squares line (slope kg/day, intercept) from the same sums as the stats table."""
+    return stats_regression_coef(len(day), int(day.sum()), float(mass.sum()), float(day @ mass),
+                                 int(day @ day))
+
+
+def downsample(day: np.ndarray, mass: np.ndarray, max_points: int) -> PlotSeries:
+    """Aggregate the series into bins of whole weeks when it has more than max_points records.
+
+    Each bin becomes one point at its mean day and mean body mass, with the bin's min and max
+    body mass as a band. The bins are as short as possible for at most max_points of them.
+    """
+    if len(day) <= max_points:
+        return PlotSeries(day, mass, None)
+
+    span = int(day[-1] - day[0]) + 1
+    bin_days = -(-span // (max_points * bin_days_step)) * bin_days_step
+    bins = (day - day[0]) // bin_days
+
+    # day is sorted, so the records of each bin are contiguous
+    starts = np.flatnonzero(np.r_[True, bins[1:] != bins[:-1]])
+    counts = np.diff(np.r_[starts, len(day)])
+    mean_day = np.add.reduceat(day, starts) / counts
+    mean_mass = np.add.reduceat(mass, starts) / counts
+    band = (np.minimum.reduceat(mass, starts), np.maximum.reduceat(mass, starts))
+    return PlotSeries(mean_day, mean_mass, band)
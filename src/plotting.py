@@ -0,0 +1,105 @@
+"""Plot renderers.
+
+A renderer is a module with a draw_plot_mass(day, mass, file_object, regression_coef=None, band=None)
+function that draws the body mass chart at plot_dpi, writes it to file_object with
+src.imageencoding.encode_plot_image() and returns the regression coefficients (slope kg/day,
+intercept) or None with less than two points. Days are day numbers since 1970-01-01.
+band is an optional (min, max) pair of sequences drawn as a shaded area around aggregated points.
+
+Renderers, the image encoders and the NumPy data preparation are imported on first use, in the
+render thread, so matplotlib and numpy are not loaded until a plot is drawn.
+"""
+from importlib import import_module
+from types import ModuleType
+from typing import BinaryIO, Optional, Sequence
+
+from telebot import logger
+
+plot_renderers = {'matplotlib': 'src.mplplot',
+                  'pillow': 'src.pillowplot'}
+fallback_plot_renderer = 'matplotlib'
+
+plot_renderer = 'pillow'
+plot_max_points = 400
+
+# 'png': full colour PNG, 'palette': PNG with up to 256 colours, 'jpeg', 'webp', or 'auto': the first of
+# plot_auto_formats whose image fits in plot_image_budget bytes, the smallest one if none does
+plot_image_formats = ('png', 'palette', 'jpeg', 'webp', 'auto')
+plot_auto_formats = ('palette', 'jpeg', 'webp')  # lossless first, faster encoders first
+plot_dpi = 160  # 8x5 inches at 160 dpi is 1280x800, the largest photo size Telegram displays
+plot_image_format = 'auto'
+plot_image_quality = 85  # jpeg and webp
+plot_image_budget = 64 * 1024
+
+_renderer: Optional[ModuleType] = None
+
+
+def configure_plot_renderer(name: str, max_points: int = plot_max_points) -> None:
+    """Select the renderer and the number of points above which records are aggregated.
+
+    Must be called before the first plot.
+    """
+    global plot_renderer, plot_max_points
+    if name not in plot_renderers:
+        raise ValueError(f"Unknown plot renderer {name!r}, expected one of {', '.join(plot_renderers)}")
+    assert _renderer is None, "Plot renderer is already loaded"
+    plot_renderer = name
+    plot_max_points = max(1, max_points)
+
+
+def configure_plot_image(dpi: int = plot_dpi, image_format: str = plot_image_format,
+                         quality: int = plot_image_quality, budget: int = plot_image_budget) -> None:
+    """Select the resolution and the encoding of the plot images.
+
+    The resolution must be set before the first plot, the encoding can change at any time.
+    """
+    global plot_dpi, plot_image_format, plot_image_quality, plot_image_budget
+    if image_format not in plot_image_formats:
+        raise ValueError(f"Unknown plot image format {image_format!r}, "
+                         f"expected one of {', '.join(plot_image_formats)}")
+    assert _renderer is None or dpi == plot_dpi, "Plot renderer is already loaded"
+    plot_dpi = max(1, dpi)
+    plot_image_format = image_format
+    plot_image_quality = min(100, max(1, quality))
+    plot_image_budget = max(1, budget)
+
+
+def load_plot_renderer() -> ModuleType:
+    """Import the selected renderer, or the matplotlib one if the selected renderer cannot be loaded."""
+    global _renderer
+    if _renderer is None:
+        try:
+            renderer = import_module(plot_renderers[plot_renderer])
+        except (ImportError, OSError) as exception:
+            if plot_renderer == fallback_plot_renderer:
+                raise
+            logger.warning("Plot renderer %s is not available (%s), falling back to %s",
+                           plot_renderer, exception, fallback_plot_renderer)
+            renderer = import_module(plot_renderers[fallback_plot_renderer])
+        import_module('src.plotdata')
+        _renderer = renderer
+    return _renderer
+
+
+def draw_plot_mass(day: Sequence[float], mass: Sequence[float], file_object: BinaryIO,
+                   regression_coef: Optional[Sequence[float]] = None,
+                   band: Optional[tuple[Sequence[float], Sequence[float]]] = None) -> Optional[Sequence[float]]:
+    return load_plot_renderer().draw_plot_mass(day, mass, file_object, regression_coef, band)
+
+
+def draw_user_plot(rows: list[tuple[int, float]], file_object: BinaryIO,
+                   regression_coef: Optional[Sequence[float]] = None) -> Optional[Sequence[float]]:
+    """Plot (day number, body mass) rows ordered by day.
+
+    The trend line is fitted on all the rows unless regression_coef is given. Histories longer
+    than plot_max_points are aggregated before drawing, so the drawing cost stays bounded.
+    """
+    renderer = load_plot_renderer()
+    from src.plotdata import series_from_rows, regression_coef as fit_regression, downsample
+
+    day, mass = series_from_rows(rows)
+    if regression_coef is None:
+        regression_coef = fit_regression(day, mass)
+    series = downsample(day, mass, plot_max_points)
+    renderer.draw_plot_mass(series.day, series.mass, file_object, regression_coef, series.band)
+    return regression_coef
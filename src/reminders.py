@@ -0,0 +1,216 @@
+"""Daily weigh-in reminders.
+
+Users pick a time of day, in the bot's local time like the record dates. The reminders are kept in
+the users_reminder table with their next fire time and, in memory, in one heap ordered by fire
+time, so a single task sleeps until the next reminder is due. The table is read once, on startup.
+
+Due reminders are queued and sent at reminder_send_rate a second. Right before each one is sent,
+users whose last record (users_mass_stats.last_day) is from today are skipped, so a user who weighs
+in while a large batch is still being sent is not reminded. A reminder is moved to the next day before it
+is sent, so reminders still queued when the bot stops are skipped rather than sent twice.
+"""
+import asyncio
+import heapq
+import time
+from collections import deque
+from datetime import date, datetime, timedelta
+from typing import Awaitable, Callable, Optional
+
+from telebot import logger
+from telebot.asyncio_helper import ApiTelegramException
+
+from src.database import fetchall, fetchone, transaction
+from src.metrics import Counter
+from src.userstats import day_number, sqlite_db_users_mass_stats
+from src.workers import shard_of
+
+sqlite_db_users_reminder = 'users_reminder'
+
+reminder_send_rate = 10.0  # reminders a second
+missed_reminder_grace = 3600  # seconds; reminders missed for longer while the bot was down are skipped
+
+reminders_total = Counter('bodymass_reminders_total', 'Due reminders by outcome.', ('result',))
+
+_reminders: dict[int, tuple[int, int]] = {}  # user_id -> (next fire time, minute of the day)
+_heap: list[tuple[int, int]] = []  # (fire time, user_id); entries of moved or cancelled reminders go stale
+_due: deque = deque()  # user ids waiting to be reminded
+_wakeup = asyncio.Event()
+_due_added = asyncio.Event()
+_send: Optional[Callable[[int], Awaitable]] = None
+_tasks: list[asyncio.Task] = []
+_send_tasks: set[asyncio.Task] = set()
+
+
+def parse_reminder_time(text: str) -> Optional[int]:
+    """'HH:MM' to the minute of the day, None if the text is not a valid time."""
+    try:
+        parsed = datetime.strptime(text.strip(), '%H:%M')
+    except ValueError:
+        return None
+    return parsed.hour * 60 + parsed.minute
+
+
+def format_reminder_time(minute: int) -> str:
+    return f'{minute // 60:02d}:{minute % 60:02d}'
+
+
+def next_fire_time(minute: int, after: float) -> int:
+    """Unix time of the first local minute of the day after the given unix time."""
+    day = datetime.fromtimestamp(after).date()
+    while True:
+        fire = int(datetime(day.year, day.month, day.day, minute // 60, minute % 60).timestamp())
+        if fire > after:
+            return fire
+        day += timedelta(days=1)
+
+
+def get_reminder(user_id: int) -> Optional[int]:
+    """Minute of the day of the user's reminder, None without one."""
+    reminder = _reminders.get(user_id)
+    return reminder[1] if reminder is not None else None
+
+
+def _schedule(user_id: int, fire: int, minute: int) -> None:
+    global _heap
+    _reminders[user_id] = (fire, minute)
+    heapq.heappush(_heap, (fire, user_id))
+    if len(_heap) > 2 * len(_reminders) + 1024:
+        _heap = [(fire, user_id) for user_id, (fire, _) in _reminders.items()]
+        heapq.heapify(_heap)
+    if _heap[0] == (fire, user_id):
+        _wakeup.set()
+
+
+async def set_reminder(user_id: int, minute: int) -> None:
+    fire = next_fire_time(minute, time.time())
+    async with transaction() as db:
+        await db.execute(f"INSERT OR REPLACE INTO {sqlite_db_users_reminder} (user_id, minute, next_fire) "
+                         f"VALUES (?, ?, ?)", (user_id, minute, fire))
+    _schedule(user_id, fire, minute)
+
+
+async def cancel_reminder(user_id: int) -> None:
+    async with transaction() as db:
+        await db.execute(f"DELETE FROM {sqlite_db_users_reminder} WHERE user_id = ?", (user_id,))
+    _reminders.pop(user_id, None)
+
+
+async def _store_fire_times(fire_times: list[tuple[int, int]]) -> None:
+    async with transaction() as db:
+        await db.executemany(f"UPDATE {sqlite_db_users_reminder} SET next_fire = ? WHERE user_id = ?", fire_times)
+
+
+async def load_reminders(shard: int = 0, shards: int = 1) -> None:
+    """Read the reminders of the shard's users from the database.
+
+    Reminders missed by more than missed_reminder_grace move to the next day.
+    """
+    global _heap
+    now = time.time()
+    moved = []
+    for user_id, minute, fire in await fetchall(f"SELECT user_id, minute, next_fire FROM {sqlite_db_users_reminder}"):
+        if shard_of(user_id, shards) != shard:
+            continue
+        if fire < now - missed_reminder_grace:
+            fire = next_fire_time(minute, now)
+            moved.append((fire, user_id))
+        _reminders[user_id] = (fire, minute)
+    _heap = [(fire, user_id) for user_id, (fire, _) in _reminders.items()]
+    heapq.heapify(_heap)
+    if moved:
+        await _store_fire_times(moved)
+    logger.info("Loaded %d reminders", len(_reminders))
+
+
+async def _run_timer() -> None:
+    while True:
+        now = time.time()
+        fired = []
+        while _heap and _heap[0][0] <= now:
+            fire, user_id = heapq.heappop(_heap)
+            reminder = _reminders.get(user_id)
+            if reminder is None or reminder[0] != fire:
+                continue
+            next_fire = next_fire_time(reminder[1], now)
+            _schedule(user_id, next_fire, reminder[1])
+            fired.append((next_fire, user_id))
+        if fired:
+            try:
+                await _store_fire_times(fired)
+            except Exception as exception:
+                logger.error("Failed to store reminder times: %s: %s", type(exception).__name__, exception)
+            _due.extend(user_id for _, user_id in fired)
+            _due_added.set()
+
+        _wakeup.clear()
+        timeout = max(0.0, _heap[0][0] - time.time()) if _heap else None
+        try:
+            await asyncio.wait_for(_wakeup.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+
+async def _logged_today(user_id: int) -> bool:
+    return await fetchone(f"SELECT 1 FROM {sqlite_db_users_mass_stats} WHERE user_id = ? AND last_day >= ?",
+                          (user_id, day_number(date.today()))) is not None
+
+
+async def _send_reminder(user_id: int) -> None:
+    try:
+        await _send(user_id)
+    except ApiTelegramException as exception:
+        if exception.error_code == 403:
+            # The user blocked the bot or deleted the account
+            reminders_total.inc(result='unsubscribed')
+            await cancel_reminder(user_id)
+        else:
+            reminders_total.inc(result='failed')
+            logger.error("Failed to send a reminder to %s: %s", user_id, exception)
+    except Exception as exception:
+        reminders_total.inc(result='failed')
+        logger.error("Failed to send a reminder to %s: %s: %s", user_id, type(exception).__name__, exception)
+    else:
+        reminders_total.inc(result='sent')
+
+
+async def _run_sender() -> None:
+    while True:
+        if not _due:
+            _due_added.clear()
+            await _due_added.wait()
+            continue
+        user_id = _due.popleft()
+        if user_id not in _reminders:
+            continue
+        try:
+            logged_today = await _logged_today(user_id)
+        except Exception as exception:
+            logger.error("Failed to check the records of %s: %s: %s", user_id, type(exception).__name__, exception)
+            logged_today = False
+        if logged_today:
+            reminders_total.inc(result='skipped')
+            continue
+        task = asyncio.create_task(_send_reminder(user_id))
+        _send_tasks.add(task)
+        task.add_done_callback(_send_tasks.discard)
+        await asyncio.sleep(1 / reminder_send_rate)
+
+
+async def start_reminders(send: Callable[[int], Awaitable], send_rate: float, shard: int = 0,
+                          shards: int = 1) -> None:
+    """Load the reminders and start sending them with send(user_id).
+
+    With several worker processes each one sends the reminders of its own shard of the users.
+    """
+    global _send, reminder_send_rate
+    _send = send
+    reminder_send_rate = send_rate
+    await load_reminders(shard, shards)
+    _tasks.extend([asyncio.create_task(_run_timer()), asyncio.create_task(_run_sender())])
+
+
+async def stop_reminders() -> None:
+    for task in _tasks + list(_send_tasks):
+        task.cancel()
+    await asyncio.gather(*_tasks, *_send_tasks, return_exceptions=True)
+    _tasks.clear()
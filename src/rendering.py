@@ -0,0 +1,44 @@
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Optional
+
+render_workers = 1
+render_queue_size = 8
+
+_executor: Optional[ThreadPoolExecutor] = None
+_slots: Optional[asyncio.Semaphore] = None
+
+
+def configure_renderer(workers: int, queue_size: int) -> None:
+    """Set the render worker count and the number of jobs allowed to wait for a worker.
+
+    Must be called before the first render.
+    """
+    global render_workers, render_queue_size
+    assert _executor is None, "Renderer is already running"
+    render_workers = max(1, workers)
+    render_queue_size = max(0, queue_size)
+
+
+async def run_render(func: Callable, *args, **kwargs) -> Any:
+    """Run a rendering function in the worker pool without blocking the event loop.
+
+    At most render_workers + render_queue_size jobs are submitted at once;
+    further callers wait here until a slot frees up.
+    """
+    global _executor, _slots
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=render_workers, thread_name_prefix='render')
+        _slots = asyncio.Semaphore(render_workers + render_queue_size)
+
+    async with _slots:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(_executor, functools.partial(func, *args, **kwargs))
+
+
+def shutdown_renderer() -> None:
+    global _executor, _slots
+    if _executor is not None:
+        _executor.shutdown(wait=True)
+        _executor, _slots = None, None
@@ -0,0 +1,217 @@
+"""Per-user running sums for the body mass trend line.
+
+Days are counted from 1970-01-01, the same scale as matplotlib date numbers, so the
+regression coefficients can be used for plotting directly.
+
+Run as ``python -m src.userstats [--database PATH] [--rebuild]`` to check the table against the raw records.
+"""
+import argparse
+import asyncio
+import sys
+from bisect import bisect_left
+from datetime import date
+from itertools import accumulate
+from typing import NamedTuple, Optional, Sequence
+
+import aiosqlite
+
+import src.database
+from src.database import fetchall, fetchone, close_connection, transaction
+
+sqlite_db_users_mass = 'users_mass'
+sqlite_db_users_mass_stats = 'users_mass_stats'
+
+unix_epoch_ordinal = date(1970, 1, 1).toordinal()
+
+users_mass_stats_source_query = f"""
+    SELECT user_id, COUNT(*), SUM(day), SUM(body_mass), SUM(day * body_mass), SUM(day * day), MIN(day), MAX(day)
+    FROM {sqlite_db_users_mass}
+    GROUP BY user_id
+"""
+
+_update_query = f"""
+    INSERT INTO {sqlite_db_users_mass_stats} (user_id, n, sum_x, sum_y, sum_xy, sum_xx, first_day, last_day)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+    ON CONFLICT (user_id) DO UPDATE SET
+        n = n + excluded.n,
+        sum_x = sum_x + excluded.sum_x,
+        sum_y = sum_y + excluded.sum_y,
+        sum_xy = sum_xy + excluded.sum_xy,
+        sum_xx = sum_xx + excluded.sum_xx,
+        first_day = min(first_day, excluded.first_day),
+        last_day = max(last_day, excluded.last_day)
+"""
+
+_relative_tolerance = 1e-6
+
+
+class UserStats(NamedTuple):
+    n: int
+    sum_x: int
+    sum_y: float
+    sum_xy: float
+    sum_xx: int
+    first_day: int
+    last_day: int
+
+    @property
+    def mean_mass(self) -> float:
+        return self.sum_y / self.n
+
+    @property
+    def regression_coef(self) -> Optional[tuple[float, float]]:
+        """Least squares line (slope kg/day, intercept), same as np.polyfit(x, y, 1)."""
+        return regression_coef(self.n, self.sum_x, self.sum_y, self.sum_xy, self.sum_xx)
+
+
+class WindowStats(NamedTuple):
+    days: Optional[int]  # None for all the records
+    n: int
+    first_day: int
+    mean_mass: float
+    min_mass: float
+    max_mass: float
+    regression_coef: Optional[tuple[float, float]]  # slope kg/day, intercept (days from first_day)
+
+
+def window_stats(rows: Sequence[tuple[int, float]], today: int,
+                 windows: Sequence[Optional[int]]) -> list[Optional[WindowStats]]:
+    """Stats of the records of the last days of each window, up to today, None for all the records.
+
+    One pass over the (day number, body mass) rows, ordered by day, builds prefix sums of the
+    regression sums and suffix minima and maxima. The windows all end at the last record, so each
+    one is then a bisect and a few subtractions. Windows without records are None.
+    """
+    if not rows:
+        return [None] * len(windows)
+    first_day = rows[0][0]
+    # Days from the first record keep the sums small
+    x = [day - first_day for day, _ in rows]
+    y = [body_mass for _, body_mass in rows]
+    prefix_x = list(accumulate(x, initial=0))
+    prefix_y = list(accumulate(y, initial=0.0))
+    prefix_xy = list(accumulate((xi * yi for xi, yi in zip(x, y)), initial=0.0))
+    prefix_xx = list(accumulate((xi * xi for xi in x), initial=0))
+    suffix_min = list(accumulate(reversed(y), min))[::-1]
+    suffix_max = list(accumulate(reversed(y), max))[::-1]
+
+    total = len(rows)
+    stats = []
+    for days in windows:
+        start = 0 if days is None else bisect_left(x, today - days + 1 - first_day)
+        n = total - start
+        if n == 0:
+            stats.append(None)
+            continue
+        sum_x = prefix_x[total] - prefix_x[start]
+        sum_y = prefix_y[total] - prefix_y[start]
+        coef = regression_coef(n, sum_x, sum_y, prefix_xy[total] - prefix_xy[start],
+                               prefix_xx[total] - prefix_xx[start])
+        if coef is not None:
+            # Move the intercept from the first record to the window's first day
+            coef = coef[0], coef[1] + coef[0] * x[start]
+        stats.append(WindowStats(days, n, rows[start][0], sum_y / n, suffix_min[start], suffix_max[start], coef))
+    return stats
+
+
+def day_number(day: date) -> int:
+    return day.toordinal() - unix_epoch_ordinal
+
+
+def regression_coef(n: int, sum_x: int, sum_y: float, sum_xy: float,
+                    sum_xx: int) -> Optional[tuple[float, float]]:
+    # sum_x and sum_xx are exact integers, so the denominator does not lose precision
+    denominator = n * sum_xx - sum_x * sum_x
+    if n < 2 or denominator == 0:
+        return None
+    slope = (n * sum_xy - sum_x * sum_y) / denominator
+    intercept = (sum_y - slope * sum_x) / n
+    return slope, intercept
+
+
+async def update_user_stats(db: aiosqlite.Connection, user_id: int,
+                            added: dict[int, float], replaced: dict[int, float]) -> None:
+    """Add records to the user's sums. Must run in the transaction that writes the records.
+
+    Keyword arguments:
+    :param db: connection with an open write transaction
+    :param user_id: user id
+    :param added: day number -> body mass of every written record
+    :param replaced: day number -> previous body mass of the records being overwritten
+    """
+    if not added:
+        return
+    n = len(added) - len(replaced)
+    sum_x = sum(added) - sum(replaced)
+    sum_y = sum(added.values()) - sum(replaced.values())
+    sum_xy = sum(x * y for x, y in added.items()) - sum(x * y for x, y in replaced.items())
+    sum_xx = sum(x * x for x in added) - sum(x * x for x in replaced)
+    await db.execute(_update_query, (user_id, n, sum_x, sum_y, sum_xy, sum_xx, min(added), max(added)))
+
+
+async def delete_user_stats(db: aiosqlite.Connection, user_id: int) -> None:
+    await db.execute(f"DELETE FROM {sqlite_db_users_mass_stats} WHERE user_id = ?", (user_id,))
+
+
+async def fetch_user_stats(user_id: int) -> Optional[UserStats]:
+    row = await fetchone(f"SELECT n, sum_x, sum_y, sum_xy, sum_xx, first_day, last_day "
+                         f"FROM {sqlite_db_users_mass_stats} WHERE user_id = ?", (user_id,))
+    return UserStats(*row) if row is not None else None
+
+
+def _stats_match(stored: tuple, recomputed: tuple) -> bool:
+    for stored_value, recomputed_value in zip(stored, recomputed):
+        if abs(stored_value - recomputed_value) > _relative_tolerance * max(1.0, abs(recomputed_value)):
+            return False
+    return True
+
+
+async def check_user_stats(rebuild: bool = False) -> list[str]:
+    """Recompute the sums from the raw records and compare them with the table.
+
+    :param rebuild: replace the table with the recomputed sums
+
+    :return: ids of the users whose stored sums are missing or wrong
+    """
+    stored = {row[0]: row[1:] for row in await fetchall(
+        f"SELECT user_id, n, sum_x, sum_y, sum_xy, sum_xx, first_day, last_day FROM {sqlite_db_users_mass_stats}")}
+    recomputed = {row[0]: row[1:] for row in await fetchall(users_mass_stats_source_query)}
+
+    mismatched = [user_id for user_id in stored.keys() | recomputed.keys()
+                  if user_id not in stored or user_id not in recomputed
+                  or not _stats_match(stored[user_id], recomputed[user_id])]
+
+    if rebuild:
+        async with transaction() as db:
+            await db.execute(f"DELETE FROM {sqlite_db_users_mass_stats}")
+            await db.execute(f"INSERT INTO {sqlite_db_users_mass_stats} {users_mass_stats_source_query}")
+
+    return sorted(mismatched)
+
+
+async def _main(arguments: argparse.Namespace) -> int:
+    # src.datautils imports this module
+    from src.datautils import init_database
+
+    src.database.sqlite_db_path = arguments.database
+    try:
+        await init_database()
+        mismatched = await check_user_stats(arguments.rebuild)
+    finally:
+        await close_connection()
+    rebuilt = arguments.rebuild and mismatched
+    print(f"{len(mismatched)} users with inconsistent stats" + (", rebuilt" if rebuilt else ""))
+    for user_id in mismatched:
+        print(user_id)
+    return 1 if mismatched and not arguments.rebuild else 0
+
+
+def parse_arguments(arguments: Optional[list[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Check the per-user stats table against the raw records.")
+    parser.add_argument('--database', default=src.database.sqlite_db_path)
+    parser.add_argument('--rebuild', action='store_true', help='rebuild the stats of the inconsistent users')
+    return parser.parse_args(arguments)
+
+
+if __name__ == '__main__':
+    sys.exit(asyncio.run(_main(parse_arguments())))
@@ -0,0 +1,80 @@
+import asyncio
+import hmac
+from typing import Awaitable, Callable, Optional
+
+from aiohttp import web
+from telebot import logger, types
+from telebot.async_telebot import AsyncTeleBot
+
+secret_token_header = 'X-Telegram-Bot-Api-Secret-Token'
+
+
+def create_webhook_app(bot: AsyncTeleBot, path: str, secret_token: Optional[str], max_in_flight: int,
+                       dispatch: Optional[Callable[[dict], Awaitable]] = None) -> web.Application:
+    """Build an aiohttp application that feeds webhook updates to the bot.
+
+    Every update is acknowledged as soon as it is scheduled. When max_in_flight updates are being
+    processed, the next request waits for a free slot before it is acknowledged. With dispatch,
+    the update dicts are passed to it instead, and acknowledged once it returns.
+    """
+    in_flight = asyncio.Semaphore(max_in_flight)
+    update_tasks: set[asyncio.Task] = set()
+
+    def on_update_done(task: asyncio.Task) -> None:
+        update_tasks.discard(task)
+        in_flight.release()
+
+    async def receive_update(request: web.Request) -> web.Response:
+        if secret_token and not hmac.compare_digest(request.headers.get(secret_token_header, ''), secret_token):
+            return web.Response(status=403)
+        try:
+            update_json = await request.json()
+        except ValueError:
+            return web.Response(status=400)
+        if dispatch is not None:
+            await dispatch(update_json)
+            return web.Response()
+        update = types.Update.de_json(update_json)
+
+        await in_flight.acquire()
+        task = asyncio.create_task(bot.process_new_updates([update]))
+        update_tasks.add(task)
+        task.add_done_callback(on_update_done)
+        return web.Response()
+
+    app = web.Application()
+    app['update_tasks'] = update_tasks
+    app.router.add_post(path, receive_update)
+    return app
+
+
+async def run_webhook(bot: AsyncTeleBot, stop_event: asyncio.Event, host: str, port: int, path: str,
+                      url: Optional[str], secret_token: Optional[str], max_in_flight: int,
+                      drain_timeout: float, dispatch: Optional[Callable[[dict], Awaitable]] = None) -> None:
+    """Serve webhook updates until stop_event is set, then drain the updates in flight.
+
+    Keyword arguments:
+    :param url: public webhook url to register with Telegram, None to skip registration (local testing)
+    :param drain_timeout: how long to wait for the updates in flight on shutdown, seconds
+    :param dispatch: receives the update dicts instead of the bot, see create_webhook_app()
+    """
+    app = create_webhook_app(bot, path, secret_token, max_in_flight, dispatch)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, host, port)
+    await site.start()
+    logger.info("Listening for webhook updates on %s:%d%s", host, port, path)
+
+    if url:
+        await bot.set_webhook(url=url, secret_token=secret_token, max_connections=max_in_flight)
+
+    try:
+        await stop_event.wait()
+    finally:
+        await runner.cleanup()
+        update_tasks = app['update_tasks']
+        if update_tasks:
+            logger.info("Draining %d updates in flight", len(update_tasks))
+            _, pending = await asyncio.wait(update_tasks, timeout=drain_timeout)
+            if pending:
+                logger.warning("%d updates were still in flight after %.0f s", len(pending), drain_timeout)
@@ -0,0 +1,180 @@
+"""Multi-process mode: a front process routes the updates to worker processes by chat id.
+
+Every chat belongs to one worker, shard_of(chat_id, workers), so the updates of a chat are
+handled in order by one process, which alone caches the chat's conversation state and plots.
+The workers share the SQLite database; WAL mode, busy timeouts and immediate write transactions
+make that safe.
+
+Updates are passed as the JSON dicts received from Telegram, through one bounded
+multiprocessing queue per worker. Updates for a worker whose queue is full, or which is being
+restarted, wait in a per-worker backlog in the front process so the other workers keep receiving
+theirs; only a backlog of worker_backlog_size updates holds the front process back.
+"""
+import asyncio
+import collections
+import multiprocessing
+import queue
+import time
+from typing import Callable, Optional
+
+from telebot import logger
+
+worker_restart_delay = 1.0  # seconds, doubled for every crash soon after a start
+worker_max_restart_delay = 60.0
+worker_stable_time = 30.0  # seconds; a worker that ran this long starts over with worker_restart_delay
+worker_backlog_size = 10000  # updates waiting in the front process for one worker
+worker_forward_interval = 0.01  # seconds between attempts to move a backlog into its worker's queue
+
+_update_chat_keys = ('message', 'edited_message', 'channel_post', 'edited_channel_post', 'my_chat_member',
+                     'chat_member', 'chat_join_request')
+
+
+def shard_of(chat_id: int, shards: int) -> int:
+    return chat_id % shards
+
+
+def update_chat_id(update: dict) -> int:
+    """Chat (or, for updates without a chat, user) id of an update, 0 if it has neither."""
+    for key in _update_chat_keys:
+        if key in update:
+            return update[key]['chat']['id']
+    for value in update.values():
+        if isinstance(value, dict):
+            if isinstance(value.get('message'), dict):
+                return value['message']['chat']['id']
+            if isinstance(value.get('from'), dict):
+                return value['from']['id']
+    return 0
+
+
+class WorkerPool:
+    """Runs target(index, workers, updates) in worker processes and restarts the ones that exit.
+
+    target must be importable by the spawned processes, updates is the worker's queue of update
+    dicts; None in it asks the worker to finish the updates in flight and exit.
+    """
+
+    def __init__(self, target: Callable, workers: int, queue_size: int):
+        self._context = multiprocessing.get_context('spawn')
+        self.target = target
+        self.workers = workers
+        self.queue_size = queue_size
+        self._queues = [self._context.Queue(queue_size) for _ in range(workers)]
+        self._backlogs: list[collections.deque] = [collections.deque() for _ in range(workers)]
+        self._processes: list[Optional[multiprocessing.Process]] = [None] * workers
+        self._started_at = [0.0] * workers
+        self._restart_delays = [worker_restart_delay] * workers
+        self._restart_at = [0.0] * workers
+        self._stopping = False
+
+    def _start(self, index: int) -> None:
+        process = self._context.Process(target=self.target, args=(index, self.workers, self._queues[index]),
+                                        name=f'bodymass-worker-{index}')
+        process.start()
+        self._processes[index] = process
+        self._started_at[index] = time.monotonic()
+        logger.info("Started worker %d (pid %d)", index, process.pid)
+
+    def start(self) -> None:
+        for index in range(self.workers):
+            self._start(index)
+
+    async def supervise(self, interval: float = 1.0) -> None:
+        """Restart the workers that exit, with a growing delay for workers that keep crashing."""
+        while not self._stopping:
+            now = time.monotonic()
+            for index, process in enumerate(self._processes):
+                if process is None or process.is_alive():
+                    continue
+                if self._restart_at[index] == 0:
+                    if now - self._started_at[index] >= worker_stable_time:
+                        self._restart_delays[index] = worker_restart_delay
+                    logger.error("Worker %d exited with code %s, restarting in %.0f s", index, process.exitcode,
+                                 self._restart_delays[index])
+                    self._restart_at[index] = now + self._restart_delays[index]
+                    self._restart_delays[index] = min(worker_max_restart_delay, self._restart_delays[index] * 2)
+                elif now >= self._restart_at[index]:
+                    self._restart_at[index] = 0
+                    process.close()
+                    self._replace_queue(index)
+                    self._start(index)
+            await asyncio.sleep(interval)
+
+    def _replace_queue(self, index: int) -> None:
+        """Give a restarted worker a new queue, with the updates left in the old one ahead of its backlog."""
+        old_queue = self._queues[index]
+        self._queues[index] = self._context.Queue(self.queue_size)
+        left = []
+        try:
+            while True:
+                # A killed worker may hold the queue's lock, then the updates left in it are lost
+                update = old_queue.get(timeout=0.1)
+                if update is not None:
+                    left.append(update)
+        except queue.Empty:
+            pass
+        except Exception as exception:
+            logger.error("Failed to read the updates left for worker %d: %s: %s", index,
+                         type(exception).__name__, exception)
+        old_queue.close()
+        old_queue.cancel_join_thread()
+        if left:
+            logger.info("Moved %d updates to the new queue of worker %d", len(left), index)
+            self._backlogs[index].extendleft(reversed(left))
+            self._forward(index)
+
+    def _forward(self, index: int) -> None:
+        """Move the worker's backlog into its queue, as far as the queue has room."""
+        backlog = self._backlogs[index]
+        while backlog:
+            try:
+                self._queues[index].put_nowait(backlog[0])
+            except (queue.Full, ValueError):  # ValueError: the queue was closed for a restart
+                return
+            backlog.popleft()
+
+    async def forward(self) -> None:
+        """Keep moving the backlogs into the workers' queues."""
+        while True:
+            for index in range(self.workers):
+                self._forward(index)
+            await asyncio.sleep(worker_forward_interval)
+
+    async def dispatch(self, update: dict) -> None:
+        """Queue the update for the worker of its chat, behind the updates already waiting for it.
+
+        Waits only while that worker's backlog is full.
+        """
+        index = shard_of(update_chat_id(update), self.workers)
+        backlog = self._backlogs[index]
+        backlog.append(update)
+        self._forward(index)
+        while len(backlog) > worker_backlog_size:
+            await asyncio.sleep(worker_forward_interval)
+            self._forward(index)
+
+    async def stop(self, timeout: float) -> None:
+        """Ask every worker to finish its updates and exit, terminate the ones still running after timeout."""
+        self._stopping = True
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        for index in range(self.workers):
+            self._backlogs[index].append(None)
+        while any(self._backlogs) and loop.time() < deadline:
+            for index in range(self.workers):
+                self._forward(index)
+            await asyncio.sleep(worker_forward_interval)
+        if any(self._backlogs):
+            logger.warning("%d updates were not passed to the workers in %.0f s",
+                           sum(update is not None for backlog in self._backlogs for update in backlog), timeout)
+
+        for index, process in enumerate(self._processes):
+            if process is None:
+                continue
+            await loop.run_in_executor(None, process.join, max(0.0, deadline - loop.time()))
+            if process.is_alive():
+                logger.warning("Worker %d did not stop in %.0f s, terminating it", index, timeout)
+                process.terminate()
+                await loop.run_in_executor(None, process.join)
+        for updates in self._queues:
+            updates.close()